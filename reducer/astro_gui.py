@@ -1,7 +1,10 @@
 from collections import OrderedDict
 import os
+import threading
 import warnings
 
+from astropy import units as u
+from astropy.io import fits
 from astropy.modeling import models
 import ccdproc
 from astropy.stats import median_absolute_deviation
@@ -9,6 +12,15 @@ from astropy.stats import median_absolute_deviation
 import numpy as np
 
 from . import gui
+from .checkpoint import Checkpoint
+from .calibration import (DarkModel, DARK_MODEL_KEYWORD, flat_correct,
+                          SCALED_DARK_CACHE_SIZE, subtract_dark,
+                          subtract_overscan)
+from .cosmic_ray import cosmicray_clean, DEFAULT_MAX_ITER
+from .fits_io import (BackgroundWriter, compress_hdulist, encode_hdu,
+                      image_hdu_index, read_ahead, read_ccd, read_hdulist,
+                      read_master, write_atomic, write_sidecar, DEFAULT_QUANTIZE_LEVEL)
+from .planning import DEFAULT_RATES, Plan, header_bytes, image_geometry
 
 import ipywidgets as widgets
 from traitlets import Any, link
@@ -72,6 +84,38 @@ class ReducerBase(gui.ToggleGo):
     destination : str
         Directory in which reduced images will be stored.
 
+    destination_collection : `~ccdproc.ImageFileCollection`, optional
+        Collection of the images in ``destination``. Each image written is
+        added to it as soon as it is written, without the directory being
+        scanned again, if it has an ``add_file`` method (e.g. an
+        `~reducer.header_index.IndexedImageFileCollection`); otherwise the
+        collection is refreshed once all of the images are written.
+
+    compression : str, optional
+        If set, images are written tile compressed with this algorithm, one
+        of ``'RICE_1'``, ``'GZIP_1'`` or ``'GZIP_2'``; see
+        `~reducer.fits_io.compress_hdulist`.
+
+    quantize_level : float, optional
+        Quantization of floating point images compressed with RICE_1.
+
+    output_encoding : str, optional
+        Type in which images are written: ``'float32'``, ``'float64'``, or
+        ``'int16'`` or ``'int32'`` scaled separately for each image; see
+        `~reducer.fits_io.encode_hdu` for the error this introduces. By
+        default reduced images are floating point of a precision that
+        depends on the type of the input (see ``REDUCE_IMAGE_DTYPE_MAPPING``)
+        and combined images have the type of the images combined.
+
+    writer_threads : int, optional
+        Number of threads writing images in the background while the next
+        ones are computed. Set to 0 to write each image before starting the
+        next.
+
+    lean : bool, optional
+        If ``True``, masks and uncertainties are never read, computed or
+        written, which saves memory and time when they are not used.
+
     imagetype_map : dict
         Key-value pairs where the keys are "bias", "dark", "flat", and "light"
         and the values are the values of the "imagetyp" keyword that will be
@@ -80,6 +124,13 @@ class ReducerBase(gui.ToggleGo):
     def __init__(self, *arg, **kwd):
         self._apply_to = kwd.pop('apply_to', None)
         self._destination = kwd.pop('destination', None)
+        self._destination_collection = kwd.pop('destination_collection', None)
+        self._compression = kwd.pop('compression', None)
+        self._quantize_level = kwd.pop('quantize_level',
+                                       DEFAULT_QUANTIZE_LEVEL)
+        self._output_encoding = kwd.pop('output_encoding', None)
+        self._writer_threads = kwd.pop('writer_threads', 1)
+        self._lean = kwd.pop('lean', False)
         self._imagetype_map = kwd.pop('imagetype_map', DEFAULT_IMAGETYPE_MAP)
         self._exposure_time_keyword = kwd.pop('exposure_keyword', 'exposure')
         super(ReducerBase, self).__init__(*arg, **kwd)
@@ -88,6 +139,106 @@ class ReducerBase(gui.ToggleGo):
     def destination(self):
         return self._destination
 
+    @property
+    def destination_collection(self):
+        return self._destination_collection
+
+    @property
+    def compression(self):
+        return self._compression
+
+    @property
+    def output_encoding(self):
+        return self._output_encoding
+
+    @property
+    def lean(self):
+        """
+        If ``True``, masks and uncertainties are neither read, computed nor
+        written.
+        """
+        return self._lean
+
+    @lean.setter
+    def lean(self, value):
+        self._lean = value
+
+    def _output_hdulist(self, hdulist, index=0):
+        """
+        The HDUs to write for an output image, compressed if compression
+        was requested.
+        """
+        if not self._compression:
+            return hdulist
+        return compress_hdulist(hdulist, index, self._compression,
+                                self._quantize_level)
+
+    def _register_output(self, path, header):
+        """
+        Add a file that was just written to the destination collection.
+        """
+        collection = self._destination_collection
+        if collection is not None and hasattr(collection, 'add_file'):
+            collection.add_file(path, header)
+
+    def _writer(self):
+        """
+        A background writer for the images written by one action, or
+        ``None`` if images are to be written as soon as they are computed.
+        """
+        if not self._writer_threads:
+            return None
+        return BackgroundWriter(n_threads=self._writer_threads)
+
+    def _write_output(self, hdulist, path, header, writer=None,
+                      before_commit=None):
+        """
+        Write an output file, or queue it on ``writer``, and register it
+        once it is written. The file never appears half written; see
+        `~reducer.fits_io.write_atomic`, to which ``before_commit`` is
+        passed.
+        """
+        if writer is None:
+            write_atomic(hdulist, path, before_commit=before_commit)
+            self._register_output(path, header)
+        else:
+            writer.submit(hdulist, path, header, before_commit=before_commit)
+            self._writes_finished(writer.done())
+
+    def _writes_finished(self, finished, raise_errors=True):
+        """
+        Register the files a background writer has written and raise the
+        first error, if any, it ran into.
+        """
+        errors = []
+        for path, header, error in finished:
+            if error is None:
+                self._register_output(path, header)
+            elif not self._write_failed(path, error):
+                errors.append(error)
+        if errors and raise_errors:
+            raise errors[0]
+
+    def _write_failed(self, path, error):
+        """
+        Deal with an error writing ``path`` in the background, returning
+        ``True`` if it was dealt with and should not be raised.
+        """
+        return False
+
+    def _close_writer(self, writer, raise_errors=True):
+        if writer is not None:
+            self._writes_finished(writer.close(), raise_errors=raise_errors)
+
+    def _outputs_done(self):
+        """
+        Bring a destination collection that cannot have files added one at
+        a time up to date.
+        """
+        collection = self._destination_collection
+        if collection is not None and not hasattr(collection, 'add_file'):
+            collection.refresh()
+
     @property
     def apply_to(self):
         """
@@ -105,10 +256,44 @@ class ReducerBase(gui.ToggleGo):
         return self._imagetype_map
 
 
+def _read_or_error(path):
+    """
+    Read a file with `~reducer.fits_io.read_hdulist`, returning the error
+    instead of raising it so that reading ahead carries on past bad files.
+    """
+    try:
+        return read_hdulist(path)
+    except Exception as e:
+        return e
+
+
 class Reduction(ReducerBase):
     """
     Primary widget for performing a logical reduction step (e.g. dark
     subtraction or flat correction).
+
+    Parameters
+    ----------
+
+    read_ahead : int, optional
+        Number of input files read, on background threads, ahead of the one
+        being reduced. Set to 0 to read each file only when it is reduced.
+
+    shared_masters : dict, optional
+        `~reducer.shared_masters.SharedMaster` handles, by path, of masters
+        published in shared memory, e.g. by
+        `~reducer.shared_masters.SharedMasterStore.publish_masters`. The
+        calibration steps map these masters instead of each reading its own
+        copy.
+
+    checkpoint : bool, optional
+        If ``True``, each reduced file is recorded in a
+        `~reducer.checkpoint.Checkpoint` in the destination directory as it
+        is written, and files already reduced from the same input are
+        skipped, so a reduction that was interrupted resumes where it
+        stopped instead of finding its own outputs in the way.
+
+    All other parameters are the same as those for `ReducerBase`.
     """
     def __init__(self, *arg, **kwd):
         allow_flat = kwd.pop('allow_flat', True)
@@ -118,13 +303,22 @@ class Reduction(ReducerBase):
         allow_copy = kwd.pop('allow_copy_only', True)
         self.image_collection = kwd.pop('input_image_collection', None)
         self._master_source = kwd.pop('master_source', None)
+        self._read_ahead = kwd.pop('read_ahead', 2)
+        shared_masters = kwd.pop('shared_masters', None)
+        self._checkpoint = kwd.pop('checkpoint', True)
+        self._journal = None
+        self._failures = OrderedDict()
+        # Input each output being written comes from, by path, while
+        # action runs.
+        self._writing = None
         super(Reduction, self).__init__(*arg, **kwd)
         self._overscan = Overscan(description='Subtract overscan?')
         self._trim = Trim(description='Trim (specify region to keep)?')
         self._cosmic_ray = CosmicRaySettings()
-        self._bias_calib = BiasSubtract(master_source=self._master_source, imagetype_map=self.imagetype_map)
-        self._dark_calib = DarkSubtract(master_source=self._master_source, imagetype_map=self.imagetype_map, exposure_keyword=self._exposure_time_keyword)
-        self._flat_calib = FlatCorrect(master_source=self._master_source, imagetype_map=self.imagetype_map)
+        self._bias_calib = BiasSubtract(master_source=self._master_source, imagetype_map=self.imagetype_map, lean=self.lean)
+        self._dark_calib = DarkSubtract(master_source=self._master_source, imagetype_map=self.imagetype_map, exposure_keyword=self._exposure_time_keyword, lean=self.lean)
+        self._flat_calib = FlatCorrect(master_source=self._master_source, imagetype_map=self.imagetype_map, lean=self.lean)
+        self.shared_masters = shared_masters
 
         if allow_copy:
             self._copy_only = CopyFiles()
@@ -152,7 +346,281 @@ class Reduction(ReducerBase):
             )
         self.visible = kwd.pop('visible', True)
 
-    def action(self):
+    @ReducerBase.lean.setter
+    def lean(self, value):
+        self._lean = value
+        for step in (self._bias_calib, self._dark_calib, self._flat_calib):
+            step.lean = value
+
+    @property
+    def shared_masters(self):
+        """
+        Handles, by path, of masters the calibration steps map from shared
+        memory instead of reading.
+        """
+        return self._shared_masters
+
+    @shared_masters.setter
+    def shared_masters(self, value):
+        self._shared_masters = value or {}
+        for step in (self._bias_calib, self._dark_calib, self._flat_calib):
+            step.shared_masters = self._shared_masters
+
+    def _checkpoint_journal(self):
+        """
+        The checkpoint of the destination directory, or ``None`` if
+        checkpointing is off.
+        """
+        if not self._checkpoint:
+            return None
+        if (self._journal is None or
+                self._journal.directory != self.destination):
+            self._journal = Checkpoint(self.destination)
+        return self._journal
+
+    def _unfinished(self, files, clean=False):
+        """
+        The files not yet reduced according to the checkpoint, if any; with
+        ``clean``, files left half written for them are removed.
+        """
+        journal = self._checkpoint_journal()
+        if journal is None:
+            return list(files)
+        # Pick up outputs recorded by other runs, e.g. one interrupted.
+        journal.reload()
+        if clean:
+            journal.remove_partial(files)
+        location = self.image_collection.location
+        return [fname for fname in files if not journal.done(
+            fname, os.path.join(self.destination, os.path.basename(fname)),
+            source_path=os.path.join(location, fname))]
+
+    def masters_used(self):
+        """
+        Image types, ``'bias'``, ``'dark'`` or ``'flat'``, of the masters
+        the selected calibration steps use.
+
+        Returns
+        -------
+
+        list of str
+        """
+        steps = [('bias', self._bias_calib), ('dark', self._dark_calib),
+                 ('flat', self._flat_calib)]
+        return [image_type for image_type, step in steps
+                if step in self.container.children and step.toggle.value]
+
+    def plan(self, rates=None):
+        """
+        Work out what pressing Go would do, reading headers but no pixels.
+
+        Parameters
+        ----------
+
+        rates : dict, optional
+            Rates used to estimate the run time, e.g. from
+            `~reducer.planning.load_rates`; any not given are taken from
+            `~reducer.planning.DEFAULT_RATES`.
+
+        Returns
+        -------
+
+        `~reducer.planning.Plan`
+            The files selected, other than those a checkpoint shows are
+            already reduced, the master each calibration step would use
+            for each, and estimates of the I/O, memory and time needed.
+            Output sizes do not allow for trimming or compression.
+        """
+        if not self.image_collection:
+            raise ValueError("No images to reduce")
+        rates = dict(DEFAULT_RATES, **(rates or {}))
+        self.image_collection.refresh()
+        if self._master_source:
+            self._master_source.refresh()
+
+        rate_names = {
+            self._overscan: 'overscan',
+            self._trim: 'trim',
+            self._bias_calib: 'bias',
+            self._dark_calib: 'dark',
+            self._flat_calib: 'flat',
+            self._cosmic_ray: 'cosmic_ray_' + self._cosmic_ray.method,
+        }
+        steps = [child for child in self.container.children
+                 if child.toggle.value]
+        calibrations = [(rate_names[step], step) for step in steps
+                        if isinstance(step, CalibrationStep)]
+        step_rates = []
+        for step in steps:
+            if rate_names.get(step) not in rates:
+                continue
+            # Allow for every pass of cosmic ray rejection being made.
+            passes = self._cosmic_ray.max_iter if step is self._cosmic_ray else 1
+            step_rates.append(rates[rate_names[step]] / passes)
+
+        files = [str(f) for f in self._unfinished(
+            self.image_collection.files_filtered(**self.apply_to))]
+        masters = {}
+        # Exposure times each dark is used for, since a scaled or
+        # synthesized dark is cached for each.
+        dark_exposures = {}
+        problems = []
+        bytes_read = bytes_written = 0
+        runtime = 0.0
+        image_memory = 0
+        for fname in files:
+            path = os.path.join(self.image_collection.location, fname)
+            shape, dtype, header = image_geometry(
+                path, ext=self.image_collection.ext)
+            n_pixels = int(np.prod(shape))
+            destination = os.path.join(self.destination,
+                                       os.path.basename(fname))
+            if os.path.exists(destination):
+                problems.append("{} already exists".format(destination))
+
+            used = {}
+            for name, step in calibrations:
+                try:
+                    used[name] = step.master_file(header)
+                except KeyError as e:
+                    # The message of astropy's KeyError is a sentence, so
+                    # name the keywords instead.
+                    missing = ([keyword for keyword in step.match_on
+                                if keyword not in header] or [e.args[0]])
+                    problems.append("{}: keyword {} needed to choose the {} "
+                                    "master is missing".format(
+                                        fname, ', '.join(missing), name))
+                except (RuntimeError, ValueError) as e:
+                    problems.append("{}: {}".format(fname, e))
+            if 'dark' in used:
+                exposures = dark_exposures.setdefault(used['dark'], set())
+                exposures.add(header.get(self._exposure_time_keyword))
+            masters[fname] = used
+
+            if self._output_encoding is not None:
+                output_dtype = np.dtype(self._output_encoding)
+            else:
+                output_dtype = np.dtype(
+                    REDUCE_IMAGE_DTYPE_MAPPING[dtype.name])
+            input_bytes = os.path.getsize(path)
+            output_bytes = (n_pixels * output_dtype.itemsize +
+                            header_bytes(header, extra_cards=4 * len(steps)))
+            bytes_read += input_bytes
+            bytes_written += output_bytes
+            runtime += (input_bytes / rates['read'] +
+                        output_bytes / rates['write'] +
+                        sum(n_pixels / rate for rate in step_rates))
+
+            # The image being reduced, in double precision and copied by
+            # some steps, the images read ahead of it and those waiting to
+            # be written.
+            working = 2 * 8 * n_pixels
+            if self._cosmic_ray in steps:
+                working += (8 + 1) * n_pixels
+            in_flight = (working +
+                         (self._read_ahead + 1) * n_pixels * dtype.itemsize +
+                         2 * self._writer_threads * n_pixels *
+                         output_dtype.itemsize)
+            image_memory = max(image_memory, in_flight)
+
+        # Each master is read once and kept, along with what is cached for
+        # it: darks scaled to, or synthesized for, each exposure time and
+        # the reciprocal of each flat.
+        master_memory = 0
+        for name, step in calibrations:
+            for master in set(used[name] for used in masters.values()
+                              if name in used):
+                path = os.path.join(self._master_source.location, master)
+                shape, dtype, _ = image_geometry(path)
+                n_pixels = int(np.prod(shape))
+                master_bytes = os.path.getsize(path)
+                bytes_read += master_bytes
+                runtime += master_bytes / rates['read']
+                master_memory += n_pixels * dtype.itemsize
+                if name == 'dark' and (step._model.use_model or
+                                       step._scale.scale):
+                    if step._model.use_model:
+                        master_memory += n_pixels * dtype.itemsize
+                    n_cached = min(len(dark_exposures[master]),
+                                   SCALED_DARK_CACHE_SIZE)
+                    master_memory += n_cached * 8 * n_pixels
+                elif name == 'flat':
+                    master_memory += 8 * n_pixels
+
+        return Plan(files=files, masters=masters, groups=[],
+                    bytes_read=bytes_read, bytes_written=bytes_written,
+                    peak_memory=master_memory + image_memory,
+                    runtime=runtime, problems=problems)
+
+    @property
+    def failures(self):
+        """
+        Files that could not be reduced by the last `action`, with the
+        reason for each, in the order they failed.
+        """
+        return self._failures
+
+    def failure_summary(self):
+        """
+        The files that could not be reduced, and why, as text.
+
+        Returns
+        -------
+
+        str
+        """
+        if not self._failures:
+            return "All files were reduced."
+        lines = ["{} file(s) could not be reduced:".format(
+            len(self._failures))]
+        lines.extend("    {}: {}".format(fname, reason)
+                     for fname, reason in self._failures.items())
+        lines.append("Call retry_failed() to try them again once the "
+                     "problems are fixed. This notebook will NOT overwrite "
+                     "existing files; delete them to reduce them again.")
+        return '\n'.join(lines)
+
+    def retry_failed(self):
+        """
+        Reduce again the files that could not be reduced by the last
+        `action` or, if it has not been run, those the checkpoint in the
+        destination records as failed.
+        """
+        failed = list(self._failures)
+        journal = self._checkpoint_journal()
+        if not failed and journal is not None:
+            journal.reload()
+            failed = list(journal.failures())
+        # Files may have been removed, or fixed so they are not selected.
+        self.image_collection.refresh()
+        selected = set(self.image_collection.files_filtered(**self.apply_to))
+        failed = [fname for fname in failed if fname in selected]
+        if failed:
+            self.action(files=failed)
+
+    def _file_failed(self, fname, destination, error):
+        fname = str(fname)
+        reason = '{}: {}'.format(type(error).__name__, error)
+        self._failures[fname] = reason
+        journal = self._checkpoint_journal()
+        if journal is not None:
+            journal.record_failure(fname, destination, reason)
+
+    def _write_failed(self, path, error):
+        if self._writing is None or path not in self._writing:
+            return False
+        self._file_failed(self._writing[path], path, error)
+        return True
+
+    def action(self, files=None):
+        """
+        Reduce the selected files, or ``files`` if given.
+
+        A file that cannot be read, reduced or written does not stop the
+        others being reduced; it is recorded in `failures`, and in the
+        checkpoint if there is one, and a summary of the failures is
+        printed at the end.
+        """
         if not self.image_collection:
             raise ValueError("No images to reduce")
         self.progress_bar.visible = True
@@ -170,54 +638,208 @@ class Reduction(ReducerBase):
 
         # Suppress warnings that come up here...mostly about HIERARCH keywords
         warnings.filterwarnings('ignore')
+        self._failures = OrderedDict()
+        self._writing = {}
+        writer = self._writer()
+        reader = None
         try:
-            n_files = \
-                len(self.image_collection.files_filtered(**self.apply_to))
-            current_file = 0
-            for hdu, fname in self.image_collection.hdus(return_fname=True,
-                                                         save_location=self.destination,
-                                                         **self.apply_to):
-                current_file += 1
+            if files is None:
+                files = self.image_collection.files_filtered(**self.apply_to)
+            files = self._unfinished(files, clean=True)
+            n_files = len(files)
+            if self._read_ahead:
+                reader = read_ahead(
+                    [os.path.join(self.image_collection.location, fname)
+                     for fname in files],
+                    depth=self._read_ahead, n_threads=self._read_ahead,
+                    read=_read_or_error)
+                inputs = (hdulist for _, hdulist in reader)
+            else:
+                inputs = (None for _ in files)
+            for current_file, (fname, hdulist) in enumerate(zip(files, inputs),
+                                                            1):
+                destination = os.path.join(self.destination,
+                                           os.path.basename(fname))
+                self._writing[destination] = fname
                 try:
-                    unit = hdu.header['BUNIT']
-                except KeyError:
-                    unit = DEFAULT_IMAGE_UNIT
-                ccd = ccdproc.CCDData(hdu.data, meta=hdu.header, unit=unit)
-                for child in self.container.children:
-                    if not child.toggle.value:
-                        # Nothing to do for this child, so keep going.
-                        continue
-                    ccd = child.action(ccd)
-
-                input_dtype = hdu.data.dtype.name
-                hdu_tmp = ccd.to_hdu()[0]
-                hdu.header = hdu_tmp.header
-                hdu.data = hdu_tmp.data
-                desired_dtype = REDUCE_IMAGE_DTYPE_MAPPING[str(input_dtype)]
-                if desired_dtype != hdu.data.dtype:
-                    hdu.data = hdu.data.astype(desired_dtype)
-
-                # Workaround to ensure uint16 images are handled properly.
-                if 'bzero' in hdu.header:
-                    # Check for the unsigned int16 case, and if our data type
-                    # is no longer uint16, delete BZERO and BSCALE
-                    header_unsigned_int = ((hdu.header['bscale'] == 1) and
-                                           (hdu.header['bzero'] == 32768))
-                    if (header_unsigned_int and
-                        (hdu.data.dtype != np.dtype('uint16'))):
-
-                        del hdu.header['bzero'], hdu.header['bscale']
-
+                    if isinstance(hdulist, Exception):
+                        raise hdulist
+                    self.process_file(fname, writer=writer, hdulist=hdulist)
+                except Exception as e:
+                    # Keep going; one bad file should not hold up the rest.
+                    self._file_failed(fname, destination, e)
                 self.progress_bar.description = \
                     ("Processed file {} of {}".format(current_file, n_files))
                 self.progress_bar.value = current_file / n_files
-        except IOError:
-            print("One or more of the reduced images already exists. Delete "
-                  "those files and try again. This notebook will NOT "
-                  "overwrite existing files.")
+            self._close_writer(writer)
         finally:
+            if reader is not None:
+                reader.close()
+            self._close_writer(writer, raise_errors=False)
+            self._writing = None
+            self._outputs_done()
             self.progress_bar.visible = False
             self.progress_bar.layout.display = 'none'
+        if self._failures:
+            print(self.failure_summary())
+
+    def reduce_hdu(self, hdu):
+        """
+        Apply the selected reduction steps to one image.
+
+        Parameters
+        ----------
+
+        hdu : `astropy.io.fits.PrimaryHDU` or `astropy.io.fits.ImageHDU`
+            Image to reduce. Its data are not changed, but its header may be
+            used, and updated, as the header of the reduced image.
+
+        Returns
+        -------
+
+        hdu : same type as the input
+            The reduced image.
+        """
+        try:
+            unit = hdu.header['BUNIT']
+        except KeyError:
+            unit = DEFAULT_IMAGE_UNIT
+        data = hdu.data
+        if isinstance(data, np.ndarray) and data.flags.writeable:
+            # Steps that work in place, like dark subtraction, must not
+            # change the input, so give them a read-only view of it.
+            data = data.view()
+            data.flags.writeable = False
+        ccd = ccdproc.CCDData(data, meta=hdu.header, unit=unit)
+        for child in self.container.children:
+            if not child.toggle.value:
+                # Nothing to do for this child, so keep going.
+                continue
+            ccd = child.action(ccd)
+            if self._lean:
+                ccd.mask = None
+                ccd.uncertainty = None
+
+        return self._output_hdu(ccd, hdu)
+
+    def _output_hdu(self, ccd, hdu):
+        """
+        Build the HDU written for a reduced image.
+
+        The header of ``ccd`` is updated in place rather than copied, and
+        the data are converted to the output type with at most one copy,
+        none if they already have that type.
+
+        Parameters
+        ----------
+
+        ccd : `~ccdproc.CCDData`
+            The reduced image.
+
+        hdu : `astropy.io.fits.PrimaryHDU` or `astropy.io.fits.ImageHDU`
+            The image before reduction; the output is of the same type.
+        """
+        header = ccd.header
+        if not isinstance(header, fits.Header):
+            header = ccd.to_hdu(hdu_mask=None, hdu_uncertainty=None,
+                                hdu_flags=None)[0].header
+        if ccd.unit is not None and ccd.unit != u.dimensionless_unscaled:
+            header['bunit'] = ccd.unit.to_string()
+        if ccd.wcs:
+            header.extend(ccd.wcs.to_header(relax=True), useblanks=False,
+                          update=True)
+
+        if self._output_encoding is not None:
+            return encode_hdu(type(hdu)(data=ccd.data, header=header),
+                              self._output_encoding)
+
+        desired_dtype = REDUCE_IMAGE_DTYPE_MAPPING[hdu.data.dtype.name]
+        data = np.asarray(ccd.data, dtype=desired_dtype)
+
+        # Workaround to ensure uint16 images are handled properly.
+        if 'bzero' in header:
+            # Check for the unsigned int16 case, and if our data type
+            # is no longer uint16, delete BZERO and BSCALE
+            header_unsigned_int = ((header.get('bscale', 1) == 1) and
+                                   (header['bzero'] == 32768))
+            if (header_unsigned_int and
+                (data.dtype != np.dtype('uint16'))):
+
+                header.remove('bzero')
+                header.remove('bscale', ignore_missing=True)
+        return type(hdu)(data=data, header=header)
+
+    def process_file(self, fname, writer=None, hdulist=None):
+        """
+        Reduce one file from the input collection and write the result,
+        with the same name, to the destination directory, adding it to the
+        destination collection if there is one.
+
+        Parameters
+        ----------
+
+        fname : str
+            Name of the file, relative to the location of the input
+            collection.
+
+        writer : `~reducer.fits_io.BackgroundWriter`, optional
+            If given, the result is queued on this writer instead of being
+            written before returning. Errors from writing earlier files
+            queued on it are raised here.
+
+        hdulist : `astropy.io.fits.HDUList`, optional
+            The contents of the file, if they have already been read with
+            `~reducer.fits_io.read_hdulist`.
+
+        Returns
+        -------
+
+        str
+            Path of the reduced file.
+
+        Raises
+        ------
+
+        IOError
+            If the reduced file already exists, unless checkpointing is on
+            and it was reduced from this file, unchanged since, in which
+            case it is left as it is. A reduced file made from an earlier
+            version of the file is not replaced.
+        """
+        ext = self.image_collection.ext
+        source = os.path.join(self.image_collection.location, fname)
+        destination = os.path.join(self.destination, os.path.basename(fname))
+        journal = self._checkpoint_journal()
+        if os.path.exists(destination):
+            if journal is not None and journal.done(fname, destination,
+                                                    source_path=source):
+                return destination
+            raise IOError("{} already exists".format(destination))
+        before_commit = None
+        if journal is not None:
+            def before_commit(written):
+                journal.record(fname, destination, written,
+                               source_path=source)
+        in_memory = hdulist is not None
+        if not in_memory:
+            hdulist = fits.open(source)
+        with hdulist:
+            ext_index = hdulist.index_of(ext)
+            hdulist[ext_index] = self.reduce_hdu(hdulist[ext_index])
+            if writer is not None and not in_memory:
+                # The input file is closed before the output is written, so
+                # any other HDUs have to be read now.
+                hdulist = fits.HDUList([hdu if idx == ext_index else hdu.copy()
+                                        for idx, hdu in enumerate(hdulist)])
+            output = self._output_hdulist(hdulist, ext_index)
+            header = output[ext_index].header
+            if writer is None:
+                self._write_output(output, destination, header,
+                                   before_commit=before_commit)
+        if writer is not None:
+            self._write_output(output, destination, header, writer=writer,
+                               before_commit=before_commit)
+        return destination
 
     def _disable_all_others(self):
         if not self._copy_only:
@@ -390,21 +1012,28 @@ class GroupBy(gui.ToggleContainer):
     def value(self):
         return self._keyword_list.value
 
-    def groups(self, apply_to):
+    @property
+    def keywords(self):
+        """
+        Keywords images are grouped by; empty if they are not grouped.
+        """
         if not (self.toggle.value and self.value):
+            return []
+        return [k.strip() for k in self.value.split(',')]
+
+    def groups(self, apply_to):
+        keywords = self.keywords
+        if not keywords:
             # Return an empty dictionary by default if there is no grouping
             return [{}]
 
         # remember, the rest is really an else to the above...
-        from copy import deepcopy
-        keywords = [k.strip() for k in self.value.split(',')]
-        # Yuck...need to use an internal method to get the mask I need.
-        tmp_coll = deepcopy(self._image_source)
-        tmp_coll._find_keywords_by_values(**apply_to)
-        mask = tmp_coll.summary['file'].mask
-        # Note the logical not below; mask indicates which values
-        # should be EXCLUDED.
-        filtered_table = tmp_coll.summary[~mask]
+        # Select the rows of the summary directly rather than filtering a
+        # copy of the whole collection.
+        summary = self._image_source.summary
+        selected = self._image_source.files_filtered(**apply_to)
+        filtered_table = summary[np.isin(np.asarray(summary['file']),
+                                         selected)]
         grouped_table = filtered_table.group_by(keywords)
         combine_groups = grouped_table.groups.keys
         group_list = []
@@ -424,11 +1053,27 @@ class Combiner(ReducerBase):
 
     description : str, optional
         Text displayed next to check box for selecting options.
+
+    dark_model : bool, optional
+        If ``True``, instead of combining the images of each group, fit a
+        `~reducer.calibration.DarkModel` to them, from which
+        `DarkSubtract` can synthesize a dark of any exposure time. The
+        images of each group must then include at least two exposure times,
+        so darks should not be grouped by exposure time. Both the offset and
+        the rate are written with ``output_encoding``, if it is given.
+
+    master_sidecars : bool, optional
+        If ``True``, each master gets a native-endian sidecar (see
+        `~reducer.fits_io.write_sidecar`) once it is written, so that it is
+        mapped rather than decoded whenever it is used. Sidecars are made
+        nowhere else, so with ``False`` none are written.
     """
     def __init__(self, *args, **kwd):
         group_by_in = kwd.pop('group_by', '')
         self._image_source = kwd.pop('image_source', None)
         self._file_base_name = kwd.pop('file_name_base', 'master')
+        self._dark_model = kwd.pop('dark_model', False)
+        self._master_sidecars = kwd.pop('master_sidecars', True)
         super(Combiner, self).__init__(*args, **kwd)
         self._clipping_widget = \
             Clipping(description="Clip before combining?")
@@ -444,6 +1089,9 @@ class Combiner(ReducerBase):
         self.add_child(self._group_by)
 
         self._combined = None
+        # Masters just combined, by output name, kept until they are
+        # written so their sidecars need not be read back from disk.
+        self._sidecar_sources = {}
 
     @property
     def combined(self):
@@ -456,6 +1104,14 @@ class Combiner(ReducerBase):
     def image_source(self):
         return self._image_source
 
+    @property
+    def group_keywords(self):
+        """
+        Keywords whose values define the groups of images combined
+        separately; empty if all images are combined together.
+        """
+        return self._group_by.keywords
+
     @property
     def is_sane(self):
         # Start with the default sanity determination...
@@ -490,6 +1146,162 @@ class Combiner(ReducerBase):
         self.image_source.refresh()
 
         groups_to_combine = self._group_by.groups(self.apply_to)
+        writer = self._writer()
+        try:
+            self._combine_groups(groups_to_combine, writer)
+            self._close_writer(writer)
+        finally:
+            self._close_writer(writer, raise_errors=False)
+            self._sidecar_sources.clear()
+        self._outputs_done()
+        self.progress_bar.visible = False
+        self.progress_bar.layout.display = 'none'
+
+    def plan(self, rates=None):
+        """
+        Work out what pressing Go would do, reading headers but no pixels.
+
+        Parameters
+        ----------
+
+        rates : dict, optional
+            Rates used to estimate the run time, e.g. from
+            `~reducer.planning.load_rates`; any not given are taken from
+            `~reducer.planning.DEFAULT_RATES`.
+
+        Returns
+        -------
+
+        `~reducer.planning.Plan`
+            The images combined for each group, and estimates of the I/O,
+            memory and time needed. Groups are combined one after the
+            other, so the peak memory is that of the largest group.
+        """
+        rates = dict(DEFAULT_RATES, **(rates or {}))
+        self.image_source.refresh()
+        clipping = (self._clipping_widget.min_max or
+                    self._clipping_widget.sigma_clip)
+        scaled = bool(self._combine_method.scaling_func)
+        memory_factor = 1.3 * (3 if self._combine_method.method == 'Median'
+                               else 2)
+
+        all_files = []
+        groups = []
+        problems = []
+        bytes_read = bytes_written = 0
+        runtime = 0.0
+        peak_memory = 0
+        for group in self._group_by.groups(self.apply_to):
+            selector = self.apply_to.copy()
+            selector.update(group)
+            files = [str(f) for f in
+                     self.image_source.files_filtered(**selector)]
+            groups.append((group, files))
+            all_files.extend(files)
+            if not files:
+                problems.append("No images to combine for "
+                                "{}".format(selector))
+                continue
+
+            name_addons = ['_'.join([str(k), str(v)])
+                           for k, v in group.items()]
+            fname = '_'.join([self._file_base_name] + name_addons) + '.fit'
+            destination = os.path.join(self.destination, fname)
+            if os.path.exists(destination):
+                problems.append("{} already exists".format(destination))
+
+            paths = [os.path.join(self.image_source.location, f)
+                     for f in files]
+            shape, dtype, header = image_geometry(paths[0])
+            n_pixels = int(np.prod(shape))
+            n_images = len(files)
+            input_bytes = sum(os.path.getsize(path) for path in paths)
+
+            if self._dark_model:
+                # Offset and rate are accumulated while the darks are read
+                # one at a time, and written as float32 unless another
+                # encoding is chosen.
+                reads = input_bytes
+                memory = 3 * 8 * n_pixels + n_pixels * dtype.itemsize
+                output_dtype = np.dtype(self._output_encoding or 'float32')
+                output_bytes = 2 * (n_pixels * output_dtype.itemsize +
+                                    header_bytes(header))
+                work_rate = rates['dark_model']
+            elif self._lean and not clipping:
+                reads = input_bytes * (2 if scaled else 1)
+                memory = (min(DEFAULT_MEMORY_LIMIT, 8 * n_images * n_pixels) +
+                          8 * n_pixels + n_pixels * dtype.itemsize)
+                output_bytes = None
+                work_rate = rates['combine']
+            else:
+                # ccdproc.combine holds data, uncertainty and mask, and
+                # reads every image again for each chunk it splits them
+                # into to stay under its memory limit.
+                image_bytes = (8 + 8 + 1) * n_pixels
+                n_chunks = int(memory_factor * image_bytes * n_images /
+                               DEFAULT_MEMORY_LIMIT) + 1
+                reads = input_bytes * (n_chunks + (1 if scaled else 0))
+                memory = (min(memory_factor * image_bytes * n_images,
+                              DEFAULT_MEMORY_LIMIT) + image_bytes)
+                output_bytes = None
+                work_rate = rates['combine']
+            if output_bytes is None:
+                output_dtype = np.dtype(self._output_encoding or dtype)
+                output_bytes = (n_pixels * output_dtype.itemsize +
+                                header_bytes(header, extra_cards=8))
+
+            bytes_read += reads
+            bytes_written += output_bytes
+            runtime += (reads / rates['read'] + output_bytes / rates['write'] +
+                        n_images * n_pixels / work_rate)
+            peak_memory = max(peak_memory, int(memory))
+
+        return Plan(files=all_files, masters={}, groups=groups,
+                    bytes_read=int(bytes_read), bytes_written=bytes_written,
+                    peak_memory=peak_memory, runtime=runtime,
+                    problems=problems)
+
+    def combine_group(self, group):
+        """
+        Combine one group of images and write the result, without
+        refreshing the image source first.
+
+        Parameters
+        ----------
+
+        group : dict
+            Values of the `group_keywords` of the images to combine, as
+            returned by the ``groups`` of the group settings; an empty
+            dictionary selects every image.
+        """
+        self._combine_groups([group])
+        self._outputs_done()
+
+    def _register_output(self, path, header):
+        super(Combiner, self)._register_output(path, header)
+        ccd = self._sidecar_sources.pop(path, None)
+        if self._master_sidecars and not header.get(DARK_MODEL_KEYWORD,
+                                                    False):
+            try:
+                write_sidecar(path, ccd)
+            except (OSError, ValueError):
+                # The directory may not be writable, or the master may not
+                # be readable as a CCDData; that only costs speed when the
+                # master is used.
+                pass
+
+    def _sidecar_source(self, combined):
+        """
+        The combined image, to make its sidecar from, or ``None`` if it is
+        not written losslessly and so differs from the master read back.
+        """
+        if (self._dark_model or self._output_encoding is not None or
+                (self._compression and
+                 not self._compression.startswith('GZIP'))):
+            return None
+        return combined
+
+    def _combine_groups(self, groups_to_combine, writer=None):
         n_groups = len(groups_to_combine)
         for idx, combo_group in enumerate(groups_to_combine):
             self.progress_bar.description = \
@@ -502,10 +1314,25 @@ class Combiner(ReducerBase):
             fname.extend(name_addons)
             fname = '_'.join(fname) + '.fit'
             dest_path = os.path.join(self.destination, fname)
-            combined.write(dest_path)
+            if self._dark_model:
+                hdu_list = combined.to_hdulist()
+            else:
+                hdu_list = combined.to_hdu()
+            if self._output_encoding is not None:
+                # The offset and rate of a dark model are both images; the
+                # extensions of a combined image are its mask and
+                # uncertainty, which are left as they are.
+                images = hdu_list if self._dark_model else hdu_list[:1]
+                for hdu in images:
+                    encode_hdu(hdu, self._output_encoding)
+            hdu_list = self._output_hdulist(hdu_list)
+            if self._master_sidecars:
+                source = self._sidecar_source(combined)
+                if source is not None:
+                    self._sidecar_sources[dest_path] = source
+            self._write_output(hdu_list, dest_path, hdu_list[0].header,
+                               writer=writer)
             self._combined = combined
-        self.progress_bar.visible = False
-        self.progress_bar.layout.display = 'none'
 
     def _action_for_one_group(self, filter_dict=None):
         combined_dict = self.apply_to.copy()
@@ -515,6 +1342,12 @@ class Combiner(ReducerBase):
         file_list = [os.path.join(self.image_source.location, f) for f in
                      self.image_source.files_filtered(**combined_dict)]
 
+        if self._dark_model:
+            model = DarkModel.fit(file_list,
+                                  exposure_keyword=self._exposure_time_keyword)
+            model.header['master'] = True
+            return model
+
         combine_keyword_args = {
             'minmax_clip': self._clipping_widget.min_max,
             'sigma_clip': self._clipping_widget.sigma_clip,
@@ -543,14 +1376,35 @@ class Combiner(ReducerBase):
         if self._combine_method.scaling_func:
             combine_keyword_args['scale'] = self._combine_method.scaling_func
 
-        combined = ccdproc.combine(file_list,
-                                   mem_limit=DEFAULT_MEMORY_LIMIT,
-                                   **combine_keyword_args)
+        # Images written tile compressed are in the first extension.
+        with fits.open(file_list[0]) as hdulist:
+            image_index = image_hdu_index(hdulist)
+        read_args = {}
+        if image_index:
+            read_args['hdu'] = image_index
+        if self._lean:
+            read_args['hdu_mask'] = None
+            read_args['hdu_uncertainty'] = None
+
+        sample_image = read_ccd(file_list[0], **read_args)
+        clipping = (combine_keyword_args['minmax_clip'] or
+                    combine_keyword_args['sigma_clip'])
+        if self._lean and not clipping:
+            data = _lean_combine(file_list, combine_keyword_args['method'],
+                                 scale=combine_keyword_args.get('scale'),
+                                 hdu=image_index,
+                                 mem_limit=DEFAULT_MEMORY_LIMIT)
+            combined = ccdproc.CCDData(data, unit=sample_image.unit)
+        else:
+            combine_keyword_args.update(read_args)
+            combined = ccdproc.combine(file_list,
+                                       mem_limit=DEFAULT_MEMORY_LIMIT,
+                                       **combine_keyword_args)
 
-        sample_image = ccdproc.CCDData.read(file_list[0])
         combined.header = sample_image.header
         combined.header['master'] = True
-        if combined.data.dtype != sample_image.dtype:
+        if (self._output_encoding is None and
+                combined.data.dtype != sample_image.dtype):
             combined.data = np.array(combined.data, dtype=sample_image.dtype)
         try:
             if isinstance(combined.uncertainty.array, np.ma.masked_array):
@@ -559,28 +1413,123 @@ class Combiner(ReducerBase):
             pass
 
         # Do not keep the mask or uncertainty if the data has neither
-        if sample_image.mask is None and sample_image.uncertainty is None:
+        if self._lean or (sample_image.mask is None and
+                          sample_image.uncertainty is None):
             combined.mask = None
             combined.uncertainty = None
         return combined
 
 
+def _lean_combine(file_list, method, scale=None, hdu=0,
+                  mem_limit=DEFAULT_MEMORY_LIMIT):
+    """
+    Average or median combine images without the masked arrays, mask and
+    uncertainty that `ccdproc.combine` always builds.
+
+    As in `ccdproc.combine`, pixels that are NaN in some images are combined
+    from the rest, and ``scale``, if given, is called with the data of each
+    image to get the factor the image is multiplied by. The images are
+    combined a band of rows at a time so that the stack of all of them stays
+    under ``mem_limit`` bytes.
+
+    Returns
+    -------
+
+    `numpy.ndarray`
+        The combined image, as float64.
+    """
+    combine = np.nanmedian if method == 'median' else np.nanmean
+    if scale is not None:
+        scales = []
+        for path in file_list:
+            with fits.open(path) as hdulist:
+                scales.append(scale(hdulist[hdu].data))
+        scales = np.array(scales, dtype='float64')[:, np.newaxis, np.newaxis]
+
+    with fits.open(file_list[0]) as hdulist:
+        shape = hdulist[hdu].shape
+    n_rows = int(mem_limit // (8 * shape[1] * len(file_list))) or 1
+    stack = np.empty((len(file_list), min(n_rows, shape[0]), shape[1]))
+    combined = np.empty(shape)
+    for start in range(0, shape[0], n_rows):
+        stop = min(start + n_rows, shape[0])
+        band = stack[:, :stop - start]
+        for idx, path in enumerate(file_list):
+            with fits.open(path) as hdulist:
+                band[idx] = hdulist[hdu].section[start:stop]
+        if scale is not None:
+            band *= scales
+        combined[start:stop] = combine(band, axis=0)
+    return combined
+
+
 class CosmicRaySettings(gui.ToggleContainer):
+    """
+    Controls and action for finding and replacing cosmic rays.
+
+    Images are cleaned in overlapping tiles, in parallel, by
+    `~reducer.cosmic_ray.cosmicray_clean`; cosmic rays are added to the mask
+    of the image.
+
+    Parameters
+    ----------
+
+    n_threads : int, optional
+        Number of tiles cleaned at the same time; defaults to the number of
+        CPUs.
+    """
     def __init__(self, *args, **kwd):
         descript = kwd.pop('description', 'Clean cosmic rays?')
+        self._n_threads = kwd.pop('n_threads', None)
         kwd['description'] = descript
         super(CosmicRaySettings, self).__init__(*args, **kwd)
-        cr_choices = override_str_factory(
-            widgets.Dropdown(description='Method:',
-                             options=['median [not connected yet]',
-                                      'LACosmic [coming soon]'])
+        methods = OrderedDict()
+        methods['median'] = 'median'
+        methods['LACosmic'] = 'lacosmic'
+        self._method = override_str_factory(
+            widgets.Dropdown(description='Method:', options=methods,
+                             value='median')
         )
-        self.add_child(cr_choices)
+        self._max_iter = override_str_factory(
+            widgets.BoundedIntText(description='Max passes:',
+                                   value=DEFAULT_MAX_ITER, min=1, max=20)
+        )
+        self.add_child(self._method)
+        self.add_child(self._max_iter)
+
+    @property
+    def method(self):
+        """
+        Method used to find cosmic rays, one of
+        `~reducer.cosmic_ray.COSMIC_RAY_METHODS`.
+        """
+        return self._method.value
+
+    @property
+    def max_iter(self):
+        """
+        Largest number of passes made over each tile of an image.
+        """
+        return self._max_iter.value
 
     def display(self):
         from IPython.display import display
         display(self)
 
+    def action(self, ccd):
+        """
+        Clean cosmic rays from an image.
+
+        Parameters
+        ----------
+
+        ccd : `ccdproc.CCDData`
+            Image to be cleaned.
+        """
+        return cosmicray_clean(ccd, method=self.method,
+                               max_iter=self.max_iter,
+                               n_threads=self._n_threads)
+
 
 class AxisSelection(widgets.Box):
     """docstring for AxisSelection"""
@@ -715,16 +1664,22 @@ class CalibrationStep(gui.ToggleContainer):
     Parameters
     ----------
 
-    None
+    shared_masters : dict, optional
+        `~reducer.shared_masters.SharedMaster` handles, by path, of masters
+        published in shared memory; these masters are mapped rather than
+        read from disk.
     """
     def __init__(self, *args, **kwd):
         self._master_source = kwd.pop('master_source', None)
         self._imagetype_map = kwd.pop('imagetype_map', DEFAULT_IMAGETYPE_MAP)
+        self._lean = kwd.pop('lean', False)
+        self._shared_masters = kwd.pop('shared_masters', None) or {}
         super(CalibrationStep, self).__init__(*args, **kwd)
         self._settings = MasterImageSource()
         # self.add_child(self._settings)
 
         self._image_cache = {}
+        self._cache_lock = threading.Lock()
         self._match_on = []
 
     @property
@@ -739,25 +1694,73 @@ class CalibrationStep(gui.ToggleContainer):
     def match_on(self, value):
         self._match_on = value
 
+    @property
+    def lean(self):
+        """
+        If ``True``, masters are read without their mask and uncertainty.
+        """
+        return self._lean
+
+    @lean.setter
+    def lean(self, value):
+        if value != self._lean:
+            self._image_cache.clear()
+        self._lean = value
+
+    @property
+    def shared_masters(self):
+        """
+        Handles, by path, of masters to map from shared memory instead of
+        reading.
+        """
+        return self._shared_masters
+
+    @shared_masters.setter
+    def shared_masters(self, value):
+        self._shared_masters = value or {}
+        self._image_cache.clear()
+
     @property
     def imagetype_map(self):
         return self._imagetype_map
 
-    def _master_image(self, selector, closest=None):
+    def _selector(self, header):
         """
-        Identify appropriate master and return as `ccdproc.CCDData`.
+        The selector and, if any, the keyword whose value need only be
+        closest, of the master for an image with this header.
+        """
+        raise NotImplementedError
+
+    def master_file(self, header):
+        """
+        Name of the master this step uses for an image, found without
+        reading any master.
 
         Parameters
         ----------
 
-        selector : dict-like
-            Dictionary of key/value pairs that uniquely select the appropriate
-            master image.
+        header : `astropy.io.fits.Header` or dict-like
+            Header of the image to calibrate.
 
-        closest : str, optional
-            Name of keyword from ``selector`` whose value needs only be
-            closest to the value in the dictionary instead of being an
-            exact match.
+        Returns
+        -------
+
+        str
+            Name of the master, relative to the location of the master
+            source.
+
+        Raises
+        ------
+
+        RuntimeError
+            If there is no master source or no single master matches.
+        """
+        selector, closest = self._selector(header)
+        return self._master_file(selector, closest=closest)
+
+    def _master_file(self, selector, closest=None):
+        """
+        Name of the master selected by ``selector``; see `_master_image`.
         """
         if not self._master_source:
             raise RuntimeError("No source provided for master.")
@@ -770,32 +1773,71 @@ class CalibrationStep(gui.ToggleContainer):
         elif len(file_name) == 0:
             if closest is None:
                 raise RuntimeError("No master found for {}".format(selector))
-            else:
-                new_select = selector.copy()
-                del new_select[closest]
-                file_name = self._master_source.files_filtered(master=True,
-                                                               **new_select)
-                master_table = self._master_source.summary
-                min_dist = 1e20
-                for name in file_name:
-                    match = master_table['file'] == name
-                    distance = abs(master_table[closest][match] -
-                                   selector[closest])
-                    if distance <= min_dist:
-                        best_match = name
-                        min_dist = distance
-                file_name = [best_match]
-        file_name = file_name[0]
+            new_select = selector.copy()
+            del new_select[closest]
+            file_name = self._master_source.files_filtered(master=True,
+                                                           **new_select)
+            if len(file_name) == 0:
+                raise RuntimeError("No master found for "
+                                   "{}".format(new_select))
+            master_table = self._master_source.summary
+            min_dist = 1e20
+            for name in file_name:
+                match = master_table['file'] == name
+                distance = abs(master_table[closest][match] -
+                               selector[closest])
+                if distance <= min_dist:
+                    best_match = name
+                    min_dist = distance
+            file_name = [best_match]
+        return str(file_name[0])
+
+    def _master_image(self, selector, closest=None, read=None):
+        """
+        Identify appropriate master and return as `ccdproc.CCDData`.
+
+        Parameters
+        ----------
+
+        selector : dict-like
+            Dictionary of key/value pairs that uniquely select the appropriate
+            master image.
+
+        closest : str, optional
+            Name of keyword from ``selector`` whose value needs only be
+            closest to the value in the dictionary instead of being an
+            exact match.
+
+        read : callable, optional
+            Called with the path of the master to read it, instead of
+            reading it as a `ccdproc.CCDData`.
+        """
+        file_name = self._master_file(selector, closest=closest)
         path = os.path.join(self._master_source.location, file_name)
-        try:
-            return self._image_cache[path]
-        except KeyError:
-            # Try getting the unit form the FITS file, but force it to ADU
+        # Held while a master is read, so files reduced at the same time on
+        # several threads read each master once.
+        with self._cache_lock:
             try:
-                self._image_cache[path] = ccdproc.CCDData.read(path)
+                return self._image_cache[path]
+            except KeyError:
+                pass
+            if read is not None:
+                self._image_cache[path] = read(path)
+                return self._image_cache[path]
+            if path in self._shared_masters:
+                self._image_cache[path] = self._shared_masters[path].attach()
+                return self._image_cache[path]
+            read_args = {}
+            if self._lean:
+                read_args['hdu_mask'] = None
+                read_args['hdu_uncertainty'] = None
+            # Try getting the unit form the FITS file, but force it to ADU.
+            # Masters are mapped from their sidecar when it is up to date.
+            try:
+                self._image_cache[path] = read_master(path, **read_args)
             except ValueError:
                 self._image_cache[path] = \
-                    ccdproc.CCDData.read(path, unit=DEFAULT_IMAGE_UNIT)
+                    read_master(path, unit=DEFAULT_IMAGE_UNIT, **read_args)
             return self._image_cache[path]
 
 
@@ -823,9 +1865,11 @@ class BiasSubtract(CalibrationStep):
         kwd['description'] = desc
         super(BiasSubtract, self).__init__(**kwd)
 
+    def _selector(self, header):
+        return {'imagetyp': self.imagetype_map['bias']}, None
+
     def action(self, ccd):
-        select_dict = {'imagetyp': self.imagetype_map['bias']}
-        master = self._master_image(select_dict)
+        master = self._master_image(*self._selector(ccd.header))
         return ccdproc.subtract_bias(ccd, master)
 
 
@@ -851,37 +1895,89 @@ class DarkScaleSetting(widgets.Box):
         return str(self._scale)
 
 
+class DarkModelSetting(widgets.Box):
+    """
+    Choice of synthesizing darks from a dark model rather than using master
+    darks.
+    """
+    def __init__(self, *arg, **kwd):
+        use_model = kwd.pop('use_model', False)
+        super(DarkModelSetting, self).__init__(*arg, **kwd)
+        value_dict = [('Yes', True), ('No', False)]
+        self._use_model = override_str_factory(
+            widgets.ToggleButtons(
+                description='Synthesize dark from dark model',
+                options=value_dict,
+                value=use_model))
+        self.children = [self._use_model]
+
+    @property
+    def use_model(self):
+        return self._use_model.value
+
+    def __str__(self):
+        return str(self._use_model)
+
+
 class DarkSubtract(CalibrationStep):
     """
     Subtract dark from an image using widget settings.
+
+    Parameters
+    ----------
+
+    use_dark_model : bool, optional
+        Initial setting of the option to synthesize the dark for each image
+        from the `~reducer.calibration.DarkModel` among the masters, made by
+        a `Combiner` with ``dark_model=True``, instead of using a master
+        dark of the same, or closest, exposure time.
     """
     def __init__(self, bias_image=None, **kwd):
         desc = kwd.pop('description', 'Subtract Dark?')
         self.exposure_keyword = kwd.pop('exposure_keyword', 'exposure')
+        use_model = kwd.pop('use_dark_model', False)
         kwd['description'] = desc
         super(DarkSubtract, self).__init__(**kwd)
         self.match_on = [self.exposure_keyword]
         self._scale = DarkScaleSetting()
+        self._model = DarkModelSetting(use_model=use_model)
         self.add_child(self._scale)
+        self.add_child(self._model)
 
-    def action(self, ccd):
-        from astropy import units as u
+    def _selector(self, header):
+        if self._model.use_model:
+            return {'imagetyp': self.imagetype_map['dark'],
+                    DARK_MODEL_KEYWORD.lower(): True}, None
         select_dict = {'imagetyp': self.imagetype_map['dark']}
         for keyword in self.match_on:
             if keyword in select_dict:
                 raise ValueError("Keyword {} already has a value set".format(keyword))
-            select_dict[keyword] = ccd.header[keyword]
-        if self._scale.scale:
-            master = self._master_image(select_dict, closest=self.match_on[0])
-            if not 'subbias' in master.meta:
-                raise RuntimeError("Bias has not been subtracted from dark, "
-                                   "so cannot scale dark")
-        else:
-            master = self._master_image(select_dict)
-        return ccdproc.subtract_dark(ccd, master,
-                                     exposure_time=self.exposure_keyword,
-                                     exposure_unit=u.second,
-                                     scale=self._scale.scale)
+            select_dict[keyword] = header[keyword]
+        closest = self.match_on[0] if self._scale.scale else None
+        return select_dict, closest
+
+    def action(self, ccd):
+        selector, closest = self._selector(ccd.header)
+        if self._model.use_model:
+            model = self._master_image(selector, read=DarkModel.read)
+            # The model caches the darks it synthesizes, so images of the
+            # same exposure time share one.
+            master = model.dark(ccd.header[self.exposure_keyword])
+            return subtract_dark(ccd, master,
+                                 exposure_time=self.exposure_keyword,
+                                 exposure_unit=u.second, inplace=True)
+
+        master = self._master_image(selector, closest=closest)
+        if self._scale.scale and not 'subbias' in master.meta:
+            raise RuntimeError("Bias has not been subtracted from dark, "
+                               "so cannot scale dark")
+        # Scaled darks are cached for each master and exposure time, and the
+        # dark is subtracted in place when the data of ccd allow it; the
+        # input is never changed since reduce_hdu makes it read-only.
+        return subtract_dark(ccd, master,
+                             exposure_time=self.exposure_keyword,
+                             exposure_unit=u.second,
+                             scale=self._scale.scale, inplace=True)
 
 
 class FlatCorrect(CalibrationStep):
@@ -894,14 +1990,19 @@ class FlatCorrect(CalibrationStep):
         super(FlatCorrect, self).__init__(**kwd)
         self.match_on = ['filter']
 
-    def action(self, ccd):
+    def _selector(self, header):
         select_dict = {'imagetyp': self.imagetype_map['flat']}
         for keyword in self.match_on:
             if keyword in select_dict:
                 raise ValueError("Keyword {} already has a value set".format(keyword))
-            select_dict[keyword] = ccd.header[keyword]
-        master = self._master_image(select_dict)
-        return ccdproc.flat_correct(ccd, master)
+            select_dict[keyword] = header[keyword]
+        return select_dict, None
+
+    def action(self, ccd):
+        master = self._master_image(*self._selector(ccd.header))
+        # The normalized reciprocal of each master is cached, so each image
+        # costs one multiplication, in place when the data of ccd allow it.
+        return flat_correct(ccd, master, inplace=True)
 
 
 class PolynomialDropdown(widgets.Dropdown):
@@ -987,10 +2088,12 @@ class Overscan(Slice):
         else:
             poly_model = None
 
-        reduced = ccdproc.subtract_overscan(ccd,
-                                            overscan=ccd[first_axis, second_axis],
-                                            overscan_axis=oscan_axis,
-                                            model=poly_model)
+        # Same result and metadata as ccdproc.subtract_overscan, but the
+        # polynomial is fit against a cached pseudo-inverse.
+        reduced = subtract_overscan(ccd,
+                                    overscan=ccd[first_axis, second_axis],
+                                    overscan_axis=oscan_axis,
+                                    model=poly_model)
         return reduced
 
 
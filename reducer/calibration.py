@@ -0,0 +1,684 @@
+from collections import OrderedDict
+from functools import lru_cache
+import threading
+import weakref
+
+import numpy as np
+
+import ccdproc
+from astropy import units as u
+from astropy.io import fits
+from astropy.modeling import models
+from ccdproc.log_meta import log_to_metadata
+
+from .fits_io import image_hdu_index
+
+__all__ = [
+    'DarkModel',
+    'fit_overscan',
+    'flat_correct',
+    'overscan_fit_matrices',
+    'subtract_dark',
+    'subtract_overscan',
+    'subtract_overscan_batch',
+]
+
+# Number of (length, order) pairs whose overscan fit matrices are kept.
+OVERSCAN_CACHE_SIZE = 32
+
+# Number of exposure times for which scaled copies of each master dark are
+# kept.
+SCALED_DARK_CACHE_SIZE = 8
+
+# Scaled copies of master darks, by master and then by scale factor. The
+# masters are held weakly, so their scaled copies go away with them.
+_scaled_darks = weakref.WeakKeyDictionary()
+
+# Normalized reciprocal of each master flat, with the arguments it was
+# computed for, held like the scaled darks.
+_inverse_flats = weakref.WeakKeyDictionary()
+
+# Keyword set in the header of a dark model to tell it apart from master
+# darks of a single exposure time.
+DARK_MODEL_KEYWORD = 'DARKMODL'
+
+# Number of exposure times for which darks synthesized from a dark model
+# are kept.
+SYNTHESIZED_DARK_CACHE_SIZE = 8
+_cache_lock = threading.Lock()
+
+
+@lru_cache(maxsize=OVERSCAN_CACHE_SIZE)
+def overscan_fit_matrices(length, order):
+    """
+    Design matrix and its pseudo-inverse for a least-squares polynomial fit
+    to an overscan profile.
+
+    The polynomial is in a coordinate that runs from -1 to 1 along the
+    profile, which keeps the problem well conditioned for long profiles;
+    the fitted values are the same as those of a fit in pixel coordinates.
+    The matrices are cached, so they are computed once for each profile
+    length and order.
+
+    Parameters
+    ----------
+
+    length : int
+        Number of points in the profile.
+
+    order : int
+        Degree of the polynomial.
+
+    Returns
+    -------
+
+    design : `numpy.ndarray`
+        Array of shape ``(length, order + 1)``.
+
+    pinv : `numpy.ndarray`
+        Array of shape ``(order + 1, length)``; ``pinv @ profile`` gives the
+        coefficients of the fit.
+    """
+    if length > 1:
+        x = np.linspace(-1, 1, length)
+    else:
+        x = np.zeros(length)
+    design = np.vander(x, order + 1, increasing=True)
+    pinv = np.linalg.pinv(design)
+    design.flags.writeable = False
+    pinv.flags.writeable = False
+    return design, pinv
+
+
+def fit_overscan(profiles, order):
+    """
+    Least-squares polynomial fit to one or more overscan profiles.
+
+    Parameters
+    ----------
+
+    profiles : array-like
+        Profile(s) to fit, along the last axis; any leading axes are a
+        batch of profiles fit at once.
+
+    order : int
+        Degree of the polynomial.
+
+    Returns
+    -------
+
+    `numpy.ndarray`
+        The fits evaluated at each point of each profile, with the same
+        shape as ``profiles``.
+    """
+    profiles = np.asarray(profiles, dtype='float64')
+    design, pinv = overscan_fit_matrices(profiles.shape[-1], order)
+    return (profiles @ pinv.T) @ design.T
+
+
+def subtract_overscan_batch(data, overscan, overscan_axis=1, order=None):
+    """
+    Subtract the overscan from one image or a stack of images.
+
+    Parameters
+    ----------
+
+    data : array-like
+        Image of shape ``(ny, nx)`` or stack of images of shape
+        ``(n, ny, nx)``.
+
+    overscan : tuple of slice
+        Region of each image holding the overscan, as ``(rows, columns)``.
+
+    overscan_axis : 0 or 1, optional
+        Axis of the image along which the overscan is averaged; the profile
+        runs along the other axis.
+
+    order : int, optional
+        Degree of the polynomial fit to the profile. If ``None`` the
+        averaged profile is subtracted without fitting.
+
+    Returns
+    -------
+
+    `numpy.ndarray`
+        The images with the overscan subtracted, as float64.
+    """
+    data = np.asarray(data)
+    region = data[(Ellipsis,) + tuple(overscan)]
+    axis = overscan_axis - 2
+    profiles = np.mean(region, axis=axis)
+    if order is not None:
+        profiles = fit_overscan(profiles, order)
+    return data - np.expand_dims(profiles, axis)
+
+
+@log_to_metadata
+def subtract_overscan(ccd, overscan=None, overscan_axis=1, model=None):
+    """
+    Drop-in replacement for `ccdproc.subtract_overscan`, called the same
+    way and giving the same result, including the metadata it adds, but
+    fitting a polynomial model against a cached pseudo-inverse instead of
+    through an astropy fitter.
+
+    Only the mean of the overscan is supported; models other than
+    `~astropy.modeling.models.Polynomial1D` are handed to
+    `ccdproc.subtract_overscan`.
+
+    Parameters
+    ----------
+
+    ccd : `~ccdproc.CCDData`
+        Image to subtract the overscan from.
+
+    overscan : `~ccdproc.CCDData`
+        Slice of ``ccd`` holding the overscan.
+
+    overscan_axis : 0 or 1, optional
+        Axis along which the overscan is averaged.
+
+    model : `~astropy.modeling.models.Polynomial1D`, optional
+        Model fit to the averaged overscan.
+
+    {log}
+
+    Returns
+    -------
+
+    `~ccdproc.CCDData`
+    """
+    if model is not None and not isinstance(model, models.Polynomial1D):
+        return ccdproc.subtract_overscan(ccd, overscan=overscan,
+                                         overscan_axis=overscan_axis,
+                                         model=model, add_keyword=False)
+    profile = np.mean(overscan.data, axis=overscan_axis)
+    if model is not None:
+        profile = fit_overscan(profile, model.degree)
+    subtracted = ccd.copy()
+    subtracted.data = ccd.data - np.expand_dims(profile, overscan_axis)
+    return subtracted
+
+
+def _combined_mask(ccd, master):
+    """
+    Mask of the result of arithmetic between ``ccd`` and ``master``.
+    """
+    if ccd.mask is None:
+        return None if master.mask is None else master.mask.copy()
+    if master.mask is None:
+        return ccd.mask.copy()
+    return ccd.mask | master.mask
+
+
+def _writable_result(data, other):
+    """
+    Whether the result of arithmetic between arrays ``data`` and ``other``
+    can be put in ``data``: it must be writeable and of the type the result
+    would have anyway.
+    """
+    return (isinstance(data, np.ndarray) and data.flags.writeable and
+            np.result_type(data, other) == data.dtype)
+
+
+def _subtract_master(ccd, master, inplace=False):
+    """
+    ``ccd - master``, as computed by `ccdproc.subtract_dark`, but done in
+    the data array of ``ccd`` if ``inplace`` and neither image has an
+    uncertainty to propagate.
+    """
+    try:
+        if (not inplace or ccd.uncertainty is not None or
+                master.uncertainty is not None or ccd.unit != master.unit or
+                not _writable_result(ccd.data, master.data)):
+            result = ccd.subtract(master)
+        else:
+            data = ccd.data
+            data -= master.data
+            result = ccdproc.CCDData(data, unit=ccd.unit,
+                                     mask=_combined_mask(ccd, master),
+                                     wcs=ccd.wcs)
+    except (u.UnitsError, u.UnitConversionError, ValueError) as err:
+        raise u.UnitsError(
+            "Unit '{}' of the uncalibrated image does not match unit '{}' "
+            "of the calibration image".format(ccd.unit, master.unit)
+        ) from err
+    result.meta = ccd.meta.copy()
+    return result
+
+
+def _scaled_dark(master, factor):
+    """
+    ``master`` multiplied by ``factor``, from the cache if it has been
+    computed before.
+    """
+    key = float(factor.to_value(u.dimensionless_unscaled))
+    with _cache_lock:
+        scaled = _scaled_darks.setdefault(master, OrderedDict())
+        try:
+            scaled.move_to_end(key)
+            return scaled[key]
+        except KeyError:
+            pass
+    # Scale outside the lock; at worst two threads scale the same dark.
+    result = master.multiply(factor)
+    with _cache_lock:
+        scaled = _scaled_darks.setdefault(master, OrderedDict())
+        scaled[key] = result
+        while len(scaled) > SCALED_DARK_CACHE_SIZE:
+            scaled.popitem(last=False)
+    return result
+
+
+@log_to_metadata
+def subtract_dark(ccd, master, dark_exposure=None, data_exposure=None,
+                  exposure_time=None, exposure_unit=None, scale=False,
+                  inplace=False):
+    """
+    Drop-in replacement for `ccdproc.subtract_dark`, called the same way
+    and giving the same result, including the metadata it adds, but faster
+    when many images are calibrated with the same master:
+
+    + When ``scale`` is ``True`` the master scaled to the exposure time of
+      ``ccd`` is cached, for up to `SCALED_DARK_CACHE_SIZE` exposure times
+      per master, so it is computed once rather than for every image.
+    + With ``inplace``, the dark can be subtracted in the data array of
+      ``ccd`` instead of a new one.
+
+    Parameters
+    ----------
+
+    ccd : `~ccdproc.CCDData`
+        Image from which dark will be subtracted.
+
+    master : `~ccdproc.CCDData`
+        Dark image; it must not be modified while it is in use, since its
+        scaled copies are cached.
+
+    dark_exposure : `~astropy.units.Quantity`, optional
+        Exposure time of the dark image.
+
+    data_exposure : `~astropy.units.Quantity`, optional
+        Exposure time of ``ccd``.
+
+    exposure_time : str or `~ccdproc.Keyword`, optional
+        Name of the keyword in the metadata of both images that holds the
+        exposure time, used instead of ``dark_exposure`` and
+        ``data_exposure``.
+
+    exposure_unit : `~astropy.units.Unit`, optional
+        Unit of the exposure time read from the metadata.
+
+    scale : bool, optional
+        If ``True``, scale the dark to the exposure time of ``ccd``.
+
+    inplace : bool, optional
+        If ``True``, subtract the dark in the data array of ``ccd`` when it
+        is writeable, of the type of the result and neither image has an
+        uncertainty; ``ccd`` must not be used afterwards. By default
+        ``ccd`` is left unchanged, as by `ccdproc.subtract_dark`.
+
+    {log}
+
+    Returns
+    -------
+
+    `~ccdproc.CCDData`
+    """
+    if not (isinstance(ccd, ccdproc.CCDData) and
+            isinstance(master, ccdproc.CCDData)):
+        raise TypeError("ccd and master must both be CCDData objects.")
+
+    if (data_exposure is not None and dark_exposure is not None and
+            exposure_time is not None):
+        raise TypeError("specify either exposure_time or "
+                        "(dark_exposure and data_exposure), not both.")
+
+    if data_exposure is None and dark_exposure is None:
+        if exposure_time is None:
+            raise TypeError("must specify either exposure_time or both "
+                            "dark_exposure and data_exposure.")
+        if isinstance(exposure_time, ccdproc.Keyword):
+            data_exposure = exposure_time.value_from(ccd.header)
+            dark_exposure = exposure_time.value_from(master.header)
+        else:
+            data_exposure = ccd.header[exposure_time]
+            dark_exposure = master.header[exposure_time]
+
+    if not (isinstance(dark_exposure, u.Quantity) and
+            isinstance(data_exposure, u.Quantity)):
+        if exposure_time:
+            try:
+                data_exposure *= exposure_unit
+                dark_exposure *= exposure_unit
+            except TypeError as err:
+                raise TypeError("must provide unit for exposure "
+                                "time.") from err
+        else:
+            raise TypeError("exposure times must be "
+                            "astropy.units.Quantity objects.")
+
+    if scale:
+        master = _scaled_dark(master, data_exposure / dark_exposure)
+    return _subtract_master(ccd, master, inplace=inplace)
+
+
+def _inverse_flat(flat, min_value, norm_value, dtype='float64'):
+    """
+    Reciprocal of ``flat`` normalized as `ccdproc.flat_correct` does, of
+    type ``dtype``, and the unit of the normalized flat, from the cache if
+    the same flat has been used with the same ``min_value`` and
+    ``norm_value`` before.
+    """
+    dtype = np.dtype(dtype)
+    key = (min_value, None if norm_value is None else str(norm_value))
+    with _cache_lock:
+        cached = _inverse_flats.get(flat)
+    if cached is not None and cached[0] == key:
+        inverses, normed_unit = cached[1]
+        if dtype in inverses:
+            return inverses[dtype], normed_unit
+        inverse = inverses[np.dtype('float64')].astype(dtype)
+        inverse.flags.writeable = False
+        with _cache_lock:
+            inverses[dtype] = inverse
+        return inverse, normed_unit
+
+    data = flat.data
+    if min_value is not None:
+        data = np.maximum(data, min_value)
+    if norm_value is not None:
+        if norm_value <= 0:
+            raise ValueError("norm_value must be greater than zero.")
+        flat_mean = (norm_value if hasattr(norm_value, 'unit') else
+                     norm_value * flat.unit)
+    else:
+        flat_mean = data.mean() * flat.unit
+    normed_unit = flat.unit / flat_mean.unit
+    # Where the flat is zero the reciprocal is infinite, so, as with
+    # ccdproc, those pixels of the corrected image are infinite.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inverse = np.asarray(flat_mean.value / data, dtype='float64')
+    if flat.mask is not None:
+        # Masked pixels are divided by 1, as in ccdproc.
+        inverse[flat.mask] = 1.0
+    inverse.flags.writeable = False
+    inverses = {inverse.dtype: inverse}
+    if dtype not in inverses:
+        inverses[dtype] = inverse.astype(dtype)
+        inverses[dtype].flags.writeable = False
+    with _cache_lock:
+        _inverse_flats[flat] = (key, (inverses, normed_unit))
+    return inverses[dtype], normed_unit
+
+
+@log_to_metadata
+def flat_correct(ccd, flat, min_value=None, norm_value=None, inplace=False):
+    """
+    Drop-in replacement for `ccdproc.flat_correct`, called the same way and
+    adding the same metadata, but faster when many images are corrected
+    with the same flat.
+
+    The reciprocal of the normalized flat is computed once per flat and
+    cached, so correcting an image is a single multiplication, done in the
+    data array of ``ccd`` with ``inplace``. Results agree with
+    `ccdproc.flat_correct` to rounding, including the infinite pixels
+    where the flat is zero, except that single precision images stay
+    single precision: they are multiplied by a single precision copy of
+    the reciprocal, also cached, instead of becoming double precision.
+
+    Images with an uncertainty, or corrected with a flat that has one, are
+    handed to `ccdproc.flat_correct` so that the uncertainty is propagated.
+
+    Parameters
+    ----------
+
+    ccd : `~ccdproc.CCDData`
+        Image to flat correct.
+
+    flat : `~ccdproc.CCDData`
+        Flat field; it must not be modified while it is in use, since its
+        normalized reciprocal is cached.
+
+    min_value : float, optional
+        Values of the flat below this are replaced by it before
+        normalizing.
+
+    norm_value : float or `~astropy.units.Quantity`, optional
+        If given, the flat is normalized by this instead of by its mean.
+
+    inplace : bool, optional
+        If ``True``, correct the data array of ``ccd`` itself when it is
+        writeable and of the type of the result; ``ccd`` must not be used
+        afterwards. By default ``ccd`` is left unchanged.
+
+    {log}
+
+    Returns
+    -------
+
+    `~ccdproc.CCDData`
+    """
+    if ccd.uncertainty is not None or flat.uncertainty is not None:
+        return ccdproc.flat_correct(ccd, flat, min_value=min_value,
+                                    norm_value=norm_value, add_keyword=False)
+    data = ccd.data
+    dtype = 'float32' if data.dtype == np.float32 else 'float64'
+    inverse, normed_unit = _inverse_flat(flat, min_value, norm_value,
+                                         dtype=dtype)
+    if inplace and _writable_result(data, inverse):
+        data *= inverse
+    else:
+        data = data * inverse
+    return ccdproc.CCDData(data, unit=ccd.unit / normed_unit,
+                           mask=_combined_mask(ccd, flat), wcs=ccd.wcs,
+                           meta=ccd.meta.copy())
+
+
+class DarkModel(object):
+    """
+    Model of the dark of every pixel as an offset plus a dark current
+    proportional to exposure time, from which a dark of any exposure time
+    can be synthesized.
+
+    Parameters
+    ----------
+
+    offset : `numpy.ndarray`
+        Dark of each pixel at zero exposure time; zero, apart from noise,
+        if the darks were bias subtracted.
+
+    rate : `numpy.ndarray`
+        Dark current of each pixel, per unit of exposure time.
+
+    header : `astropy.io.fits.Header`, optional
+        Header given to synthesized darks, which also get the exposure time.
+
+    unit : `astropy.units.Unit` or str, optional
+        Unit of the synthesized darks.
+
+    exposure_keyword : str, optional
+        Name of the keyword holding the exposure time.
+    """
+    def __init__(self, offset, rate, header=None, unit=u.adu,
+                 exposure_keyword='exposure'):
+        if offset.shape != rate.shape:
+            raise ValueError("offset and rate must have the same shape")
+        self._offset = offset
+        self._rate = rate
+        self._header = fits.Header() if header is None else header.copy()
+        self._header.remove(DARK_MODEL_KEYWORD, ignore_missing=True)
+        self._unit = u.Unit(unit)
+        self._exposure_keyword = exposure_keyword
+        self._darks = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def header(self):
+        """
+        Header given to synthesized darks; changes to it apply to darks
+        synthesized afterwards.
+        """
+        return self._header
+
+    @property
+    def offset(self):
+        return self._offset
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @property
+    def exposure_keyword(self):
+        return self._exposure_keyword
+
+    @classmethod
+    def fit(cls, darks, exposure_keyword='exposure'):
+        """
+        Fit the model to darks of at least two different exposure times.
+
+        The fit is an ordinary least-squares fit at each pixel, accumulated
+        one dark at a time, so only one dark is in memory at once. It is not
+        robust against outliers, so the darks should have been cleaned of
+        cosmic rays, or there should be enough of them at each exposure
+        time for the cosmic rays to average out.
+
+        Parameters
+        ----------
+
+        darks : list of str or `~ccdproc.CCDData`
+            Darks, or names of the files holding them, with their exposure
+            times in their headers.
+
+        exposure_keyword : str, optional
+            Name of the keyword holding the exposure time.
+
+        Returns
+        -------
+
+        `DarkModel`
+        """
+        headers = []
+        for dark in darks:
+            if isinstance(dark, ccdproc.CCDData):
+                headers.append(dark.header)
+            else:
+                with fits.open(dark) as hdulist:
+                    headers.append(hdulist[image_hdu_index(hdulist)].header)
+        exposures = np.array([header[exposure_keyword] for header in headers],
+                             dtype='float64')
+        if len(np.unique(exposures)) < 2:
+            raise ValueError("Fitting a dark model needs darks of at least "
+                             "two different exposure times")
+
+        design = np.stack([np.ones_like(exposures), exposures], axis=1)
+        weights = np.linalg.pinv(design)
+        offset = rate = None
+        unit = None
+        for dark, w_offset, w_rate in zip(darks, weights[0], weights[1]):
+            if isinstance(dark, ccdproc.CCDData):
+                data = dark.data
+                unit = unit or dark.unit
+            else:
+                with fits.open(dark) as hdulist:
+                    hdu = hdulist[image_hdu_index(hdulist)]
+                    data = hdu.data
+                    unit = unit or hdu.header.get('BUNIT')
+            if offset is None:
+                offset = np.zeros(data.shape)
+                rate = np.zeros(data.shape)
+            offset += w_offset * data
+            rate += w_rate * data
+
+        header = fits.Header(headers[0])
+        header.remove(exposure_keyword, ignore_missing=True)
+        return cls(offset, rate, header=header, unit=unit or u.adu,
+                   exposure_keyword=exposure_keyword)
+
+    def dark(self, exposure):
+        """
+        Dark of a given exposure time.
+
+        Darks are cached for the last `SYNTHESIZED_DARK_CACHE_SIZE` exposure
+        times asked for, so the same dark should not be modified.
+
+        Parameters
+        ----------
+
+        exposure : float
+            Exposure time, in the units of the darks the model was fit to.
+
+        Returns
+        -------
+
+        `~ccdproc.CCDData`
+        """
+        exposure = float(exposure)
+        with self._lock:
+            try:
+                self._darks.move_to_end(exposure)
+                return self._darks[exposure]
+            except KeyError:
+                pass
+        header = self._header.copy()
+        header[self._exposure_keyword] = exposure
+        dark = ccdproc.CCDData(self._offset + exposure * self._rate,
+                               unit=self._unit, meta=header)
+        with self._lock:
+            self._darks[exposure] = dark
+            while len(self._darks) > SYNTHESIZED_DARK_CACHE_SIZE:
+                self._darks.popitem(last=False)
+        return dark
+
+    def to_hdulist(self, dtype='float32'):
+        """
+        The model as FITS HDUs: the offset in the primary HDU, whose header
+        has `DARK_MODEL_KEYWORD` set, and the rate in an extension named
+        ``RATE``.
+
+        Parameters
+        ----------
+
+        dtype : str, optional
+            Type in which the offset and rate are stored.
+        """
+        header = self._header.copy()
+        header[DARK_MODEL_KEYWORD] = (True, 'Dark model: offset + rate * '
+                                            'exposure')
+        header['BUNIT'] = self._unit.to_string()
+        primary = fits.PrimaryHDU(data=self._offset.astype(dtype),
+                                  header=header)
+        rate = fits.ImageHDU(data=self._rate.astype(dtype), name='RATE')
+        rate.header['BUNIT'] = self._unit.to_string()
+        rate.header['EXPKEY'] = (self._exposure_keyword,
+                                 'Keyword holding the exposure time')
+        return fits.HDUList([primary, rate])
+
+    @classmethod
+    def read(cls, path):
+        """
+        Read a model written with `to_hdulist`.
+
+        Parameters
+        ----------
+
+        path : str
+            Name of the file.
+
+        Returns
+        -------
+
+        `DarkModel`
+        """
+        with fits.open(path, memmap=False) as hdulist:
+            header = hdulist[0].header
+            if not header.get(DARK_MODEL_KEYWORD, False):
+                raise ValueError("{} is not a dark model".format(path))
+            # The offset is in an extension if the file is tile compressed.
+            offset = hdulist[image_hdu_index(hdulist)].data.astype('float64')
+            rate = hdulist['RATE'].data.astype('float64')
+            exposure_keyword = hdulist['RATE'].header.get('EXPKEY',
+                                                          'exposure')
+        return cls(offset, rate, header=header,
+                   unit=header.get('BUNIT', u.adu),
+                   exposure_keyword=exposure_keyword)
@@ -0,0 +1,222 @@
+import json
+import os
+import threading
+
+from .fits_io import PARTIAL_SUFFIX
+
+__all__ = [
+    'CHECKPOINT_NAME',
+    'Checkpoint',
+]
+
+# Name of the journal kept in each destination directory; it is hidden and
+# not a FITS file, so collections of the directory never see it.
+CHECKPOINT_NAME = '.reducer_checkpoint.jsonl'
+
+
+class Checkpoint(object):
+    """
+    Journal of the files a reduction has finished writing to a directory,
+    from which an interrupted reduction resumes where it stopped.
+
+    Each output is recorded, and the record flushed to disk, once the file
+    is completely written but before it is moved into place by
+    `~reducer.fits_io.write_atomic`. So every output in the directory that
+    was written by a reduction is recorded, along with the input it was
+    made from and the size and modification time of both, and an output
+    that is recorded but missing was never finished and is made again. So
+    is an output whose input has been replaced since it was made.
+
+    Inputs that could not be reduced are recorded too, with the reason, so
+    they can be retried later.
+
+    Several reductions, and threads, can record outputs in the same
+    directory at once.
+
+    Parameters
+    ----------
+
+    directory : str
+        Directory the outputs are written to.
+
+    name : str, optional
+        Name of the journal in that directory.
+    """
+    def __init__(self, directory, name=CHECKPOINT_NAME):
+        self._directory = directory
+        self._path = os.path.join(directory, name)
+        self._lock = threading.Lock()
+        self._records = {}
+        self.reload()
+
+    @property
+    def directory(self):
+        """
+        Directory the outputs are written to.
+        """
+        return self._directory
+
+    @property
+    def path(self):
+        """
+        Name of the journal.
+        """
+        return self._path
+
+    def reload(self):
+        """
+        Read the journal again, to pick up outputs recorded by other
+        reductions.
+        """
+        records = {}
+        try:
+            with open(self._path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The last line is cut short if the process died
+                        # while writing it.
+                        continue
+                    records[record['output']] = record
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self._records = records
+
+    def record(self, source, path, written, source_path=None):
+        """
+        Record an output, flushing the record to disk before returning.
+
+        Parameters
+        ----------
+
+        source : str
+            Name of the input the output was made from.
+
+        path : str
+            Name of the output.
+
+        written : str
+            Name of the file as written, which may be a temporary file that
+            is about to be renamed to ``path``.
+
+        source_path : str, optional
+            Path of the input, if ``source`` is not one; its size and
+            modification time are recorded.
+        """
+        source_stat = os.stat(source_path or source)
+        stat = os.stat(written)
+        self._append(dict(source=source, output=os.path.basename(path),
+                          size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                          source_size=source_stat.st_size,
+                          source_mtime_ns=source_stat.st_mtime_ns))
+
+    def record_failure(self, source, path, reason):
+        """
+        Record that an input could not be reduced.
+
+        Parameters
+        ----------
+
+        source : str
+            Name of the input.
+
+        path : str
+            Name of the output it would have been reduced to.
+
+        reason : str
+            Why it failed.
+        """
+        self._append(dict(source=source, output=os.path.basename(path),
+                          failed=reason))
+
+    def _append(self, record):
+        line = (json.dumps(record) + '\n').encode()
+        with self._lock:
+            # One write per record, appended, so records from several
+            # reductions are never interleaved.
+            with open(self._path, 'ab+') as f:
+                if f.seek(0, os.SEEK_END):
+                    # Start a new line after one cut short when the process
+                    # died while writing it, so this record is readable.
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        line = b'\n' + line
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._records[record['output']] = record
+
+    def done(self, source, path, source_path=None):
+        """
+        Whether ``path`` is a finished output made from ``source`` as it is
+        now.
+
+        Parameters
+        ----------
+
+        source : str
+            Name of the input.
+
+        path : str
+            Name of the output.
+
+        source_path : str, optional
+            Path of the input, if ``source`` is not one.
+
+        Returns
+        -------
+
+        bool
+        """
+        with self._lock:
+            record = self._records.get(os.path.basename(path))
+        if (record is None or record['source'] != source or
+                'failed' in record):
+            return False
+        try:
+            stat = os.stat(path)
+            source_stat = os.stat(source_path or source)
+        except OSError:
+            return False
+        return (stat.st_size == record['size'] and
+                stat.st_mtime_ns == record['mtime_ns'] and
+                source_stat.st_size == record.get('source_size') and
+                source_stat.st_mtime_ns == record.get('source_mtime_ns'))
+
+    def failures(self):
+        """
+        Inputs whose last attempt failed, with the reason.
+
+        Returns
+        -------
+
+        dict
+        """
+        with self._lock:
+            return {record['source']: record['failed']
+                    for record in self._records.values()
+                    if 'failed' in record}
+
+    def remove_partial(self, names):
+        """
+        Remove files left half written, by a reduction that was
+        interrupted, for the given outputs.
+
+        Parameters
+        ----------
+
+        names : list of str
+            Names of outputs, relative to the directory.
+        """
+        prefixes = tuple('.{}.'.format(os.path.basename(name))
+                         for name in names)
+        if not prefixes:
+            return
+        for entry in os.listdir(self._directory):
+            if entry.startswith(prefixes) and entry.endswith(PARTIAL_SUFFIX):
+                try:
+                    os.remove(os.path.join(self._directory, entry))
+                except OSError:
+                    pass
@@ -0,0 +1,282 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import numpy as np
+
+import ccdproc
+
+__all__ = [
+    'COSMIC_RAY_METHODS',
+    'clean_cosmic_rays',
+    'cosmicray_clean',
+    'tile_slices',
+]
+
+# Methods of cosmic ray rejection; see clean_cosmic_rays.
+COSMIC_RAY_METHODS = ('median', 'lacosmic')
+
+# Default length of a side of the tiles an image is cleaned in, not counting
+# the overlap with neighbouring tiles.
+DEFAULT_TILE_SIZE = 512
+
+# Default number of times cosmic rays are looked for in each tile.
+DEFAULT_MAX_ITER = 4
+
+# Distance, in pixels, over which one pass of L.A.Cosmic can be affected by
+# pixel values; several times the size of its largest filter (7x7 on an
+# image subsampled by 2), so that tiles overlapping by this much per pass
+# find the same cosmic rays as cleaning the whole image.
+LACOSMIC_REACH = 16
+
+# Default settings for median filter rejection; the same as those of
+# ccdproc.cosmicray_median except rbox, which must be non-zero for cosmic
+# rays to be replaced.
+MEDIAN_DEFAULTS = dict(thresh=5, mbox=11, gbox=0, rbox=5)
+
+
+def tile_slices(shape, tile_size=DEFAULT_TILE_SIZE, overlap=0):
+    """
+    Divide a 2-D image into tiles that overlap their neighbours.
+
+    Parameters
+    ----------
+
+    shape : tuple of int
+        Shape of the image.
+
+    tile_size : int, optional
+        Largest length of a side of the part of the image each tile is
+        responsible for.
+
+    overlap : int, optional
+        Number of pixels each tile extends past that part on every side,
+        where the image allows.
+
+    Returns
+    -------
+
+    list of tuple
+        ``(outer, inner, core)`` for each tile: ``outer`` are the slices of
+        the image covered by the tile, ``inner`` the slices of the image the
+        tile is responsible for, and ``core`` the slices of the tile itself
+        that correspond to ``inner``.
+    """
+    ranges = []
+    for length in shape:
+        n_tiles = max(1, -(-length // tile_size))
+        edges = np.linspace(0, length, n_tiles + 1).round().astype(int)
+        ranges.append(list(zip(edges[:-1], edges[1:])))
+
+    tiles = []
+    for y_start, y_stop in ranges[0]:
+        for x_start, x_stop in ranges[1]:
+            outer_y = (max(0, y_start - overlap), min(shape[0],
+                                                      y_stop + overlap))
+            outer_x = (max(0, x_start - overlap), min(shape[1],
+                                                      x_stop + overlap))
+            outer = (slice(*outer_y), slice(*outer_x))
+            inner = (slice(y_start, y_stop), slice(x_start, x_stop))
+            core = (slice(y_start - outer_y[0], y_stop - outer_y[0]),
+                    slice(x_start - outer_x[0], x_stop - outer_x[0]))
+            tiles.append((outer, inner, core))
+    return tiles
+
+
+def _median_tile(data, mask, max_iter, error_image=None, thresh=5, mbox=11,
+                 gbox=0, rbox=5):
+    """
+    Median filter rejection of one tile, repeated until a pass finds no
+    new cosmic rays or ``max_iter`` passes have been made.
+    """
+    found = np.zeros(data.shape, dtype=bool)
+    for _ in range(max_iter):
+        data, crmask = ccdproc.cosmicray_median(data, error_image=error_image,
+                                                thresh=thresh, mbox=mbox,
+                                                gbox=gbox, rbox=rbox)
+        new = crmask & ~found
+        found |= crmask
+        if not new.any():
+            break
+    return data, found
+
+
+def _lacosmic_tile(data, mask, max_iter, **kwd):
+    """
+    L.A.Cosmic rejection of one tile; astroscrappy stops by itself once a
+    pass finds no new cosmic rays.
+    """
+    from astroscrappy import detect_cosmics
+
+    crmask, cleaned = detect_cosmics(data, inmask=mask, niter=max_iter,
+                                     **kwd)
+    return cleaned, crmask
+
+
+def _reach(method, max_iter, kwd):
+    if method == 'median':
+        settings = dict(MEDIAN_DEFAULTS, **kwd)
+        one_pass = (settings['mbox'] // 2 + settings['gbox'] // 2 +
+                    settings['rbox'] // 2)
+    else:
+        one_pass = LACOSMIC_REACH
+    return max_iter * one_pass
+
+
+def clean_cosmic_rays(data, method='median', mask=None,
+                      max_iter=DEFAULT_MAX_ITER, tile_size=DEFAULT_TILE_SIZE,
+                      overlap=None, n_threads=None, **kwd):
+    """
+    Find and replace cosmic rays in an image, working on overlapping tiles
+    in parallel.
+
+    Each tile is cleaned on its own, then the part of it away from the
+    overlap is copied into the result, so with enough overlap the same
+    cosmic rays are found as when cleaning the whole image at once. Tiles
+    stop being cleaned when a pass finds no new cosmic rays, or after
+    ``max_iter`` passes, so a tile with few cosmic rays costs little however
+    many others need; the values replacing cosmic rays can therefore differ
+    slightly from those of cleaning the whole image, where every pixel goes
+    through as many passes as the worst part of the image needs.
+
+    Parameters
+    ----------
+
+    data : `numpy.ndarray`
+        2-D image; not modified.
+
+    method : str, optional
+        One of `COSMIC_RAY_METHODS`:
+
+        + ``'median'``: pixels more than ``thresh`` times the noise above
+          the median of the ``mbox`` x ``mbox`` box around them are replaced
+          by the median of the ``rbox`` x ``rbox`` box around them, using
+          `ccdproc.cosmicray_median`. Unless ``error_image`` is given the
+          noise is the standard deviation of the whole image, as in ccdproc.
+          With ``max_iter=1`` the result is that of
+          `ccdproc.cosmicray_median` on the whole image.
+        + ``'lacosmic'``: L.A.Cosmic, using `astroscrappy.detect_cosmics`.
+
+    mask : `numpy.ndarray` of bool, optional
+        Pixels to ignore; only used by ``'lacosmic'``.
+
+    max_iter : int, optional
+        Largest number of passes made over each tile.
+
+    tile_size : int, optional
+        Length of a side of the part of the image each tile is responsible
+        for.
+
+    overlap : int, optional
+        Number of pixels by which tiles overlap. The default is enough for
+        the cosmic rays found not to depend on the tiling, except that
+        L.A.Cosmic may treat saturated stars that straddle tile edges
+        differently.
+
+    n_threads : int, optional
+        Number of tiles cleaned at the same time; defaults to the number of
+        CPUs. With one thread the whole image is cleaned at once, since the
+        overlap of the tiles would only add work.
+
+    kwd :
+        Settings of the method: ``error_image``, ``thresh``, ``mbox``,
+        ``gbox`` and ``rbox`` for ``'median'`` (see `MEDIAN_DEFAULTS`);
+        any argument of `astroscrappy.detect_cosmics` other than ``inmask``
+        and ``niter`` for ``'lacosmic'``.
+
+    Returns
+    -------
+
+    cleaned : `numpy.ndarray`
+        The image with cosmic rays replaced.
+
+    crmask : `numpy.ndarray` of bool
+        ``True`` where cosmic rays were found.
+    """
+    if method not in COSMIC_RAY_METHODS:
+        raise ValueError("method must be one of {}, not "
+                         "{}".format(', '.join(COSMIC_RAY_METHODS), method))
+    if max_iter < 1:
+        raise ValueError("max_iter must be at least 1")
+    data = np.asarray(data)
+    if overlap is None:
+        overlap = _reach(method, max_iter, kwd)
+
+    if method == 'median':
+        settings = dict(MEDIAN_DEFAULTS, **kwd)
+        error_image = settings.pop('error_image', None)
+        if error_image is None:
+            # The noise estimate must come from the whole image, not each
+            # tile, for the result not to depend on the tiling.
+            error_image = float(data.std())
+
+        def clean_tile(outer):
+            error = error_image
+            if isinstance(error, np.ndarray):
+                error = error[outer]
+            return _median_tile(data[outer], None, max_iter,
+                                error_image=error, **settings)
+    else:
+        def clean_tile(outer):
+            tile_mask = None if mask is None else mask[outer]
+            return _lacosmic_tile(data[outer], tile_mask, max_iter, **kwd)
+
+    n_threads = n_threads or os.cpu_count() or 1
+    if n_threads == 1:
+        # Tiles only pay for their overlap when cleaned in parallel.
+        whole = (slice(None), slice(None))
+        tiles = [(whole, whole, whole)]
+    else:
+        tiles = tile_slices(data.shape, tile_size, overlap)
+    cleaned = None
+    crmask = np.zeros(data.shape, dtype=bool)
+    with ThreadPoolExecutor(max_workers=min(n_threads, len(tiles))) as pool:
+        results = pool.map(clean_tile, [outer for outer, _, _ in tiles])
+        for (_, inner, core), (tile, tile_mask) in zip(tiles, results):
+            if cleaned is None:
+                cleaned = np.empty(data.shape, dtype=tile.dtype)
+            cleaned[inner] = tile[core]
+            crmask[inner] = tile_mask[core]
+    return cleaned, crmask
+
+
+def cosmicray_clean(ccd, method='median', max_iter=DEFAULT_MAX_ITER,
+                    tile_size=DEFAULT_TILE_SIZE, overlap=None,
+                    n_threads=None, **kwd):
+    """
+    Clean the cosmic rays from an image with `clean_cosmic_rays`.
+
+    The cosmic rays are added to the mask of the result and the method
+    used is recorded in the ``CRCLEAN`` keyword of its metadata.
+
+    Parameters
+    ----------
+
+    ccd : `~ccdproc.CCDData`
+        Image to clean. For ``'median'`` its uncertainty, if any, is the
+        noise against which cosmic rays are found; for ``'lacosmic'``
+        masked pixels are ignored.
+
+    All other parameters are as for `clean_cosmic_rays`.
+
+    Returns
+    -------
+
+    `~ccdproc.CCDData`
+    """
+    if method == 'median':
+        if 'error_image' not in kwd and ccd.uncertainty is not None:
+            kwd['error_image'] = ccd.uncertainty.array
+        mask = None
+    else:
+        mask = ccd.mask
+    cleaned, crmask = clean_cosmic_rays(ccd.data, method=method, mask=mask,
+                                        max_iter=max_iter,
+                                        tile_size=tile_size, overlap=overlap,
+                                        n_threads=n_threads, **kwd)
+    result = ccdproc.CCDData(cleaned, unit=ccd.unit,
+                             mask=crmask if ccd.mask is None else
+                             ccd.mask | crmask,
+                             uncertainty=ccd.uncertainty, wcs=ccd.wcs,
+                             meta=ccd.meta.copy())
+    result.meta['CRCLEAN'] = (method, 'Cosmic ray rejection method')
+    return result
@@ -0,0 +1,666 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import queue
+import threading
+import uuid
+
+import numpy as np
+
+import ccdproc
+from astropy.io import fits
+from astropy.io.fits.hdu.compressed import DITHER_SEED_CHECKSUM
+
+__all__ = [
+    'BackgroundWriter',
+    'COMPRESSION_TYPES',
+    'OUTPUT_ENCODINGS',
+    'compress_hdulist',
+    'encode_hdu',
+    'image_hdu_index',
+    'read_ahead',
+    'read_ccd',
+    'read_hdulist',
+    'read_master',
+    'sidecar_paths',
+    'write_atomic',
+    'write_sidecar',
+]
+
+# Tile compression algorithms offered for output files. RICE_1 quantizes
+# floating point images (see ``quantize_level``); GZIP is always lossless.
+COMPRESSION_TYPES = ('RICE_1', 'GZIP_1', 'GZIP_2')
+
+# Types in which output images can be written. The integer types are
+# scaled with BSCALE and BZERO chosen for each image; see encode_hdu.
+OUTPUT_ENCODINGS = ('float32', 'float64', 'int16', 'int32')
+
+# Default quantization level for RICE compression of floating point images:
+# pixel values are quantized in steps of the background noise divided by
+# this number.
+DEFAULT_QUANTIZE_LEVEL = 16.0
+
+# Bump this whenever what is stored in master sidecars changes; sidecars
+# written with a different version are ignored and rewritten.
+SIDECAR_VERSION = 1
+
+# Ending of the temporary files FITS files are written to before being moved
+# into place; it is not a FITS extension, so collections never see them.
+PARTIAL_SUFFIX = '.part'
+
+# Keywords that describe how integer pixel values are scaled.
+_SCALING_KEYWORDS = ('BSCALE', 'BZERO', 'BLANK')
+
+# Keywords that describe how the data of a particular HDU is stored; they
+# are dropped from the copy of the image header put in an empty primary HDU.
+_STORAGE_KEYWORDS = _SCALING_KEYWORDS + ('CHECKSUM', 'DATASUM')
+
+
+def image_hdu_index(hdulist):
+    """
+    Index of the HDU holding the image of a file.
+
+    That is the primary HDU unless it is empty, in which case it is the
+    first extension with image data, e.g. a tile-compressed image.
+
+    Parameters
+    ----------
+
+    hdulist : `astropy.io.fits.HDUList`
+        Open file.
+
+    Returns
+    -------
+
+    int
+    """
+    if hdulist[0].header.get('NAXIS', 0):
+        return 0
+    for index, hdu in enumerate(hdulist[1:], 1):
+        if (isinstance(hdu, (fits.ImageHDU, fits.CompImageHDU)) and
+                hdu.header.get('NAXIS', 0)):
+            return index
+    return 0
+
+
+def read_ccd(path, **kwd):
+    """
+    Read a `~ccdproc.CCDData` from a file whose image may be tile
+    compressed.
+
+    Parameters
+    ----------
+
+    path : str
+        Name of the file.
+
+    kwd :
+        Passed on to `ccdproc.CCDData.read`. Unless ``hdu`` is given, the
+        image is read from the HDU found by `image_hdu_index`.
+    """
+    if 'hdu' not in kwd:
+        with fits.open(path) as hdulist:
+            index = image_hdu_index(hdulist)
+        if index:
+            kwd['hdu'] = index
+    return ccdproc.CCDData.read(path, **kwd)
+
+
+def sidecar_paths(path):
+    """
+    Names of the files of the sidecar of a master.
+
+    The sidecar is kept next to the master, in hidden files: the data, and
+    mask if there is one, as native-endian ``.npy`` arrays, and a small JSON
+    file recording the size, modification time and ``DATASUM`` of the
+    master it was made from.
+
+    Parameters
+    ----------
+
+    path : str
+        Name of the master's FITS file.
+
+    Returns
+    -------
+
+    data, mask, info : str
+    """
+    directory, name = os.path.split(path)
+    base = os.path.join(directory, '.' + name)
+    return base + '.npy', base + '.mask.npy', base + '.json'
+
+
+def _fits_state(path, header):
+    stat = os.stat(path)
+    return {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'datasum': header.get('DATASUM'),
+    }
+
+
+def _save_array(path, array):
+    # Write to a temporary name and rename, so a reader never sees a
+    # partly written array.
+    temporary = path + '.tmp{}'.format(os.getpid())
+    with open(temporary, 'wb') as f:
+        np.save(f, array)
+    os.replace(temporary, path)
+
+
+def write_sidecar(path, ccd=None):
+    """
+    Write the sidecar of a master, from which `read_master` can map it
+    without decoding the FITS file.
+
+    Masters with an uncertainty get no sidecar, since the sidecar holds
+    only the data and mask.
+
+    Parameters
+    ----------
+
+    path : str
+        Name of the master's FITS file.
+
+    ccd : `~ccdproc.CCDData`, optional
+        The master as read from ``path`` by `read_ccd`, or the image it was
+        written losslessly from; read if not given.
+
+    Returns
+    -------
+
+    bool
+        Whether a sidecar was written.
+    """
+    if ccd is None:
+        ccd = read_ccd(path)
+    if ccd.uncertainty is not None:
+        return False
+    data_path, mask_path, info_path = sidecar_paths(path)
+    with fits.open(path) as hdulist:
+        state = _fits_state(path, hdulist[image_hdu_index(hdulist)].header)
+
+    data = np.asarray(ccd.data)
+    _save_array(data_path, data.astype(data.dtype.newbyteorder('='),
+                                       copy=False))
+    if ccd.mask is not None:
+        _save_array(mask_path, np.asarray(ccd.mask, dtype=bool))
+    info = dict(state, version=SIDECAR_VERSION,
+                unit=ccd.unit.to_string(),
+                mask=ccd.mask is not None,
+                header=fits.Header(ccd.meta).tostring())
+    temporary = info_path + '.tmp{}'.format(os.getpid())
+    with open(temporary, 'w') as f:
+        json.dump(info, f)
+    os.replace(temporary, info_path)
+    return True
+
+
+def _read_sidecar(path, with_mask=True):
+    """
+    The master mapped from its sidecar, or ``None`` if there is no sidecar
+    or it does not match the master.
+    """
+    data_path, mask_path, info_path = sidecar_paths(path)
+    try:
+        with open(info_path) as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if info.get('version') != SIDECAR_VERSION:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if (stat.st_size, stat.st_mtime_ns) != (info['size'], info['mtime_ns']):
+        return None
+    if info['datasum'] is not None:
+        with fits.open(path) as hdulist:
+            header = hdulist[image_hdu_index(hdulist)].header
+            if header.get('DATASUM') != info['datasum']:
+                return None
+    try:
+        data = np.load(data_path, mmap_mode='r')
+        mask = None
+        if with_mask and info['mask']:
+            mask = np.load(mask_path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    return ccdproc.CCDData(data, mask=mask, unit=info['unit'],
+                           meta=fits.Header.fromstring(info['header']))
+
+
+def read_master(path, **kwd):
+    """
+    Read a master, mapping it from its sidecar if it has an up-to-date one
+    and otherwise reading the FITS file.
+
+    Mapping the sidecar costs next to nothing however big the master is,
+    where reading the FITS file means decoding and byte-swapping all of it.
+    A sidecar is up to date if the size and modification time of the
+    master, and its ``DATASUM`` if it has one, are those recorded when the
+    sidecar was written. Data read from a sidecar are read-only.
+
+    Sidecars are never written here, only by `write_sidecar`, which
+    `~reducer.astro_gui.Combiner` calls for the masters it writes unless
+    told not to.
+
+    Parameters
+    ----------
+
+    path : str
+        Name of the master's FITS file.
+
+    kwd :
+        Passed to `read_ccd` if the FITS file is read. If ``hdu_mask`` is
+        ``None`` the mask is not read from the sidecar either. Reading with
+        any argument other than ``hdu_mask``, ``hdu_uncertainty`` or
+        ``unit`` bypasses the sidecar.
+
+    Returns
+    -------
+
+    `~ccdproc.CCDData`
+    """
+    if set(kwd) - {'hdu_mask', 'hdu_uncertainty', 'unit'}:
+        return read_ccd(path, **kwd)
+    with_mask = kwd.get('hdu_mask', 'MASK') is not None
+    ccd = _read_sidecar(path, with_mask=with_mask)
+    if ccd is not None:
+        return ccd
+    return read_ccd(path, **kwd)
+
+
+def compress_hdulist(hdulist, index=0, compression='RICE_1',
+                     quantize_level=DEFAULT_QUANTIZE_LEVEL):
+    """
+    Replace one image of a list of HDUs with a tile-compressed version.
+
+    A compressed image must be an extension, so if the image is the primary
+    HDU it is moved to the first extension and the primary HDU keeps a copy
+    of its header, without data. An `~ccdproc.ImageFileCollection` of the
+    output files therefore still sees every keyword of the image.
+
+    Parameters
+    ----------
+
+    hdulist : `astropy.io.fits.HDUList`
+        HDUs to be written; not modified.
+
+    index : int, optional
+        Index of the image to compress.
+
+    compression : str, optional
+        One of `COMPRESSION_TYPES`.
+
+    quantize_level : float, optional
+        Quantization of floating point images for RICE_1 compression; larger
+        values keep more precision and compress less. Floating point images
+        compressed with GZIP are not quantized, so GZIP is lossless.
+
+    Returns
+    -------
+
+    `astropy.io.fits.HDUList`
+    """
+    if compression not in COMPRESSION_TYPES:
+        raise ValueError("compression must be one of {}, not "
+                         "{}".format(', '.join(COMPRESSION_TYPES), compression))
+    if compression.startswith('GZIP'):
+        quantize_level = 0.0
+
+    hdu = hdulist[index]
+    header = hdu.header.copy()
+    # Seeding the dither from the image checksum makes the output, like the
+    # uncompressed output, the same every time a file is reduced.
+    compressed = fits.CompImageHDU(hdu.data, header=header,
+                                   compression_type=compression,
+                                   quantize_level=quantize_level,
+                                   dither_seed=DITHER_SEED_CHECKSUM)
+    if hdu.data is not None and hdu.data.dtype.kind == 'i':
+        # The data are the stored values of an image scaled by encode_hdu,
+        # so the scaling has to be recorded with the compressed image too.
+        for keyword in _SCALING_KEYWORDS:
+            if keyword in hdu.header:
+                compressed.header[keyword] = hdu.header[keyword]
+    hdus = list(hdulist)
+    if index == 0:
+        for keyword in _STORAGE_KEYWORDS:
+            header.remove(keyword, ignore_missing=True)
+        hdus[0:1] = [fits.PrimaryHDU(header=header), compressed]
+    else:
+        hdus[index] = compressed
+    return fits.HDUList(hdus)
+
+
+def encode_hdu(hdu, encoding):
+    """
+    Convert the data of an image HDU to the type it will be written as.
+
+    Integer encodings are scaled separately for each image: ``BZERO`` is
+    the middle of the range of finite pixel values and ``BSCALE`` spreads
+    that range over all but the lowest integer, which is used as ``BLANK``
+    for pixels that are NaN or infinite. Each finite pixel read back from
+    the file differs from its value before encoding by at most
+    ``BSCALE / 2``, i.e. by at most::
+
+        (max - min) / (2 * (2**16 - 2))    for 'int16'
+        (max - min) / (2 * (2**32 - 2))    for 'int32'
+
+    where ``min`` and ``max`` are the smallest and largest finite pixel
+    values of the image, when the stored integers are scaled back in double
+    precision. Infinite pixels are read back as NaN. Readers may add their
+    own rounding on top of that; astropy, for example, returns images
+    stored as 'int16' as float32, which adds up to ``abs(value) * 2**-24``
+    for each pixel.
+
+    Parameters
+    ----------
+
+    hdu : `astropy.io.fits.PrimaryHDU` or `astropy.io.fits.ImageHDU`
+        Image to convert; its data and header are changed in place.
+
+    encoding : str
+        One of `OUTPUT_ENCODINGS`.
+
+    Returns
+    -------
+
+    hdu : same type as the input
+        The converted image.
+    """
+    if encoding not in OUTPUT_ENCODINGS:
+        raise ValueError("encoding must be one of {}, not "
+                         "{}".format(', '.join(OUTPUT_ENCODINGS), encoding))
+    for keyword in _SCALING_KEYWORDS:
+        hdu.header.remove(keyword, ignore_missing=True)
+
+    dtype = np.dtype(encoding)
+    if dtype.kind == 'f':
+        if hdu.data.dtype != dtype:
+            hdu.data = hdu.data.astype(dtype)
+        return hdu
+
+    info = np.iinfo(dtype)
+    data = np.array(hdu.data, dtype='float64')
+    finite = np.isfinite(data)
+    all_finite = finite.all()
+    if all_finite:
+        low, high = data.min(), data.max()
+    elif finite.any():
+        low, high = data[finite].min(), data[finite].max()
+    else:
+        low = high = 0.0
+    bzero = (high + low) / 2
+    bscale = (high - low) / (2.0 ** (8 * dtype.itemsize) - 2) or 1.0
+    if not all_finite:
+        # Put the pixels with no value where they will be scaled to BLANK.
+        data[~finite] = bzero + info.min * bscale
+    hdu.data = data
+    hdu.scale(encoding, bscale=bscale, bzero=bzero)
+    if not all_finite:
+        hdu.header['BLANK'] = info.min
+    return hdu
+
+
+def read_hdulist(path):
+    """
+    Read every HDU of a FITS file into memory.
+
+    Image data are scaled by ``BZERO`` and ``BSCALE`` as usual and put in
+    native byte order, so no further conversion is needed when they are
+    used. The file is closed before returning.
+
+    Parameters
+    ----------
+
+    path : str
+        Name of the file.
+
+    Returns
+    -------
+
+    `astropy.io.fits.HDUList`
+    """
+    with fits.open(path, memmap=False) as hdulist:
+        for hdu in hdulist:
+            data = hdu.data
+            if (isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU)) and
+                    data is not None and not data.dtype.isnative):
+                hdu.data = data.astype(data.dtype.newbyteorder('='))
+    return hdulist
+
+
+def read_ahead(paths, depth=2, n_threads=1, read=read_hdulist):
+    """
+    Read files on background threads, up to ``depth`` files ahead of the
+    one being used.
+
+    Parameters
+    ----------
+
+    paths : list of str
+        Names of the files, in the order they are wanted.
+
+    depth : int, optional
+        Largest number of files read but not yet used, which bounds the
+        memory used.
+
+    n_threads : int, optional
+        Number of files read at the same time.
+
+    read : callable, optional
+        Called with each path to read it.
+
+    Yields
+    ------
+
+    path, result
+        Each path and what ``read`` returned for it. If ``read`` raised an
+        exception it is raised when that path is reached.
+    """
+    paths = iter(paths)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        try:
+            for path in paths:
+                pending.append((path, pool.submit(read, path)))
+                if len(pending) >= depth:
+                    break
+            while pending:
+                path, future = pending.popleft()
+                for next_path in paths:
+                    pending.append((next_path, pool.submit(read, next_path)))
+                    break
+                yield path, future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+def _partial_path(path):
+    """
+    A new, hidden, name in the directory of ``path`` to write it to before
+    moving it into place.
+    """
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.{}.{}{}'.format(name, uuid.uuid4().hex,
+                                                     PARTIAL_SUFFIX))
+
+
+def _fsync_directory(directory):
+    try:
+        fd = os.open(directory or '.', os.O_RDONLY)
+    except OSError:
+        # Directories cannot be opened on some platforms.
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def write_atomic(hdulist, path, before_commit=None):
+    """
+    Write a FITS file so that it either appears complete, on disk, or not
+    at all, even if the process dies while writing it.
+
+    The file is written and flushed to disk under a temporary name (see
+    `PARTIAL_SUFFIX`) in the same directory, then moved into place.
+
+    Parameters
+    ----------
+
+    hdulist : `astropy.io.fits.HDUList`
+        HDUs to write.
+
+    path : str
+        Name of the file; an existing file is not overwritten.
+
+    before_commit : callable, optional
+        Called with the name of the temporary file once it is completely
+        written and before it is moved into place, e.g. to record it in a
+        `~reducer.checkpoint.Checkpoint`. If it raises, the file is not
+        moved into place.
+
+    Raises
+    ------
+
+    IOError
+        If ``path`` already exists.
+    """
+    if os.path.exists(path):
+        raise IOError("File {!r} already exists.".format(path))
+    temporary = _partial_path(path)
+    try:
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        with os.fdopen(fd, 'wb') as f:
+            hdulist.writeto(f)
+            f.flush()
+            os.fsync(f.fileno())
+        if before_commit is not None:
+            before_commit(temporary)
+        try:
+            # Unlike a rename, linking fails if the file has appeared since
+            # it was looked for.
+            os.link(temporary, path)
+        except FileExistsError:
+            raise IOError("File {!r} already exists.".format(path))
+        except OSError:
+            # The file system has no hard links.
+            if os.path.exists(path):
+                raise IOError("File {!r} already exists.".format(path))
+            os.rename(temporary, path)
+        _fsync_directory(os.path.dirname(path))
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+class BackgroundWriter(object):
+    """
+    Write FITS files on background threads so that writing one file
+    overlaps with preparing the next.
+
+    At most ``max_pending`` files wait to be written at any time; `submit`
+    blocks until there is room, so memory use stays bounded however far
+    computation gets ahead of the disk.
+
+    Files are written with `write_atomic`, so none is ever seen half written.
+
+    Parameters
+    ----------
+
+    n_threads : int, optional
+        Number of files written at the same time.
+
+    max_pending : int, optional
+        Number of files that can wait to be written. Defaults to
+        ``n_threads``.
+    """
+    def __init__(self, n_threads=1, max_pending=None):
+        self._queue = queue.Queue(maxsize=max_pending or n_threads)
+        self._lock = threading.Lock()
+        self._finished = []
+        self._threads = [threading.Thread(target=self._run, daemon=True)
+                         for _ in range(n_threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            hdulist, path, header, before_commit = item
+            try:
+                write_atomic(hdulist, path, before_commit=before_commit)
+            except Exception as e:
+                error = e
+            else:
+                error = None
+            with self._lock:
+                self._finished.append((path, header, error))
+
+    def submit(self, hdulist, path, header=None, before_commit=None):
+        """
+        Queue a file to be written, waiting for room in the queue if
+        necessary.
+
+        Parameters
+        ----------
+
+        hdulist : `astropy.io.fits.HDUList`
+            HDUs to write. Everything in it must be in memory, not read
+            lazily from a file that may be closed before it is written.
+
+        path : str
+            Name of the file to write; an existing file is not overwritten.
+
+        header : `astropy.io.fits.Header`, optional
+            Returned along with ``path`` by `done` once the file is written.
+
+        before_commit : callable, optional
+            Passed to `write_atomic`.
+        """
+        if not self._threads:
+            raise RuntimeError("Cannot submit files to a closed writer")
+        self._queue.put((hdulist, path, header, before_commit))
+
+    def done(self):
+        """
+        Files finished since the last call, whether written or not.
+
+        Returns
+        -------
+
+        list of tuple
+            ``(path, header, error)`` for each file, where ``error`` is the
+            exception raised while writing it or ``None``.
+        """
+        with self._lock:
+            finished = self._finished
+            self._finished = []
+        return finished
+
+    def close(self):
+        """
+        Wait for every queued file to be written and stop the threads.
+
+        Returns
+        -------
+
+        list of tuple
+            Files finished since the last call to `done`; see `done`.
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        return self.done()
@@ -0,0 +1,805 @@
+import bisect
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+import fnmatch
+import hashlib
+from io import BytesIO
+import json
+import os
+import re
+import sqlite3
+import threading
+
+import numpy as np
+
+from astropy.io import fits
+from astropy.table import MaskedColumn, Table
+from ccdproc import ImageFileCollection
+
+__all__ = [
+    'HeaderIndex',
+    'IndexedImageFileCollection',
+    'header_cards',
+    'read_header',
+]
+
+# Name of the index file created in each directory that is indexed.
+DEFAULT_INDEX_NAME = '.reducer_index.sqlite'
+
+# Number of threads used to read headers; reading is almost entirely
+# waiting on the filesystem, so this can be well above the number of cores.
+DEFAULT_SCAN_THREADS = 8
+
+# Size of a FITS block and of a header card, in bytes.
+FITS_BLOCK_SIZE = 2880
+FITS_CARD_SIZE = 80
+
+# Bump this whenever the way header values are stored changes; indexes
+# written with a different version are discarded and rebuilt.
+INDEX_SCHEMA_VERSION = 1
+
+
+def _default_index_path(location):
+    """
+    Put the index in the directory it describes if that directory is
+    writable, otherwise in a per-user cache directory.
+    """
+    location = os.path.abspath(location)
+    if os.access(location, os.W_OK):
+        return os.path.join(location, DEFAULT_INDEX_NAME)
+    cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'reducer')
+    os.makedirs(cache_dir, exist_ok=True)
+    digest = hashlib.sha1(location.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, digest + '.sqlite')
+
+
+def read_header(path, ext=0):
+    """
+    Read a FITS header, reading only the blocks that hold the header.
+
+    The primary header of an uncompressed file is read directly, a block at
+    a time, stopping at the END card; anything else is handed to
+    `astropy.io.fits.getheader`.
+
+    Parameters
+    ----------
+
+    path : str
+        Name of the file.
+
+    ext : int, optional
+        Extension whose header is read.
+
+    Returns
+    -------
+
+    `astropy.io.fits.Header`
+    """
+    if ext != 0 or os.path.splitext(path)[1].lower() in ('.gz', '.bz2', '.z',
+                                                         '.zip', '.fz'):
+        return fits.getheader(path, ext)
+
+    end_card = b'END' + b' ' * (FITS_CARD_SIZE - 3)
+    blocks = []
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(FITS_BLOCK_SIZE)
+            if len(block) < FITS_BLOCK_SIZE:
+                raise OSError("{} ends before the end of its "
+                              "header".format(path))
+            if not blocks and not block.startswith(b'SIMPLE  ='):
+                raise OSError("{} is not a FITS file".format(path))
+            blocks.append(block)
+            for start in range(0, FITS_BLOCK_SIZE, FITS_CARD_SIZE):
+                if block[start:start + FITS_CARD_SIZE] == end_card:
+                    return fits.Header.fromstring(
+                        b''.join(blocks).decode('ascii'))
+
+
+def _summary_to_blob(summary):
+    """
+    Serialize a summary table without pickling. Columns of simple type are
+    stored as raw arrays, columns of mixed type (object columns) as JSON.
+    """
+    columns = []
+    arrays = {}
+    for idx, name in enumerate(summary.colnames):
+        column = summary[name]
+        arrays['mask_{}'.format(idx)] = np.asarray(column.mask, dtype=bool)
+        if column.dtype.kind == 'O':
+            columns.append({'name': name, 'dtype': 'O',
+                            'values': [_json_value(v) for v in
+                                       column.data.data.tolist()]})
+        else:
+            columns.append({'name': name, 'dtype': column.dtype.str})
+            arrays['data_{}'.format(idx)] = np.asarray(column.data.data)
+    buffer = BytesIO()
+    np.savez(buffer, **arrays)
+    return json.dumps(columns), buffer.getvalue()
+
+
+def _summary_key(header_keywords):
+    """
+    Key under which the summary of ``header_keywords`` is stored. The file
+    column is always in the summary, so whether ``'file'`` is listed makes
+    no difference.
+    """
+    keywords = []
+    for keyword in header_keywords:
+        if keyword != 'file' and keyword not in keywords:
+            keywords.append(keyword)
+    return json.dumps(keywords)
+
+
+def _summary_from_blob(columns, blob):
+    arrays = np.load(BytesIO(blob), allow_pickle=False)
+    summary = Table(masked=True)
+    for idx, column in enumerate(json.loads(columns)):
+        if column['dtype'] == 'O':
+            data = np.empty(len(column['values']), dtype=object)
+            data[:] = column['values']
+        else:
+            data = arrays['data_{}'.format(idx)]
+        summary.add_column(MaskedColumn(name=column['name'], data=data,
+                                        mask=arrays['mask_{}'.format(idx)]))
+    return summary
+
+
+def _merge_summaries(old, new, files):
+    """
+    Combine the summary of unchanged files with the summary of new or
+    modified files.
+
+    Each column is rebuilt from the combined list of values, so it ends up
+    with the same type it would have had if the summary had been built
+    from all of the files at once.
+
+    Parameters
+    ----------
+
+    old, new : `~astropy.table.Table` or None
+        Summaries to merge.
+
+    files : list of str
+        All of the files in the collection; rows are put in this order.
+    """
+    parts = [part for part in (old, new) if part is not None and len(part)]
+    if not parts:
+        return old if old is not None else new
+
+    names = []
+    for part in parts:
+        names.extend(c for c in part.colnames if c not in names)
+
+    merged = Table(masked=True)
+    for name in names:
+        columns = [part[name] for part in parts if name in part.colnames]
+        if (len(columns) == len(parts) and
+                len(set(c.dtype.kind for c in columns)) == 1 and
+                columns[0].dtype.kind != 'O' and
+                not any(np.any(c.mask) for c in columns)):
+            # Nothing is missing and the types agree, so the values can be
+            # joined without going through python objects.
+            data = np.concatenate([c.data.data for c in columns])
+            merged.add_column(MaskedColumn(name=name, data=data,
+                                           mask=np.zeros(len(data),
+                                                         dtype=bool)))
+            continue
+
+        values = []
+        mask = []
+        for part in parts:
+            if name in part.colnames:
+                column = part[name]
+                column_mask = np.asarray(column.mask, dtype=bool)
+                column_mask = np.broadcast_to(column_mask, (len(part),))
+                column_values = column.data.data.tolist()
+                values.extend(None if m else v
+                              for v, m in zip(column_values, column_mask))
+                mask.extend(column_mask.tolist())
+            else:
+                values.extend([None] * len(part))
+                mask.extend([True] * len(part))
+        merged.add_column(MaskedColumn(name=name, data=values, mask=mask))
+
+    position = {name: idx for idx, name in enumerate(files)}
+    order = np.argsort([position.get(name, len(files))
+                        for name in merged['file'].tolist()], kind='stable')
+    return merged[order]
+
+
+def _json_value(value):
+    """
+    Convert a header value to something JSON can store.
+    """
+    if isinstance(value, fits.card.Undefined):
+        return None
+    if isinstance(value, complex):
+        return str(value)
+    return value
+
+
+def header_cards(header):
+    """
+    Reduce a FITS header to the (keyword, value) pairs that appear in the
+    summary of an `~ccdproc.ImageFileCollection`.
+
+    Keywords are lower case, blank keywords are dropped, only the first of
+    any repeated keyword is kept, and all of the COMMENT and HISTORY cards
+    are joined into a single value each, exactly as
+    `~ccdproc.ImageFileCollection` does.
+
+    Parameters
+    ----------
+
+    header : `astropy.io.fits.Header`
+        Header to summarize.
+
+    Returns
+    -------
+
+    list of tuple
+        The (keyword, value) pairs, in header order.
+    """
+    cards = []
+    multi_entry_keys = {'comment': [], 'history': []}
+    already_encountered = set()
+    for k, v in header.items():
+        if k == '':
+            continue
+        k = k.lower()
+        if k in multi_entry_keys:
+            multi_entry_keys[k].append(str(v))
+            continue
+        elif k in already_encountered:
+            continue
+        already_encountered.add(k)
+        cards.append((k, _json_value(v)))
+
+    for k, v in multi_entry_keys.items():
+        if v:
+            cards.append((k, ','.join(v)))
+    return cards
+
+
+class HeaderIndex(object):
+    """
+    Persistent index of the FITS headers of the files in one directory.
+
+    Each file is indexed by name, size and modification time, so a header
+    is only read from disk again if the file has changed since it was
+    indexed.
+
+    Parameters
+    ----------
+
+    location : str
+        Directory whose files are indexed.
+
+    index_path : str, optional
+        Name of the SQLite file holding the index. By default it is a
+        hidden file in ``location``, or in ``~/.cache/reducer`` if
+        ``location`` is not writable.
+
+    ext : int, optional
+        Extension whose header is indexed.
+
+    n_threads : int, optional
+        Number of headers read at the same time when scanning.
+    """
+    def __init__(self, location, index_path=None, ext=0,
+                 n_threads=DEFAULT_SCAN_THREADS):
+        self._location = location
+        self._index_path = index_path or _default_index_path(location)
+        self._ext = ext
+        self._n_threads = n_threads
+        self._create()
+
+    @property
+    def location(self):
+        return self._location
+
+    @property
+    def index_path(self):
+        return self._index_path
+
+    def _connect(self):
+        # A new connection is made each time so that the index can be used
+        # from any thread, and copied or pickled along with a collection.
+        return closing(sqlite3.connect(self._index_path, timeout=30))
+
+    def _create(self):
+        with self._connect() as conn, conn:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version != INDEX_SCHEMA_VERSION:
+                conn.execute('DROP TABLE IF EXISTS headers')
+                conn.execute('DROP TABLE IF EXISTS summaries')
+                conn.execute('PRAGMA user_version = {}'.format(
+                    INDEX_SCHEMA_VERSION))
+            conn.execute('CREATE TABLE IF NOT EXISTS headers ('
+                         'name TEXT, ext INTEGER, size INTEGER, '
+                         'mtime_ns INTEGER, cards TEXT, '
+                         'PRIMARY KEY (name, ext))')
+            conn.execute('CREATE TABLE IF NOT EXISTS summaries ('
+                         'keywords TEXT, ext INTEGER, fingerprint TEXT, '
+                         'columns TEXT, blob BLOB, '
+                         'PRIMARY KEY (keywords, ext))')
+
+    def _stat(self, name):
+        stat = os.stat(os.path.join(self._location, name))
+        return stat.st_size, stat.st_mtime_ns
+
+    def _store(self, rows):
+        with self._connect() as conn, conn:
+            conn.executemany('INSERT OR REPLACE INTO headers '
+                             '(name, ext, size, mtime_ns, cards) '
+                             'VALUES (?, ?, ?, ?, ?)',
+                             [(name, self._ext, size, mtime, json.dumps(cards))
+                              for name, size, mtime, cards in rows])
+
+    def _read_cards(self, name):
+        """
+        Header cards of a file, or ``None`` if the header cannot be read.
+        """
+        try:
+            header = read_header(os.path.join(self._location, name),
+                                 self._ext)
+        except (OSError, ValueError, UnicodeDecodeError):
+            return None
+        return header_cards(header)
+
+    def stored(self):
+        """
+        Everything currently in the index, whether or not it is up to date.
+
+        Returns
+        -------
+
+        dict
+            Keys are file names, values are ``(size, mtime_ns, cards)``.
+        """
+        with self._connect() as conn:
+            rows = conn.execute('SELECT name, size, mtime_ns, cards '
+                                'FROM headers WHERE ext = ?', (self._ext,))
+            return {name: (size, mtime, cards)
+                    for name, size, mtime, cards in rows}
+
+    def stat_files(self, names):
+        """
+        Size and modification time of each file.
+
+        Parameters
+        ----------
+
+        names : list of str
+            Names of the files, relative to ``location``.
+
+        Returns
+        -------
+
+        list of tuple
+            ``(name, size, mtime_ns)`` for each file that exists, in the
+            order given.
+        """
+        stats = []
+        for name in names:
+            try:
+                size, mtime = self._stat(name)
+            except OSError:
+                continue
+            stats.append((name, size, mtime))
+        return stats
+
+    def scan(self, stats):
+        """
+        Return the header cards of each file, reading from disk only those
+        files that are new or have changed since they were indexed.
+
+        Parameters
+        ----------
+
+        stats : list of tuple
+            ``(name, size, mtime_ns)`` for each file, as returned by
+            `stat_files`.
+
+        Returns
+        -------
+
+        `~collections.OrderedDict`
+            Keys are file names, in the order given, values are lists of
+            (keyword, value) pairs as returned by `header_cards`. Files whose
+            header could not be read are left out.
+        """
+        stored = self.stored()
+        found = OrderedDict()
+        stale = []
+        for name, size, mtime in stats:
+            entry = stored.get(name)
+            if entry is not None and entry[:2] == (size, mtime):
+                found[name] = entry[2]
+            else:
+                found[name] = None
+                stale.append((name, size, mtime))
+
+        # Headers are read concurrently because on network filesystems
+        # nearly all of the time goes to waiting on each open and read.
+        if len(stale) > 1 and self._n_threads > 1:
+            with ThreadPoolExecutor(max_workers=self._n_threads) as pool:
+                all_cards = list(pool.map(self._read_cards,
+                                          [name for name, _, _ in stale]))
+        else:
+            all_cards = [self._read_cards(name) for name, _, _ in stale]
+
+        new_rows = []
+        for (name, size, mtime), cards in zip(stale, all_cards):
+            if cards is None:
+                del found[name]
+                continue
+            found[name] = cards
+            new_rows.append((name, size, mtime, cards))
+        if new_rows:
+            self._store(new_rows)
+
+        return OrderedDict((name, json.loads(cards)
+                            if isinstance(cards, str) else cards)
+                           for name, cards in found.items())
+
+    def load_summary(self, keywords, fingerprint):
+        """
+        Return the summary table stored for ``keywords``, or ``None`` if
+        there is none or it was stored for a different set of files.
+        """
+        with self._connect() as conn:
+            row = conn.execute('SELECT fingerprint, columns, blob '
+                               'FROM summaries WHERE keywords = ? '
+                               'AND ext = ?', (keywords, self._ext)).fetchone()
+        if row is None or row[0] != fingerprint:
+            return None
+        return _summary_from_blob(row[1], row[2])
+
+    def store_summary(self, keywords, fingerprint, summary):
+        """
+        Store a summary table so that a collection of exactly the same
+        files, none of them changed, can be loaded without building it again.
+        """
+        columns, blob = _summary_to_blob(summary)
+        with self._connect() as conn, conn:
+            conn.execute('INSERT OR REPLACE INTO summaries '
+                         '(keywords, ext, fingerprint, columns, blob) '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         (keywords, self._ext, fingerprint, columns, blob))
+
+    def register(self, name, header):
+        """
+        Add or replace the entry for a file using a header that is already
+        in memory, e.g. one that was just written to disk.
+
+        Parameters
+        ----------
+
+        name : str
+            Name of the file, relative to ``location``.
+
+        header : `astropy.io.fits.Header`
+            Header of the file.
+
+        Returns
+        -------
+
+        tuple
+            ``(size, mtime_ns, cards)`` recorded for the file.
+        """
+        size, mtime = self._stat(name)
+        # Values are taken from the header as written so that they are the
+        # same as if the header had been read from the file.
+        cards = header_cards(fits.Header.fromstring(header.tostring()))
+        self._store([(name, size, mtime, cards)])
+        return size, mtime, cards
+
+    def forget(self, names):
+        """
+        Remove files from the index.
+
+        Parameters
+        ----------
+
+        names : list of str
+            Names of the files, relative to ``location``.
+        """
+        with self._connect() as conn, conn:
+            conn.executemany('DELETE FROM headers WHERE name = ? AND ext = ?',
+                             [(name, self._ext) for name in names])
+
+
+class IndexedImageFileCollection(ImageFileCollection):
+    """
+    An `~ccdproc.ImageFileCollection` whose summary is built from a
+    persistent `HeaderIndex`, so that only new or changed files have their
+    headers read.
+
+    It can be used anywhere an `~ccdproc.ImageFileCollection` is used,
+    e.g. in `~reducer.image_browser.ImageBrowser`,
+    `~reducer.astro_gui.Reduction` or `~reducer.astro_gui.Combiner`.
+
+    Parameters
+    ----------
+
+    location : str
+        Directory of images; the index is only used for collections built
+        from a directory.
+
+    index_path : str, optional
+        Name of the index file; see `HeaderIndex`.
+
+    n_threads : int, optional
+        Number of headers read at the same time; see `HeaderIndex`.
+
+    All other parameters are the same as those for
+    `~ccdproc.ImageFileCollection`.
+
+    Notes
+    -----
+
+    Files can be added, and the collection refreshed, summarized and
+    filtered, from several threads at once, e.g. by the tasks of a
+    `~reducer.scheduler.CalibrationScheduler`.
+    """
+    def __init__(self, location=None, *args, **kwd):
+        index_path = kwd.pop('index_path', None)
+        n_threads = kwd.pop('n_threads', DEFAULT_SCAN_THREADS)
+        self._lock = threading.RLock()
+        self._header_cards = {}
+        # Size and modification time of each file in the summary, used to
+        # find changed files when refreshing.
+        self._stats = {}
+        # Header cards of files added with add_file that are not yet in the
+        # summary; they are merged in the next time the summary is used.
+        self._added = OrderedDict()
+        if location and not kwd.get('filenames'):
+            self._index = HeaderIndex(location, index_path=index_path,
+                                      ext=kwd.get('ext', 0),
+                                      n_threads=n_threads)
+        else:
+            self._index = None
+        super(IndexedImageFileCollection, self).__init__(location, *args,
+                                                         **kwd)
+
+    @property
+    def index(self):
+        """
+        The `HeaderIndex` backing this collection, or ``None``.
+        """
+        return self._index
+
+    def _fits_files_in_directory(self, extensions=None, compressed=True):
+        if self._find_fits_by_reading:
+            return super(IndexedImageFileCollection,
+                         self)._fits_files_in_directory(
+                             extensions=extensions, compressed=compressed)
+        # The parent class filters the directory listing once per glob
+        # pattern, of which there are about a hundred; a single combined
+        # pattern selects the same files far faster in large directories.
+        patterns = ['*' + extension for extension in
+                    self._fits_file_extensions(extensions, compressed)]
+        flags = 0 if os.path.normcase('A') == 'A' else re.IGNORECASE
+        matcher = re.compile('|'.join(fnmatch.translate(p) for p in patterns),
+                             flags)
+        files = [name for name in os.listdir(self.location)
+                 if matcher.match(name)]
+        files.sort()
+        return files
+
+    @staticmethod
+    def _fits_file_extensions(extensions, compressed):
+        from ccdproc.ccddata import _recognized_fits_file_extensions
+        full_extensions = extensions or list(_recognized_fits_file_extensions)
+        if compressed:
+            for comp in ['.gz', '.bz2', '.Z', '.zip', '.fz']:
+                with_comp = [extension + comp for extension in full_extensions]
+                full_extensions.extend(with_comp)
+        return full_extensions
+
+    def _fingerprint(self, stats):
+        return hashlib.sha1(json.dumps(stats).encode('utf-8')).hexdigest()
+
+    def _summary_from_index(self, stats, header_keywords):
+        """
+        Build a summary table for the files in ``stats`` from the index.
+        """
+        return self._summary_from_cards(self._index.scan(stats),
+                                        header_keywords)
+
+    def _summary_from_cards(self, cards, header_keywords):
+        """
+        Build a summary table from the header cards of each file.
+        """
+        self._header_cards = cards
+        all_files = self._files
+        self._files = list(cards)
+        try:
+            return super(IndexedImageFileCollection,
+                         self)._fits_summary(header_keywords)
+        finally:
+            self._header_cards = {}
+            self._files = all_files
+
+    def _fits_summary(self, header_keywords):
+        if self._index is None or not self.files:
+            return super(IndexedImageFileCollection,
+                         self)._fits_summary(header_keywords)
+
+        stats = self._index.stat_files(self.files)
+        self._stats = {name: (size, mtime) for name, size, mtime in stats}
+        keywords = _summary_key(header_keywords)
+        fingerprint = self._fingerprint(stats)
+        summary = self._index.load_summary(keywords, fingerprint)
+        if summary is not None:
+            return summary
+
+        summary = self._summary_from_index(stats, header_keywords)
+        if summary is not None:
+            self._index.store_summary(keywords, fingerprint, summary)
+        return summary
+
+    @property
+    def summary(self):
+        """
+        `~astropy.table.Table` of values of FITS keywords for files in the
+        collection, including any added with `add_file`.
+        """
+        with self._lock:
+            self._merge_added()
+            return self._summary
+
+    def files_filtered(self, **kwd):
+        with self._lock:
+            self._merge_added()
+            summary = self._summary
+            if not isinstance(summary, Table):
+                return super(IndexedImageFileCollection,
+                             self).files_filtered(**kwd)
+            # Filtering masks the file column of the summary while it works,
+            # so give it a copy of that column rather than change the one
+            # other threads may be reading.
+            self._summary = Table(summary, copy=False)
+            self._summary.replace_column('file', summary['file'].copy())
+            try:
+                return super(IndexedImageFileCollection,
+                             self).files_filtered(**kwd)
+            finally:
+                self._summary = summary
+
+    def add_file(self, name, header):
+        """
+        Add a file that has just been written to the directory, using the
+        header that is already in memory instead of reading it back.
+
+        The file is recorded in the index and shows up in the summary the
+        next time the summary is used, without anything else in the
+        directory being looked at.
+
+        Parameters
+        ----------
+
+        name : str
+            Name of the file; any directory part is ignored.
+
+        header : `astropy.io.fits.Header`
+            Header of the file as written.
+        """
+        if self._index is None:
+            self.refresh()
+            return
+        name = os.path.basename(name)
+        size, mtime, cards = self._index.register(name, header)
+        with self._lock:
+            self._stats[name] = (size, mtime)
+            self._added.pop(name, None)
+            self._added[name] = cards
+            if name not in self._files:
+                bisect.insort(self._files, name)
+
+    def _merge_added(self):
+        if not self._added:
+            return
+        added = self._added
+        self._added = OrderedDict()
+        summary = self._summary
+        if isinstance(summary, Table) and summary.colnames:
+            keywords = '*' if self._all_keywords else summary.colnames
+            keep = ~np.isin(np.asarray(summary['file']), list(added))
+            summary = summary[keep]
+        elif self._all_keywords:
+            keywords = '*'
+            summary = None
+        else:
+            # No keywords were asked for, so there is no summary to add to.
+            return
+
+        new_rows = self._summary_from_cards(added, keywords)
+        self._summary = _merge_summaries(summary, new_rows, self._files)
+
+    def refresh(self):
+        """
+        Bring the collection up to date with the directory.
+
+        Files that were added, removed or modified since the last refresh
+        are found from the directory listing and the size and modification
+        time of each file; only the headers of new or modified files are
+        read, and the summary rows of all other files are kept as they are.
+        """
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self):
+        self._merge_added()
+        if self._index is None or not self._stats or not self._summary:
+            return super(IndexedImageFileCollection, self).refresh()
+
+        keywords = '*' if self._all_keywords else self.keywords
+        files = self._get_files()
+        stats = self._index.stat_files(files)
+        current = {name: (size, mtime) for name, size, mtime in stats}
+        changed = [stat for stat in stats
+                   if self._stats.get(stat[0]) != stat[1:]]
+        gone = set(self._stats) - set(current)
+        self._files = files
+        if not changed and not gone:
+            return
+
+        drop = gone.union(name for name, _, _ in changed)
+        summary = self._summary
+        keep = ~np.isin(np.asarray(summary['file']), list(drop))
+        new_rows = self._summary_from_index(changed, keywords)
+        summary = _merge_summaries(summary[keep], new_rows, files)
+        if self._all_keywords:
+            # Keywords found only in files that are gone go with them.
+            for name in summary.colnames:
+                if np.all(summary[name].mask):
+                    summary.remove_column(name)
+        self._summary = summary
+        self._stats = current
+        self._index.store_summary(_summary_key(keywords),
+                                  self._fingerprint(stats), self._summary)
+
+    def _dict_from_fits_header(self, file_name, input_summary=None,
+                               missing_marker=None):
+        if self._index is None:
+            return super(IndexedImageFileCollection,
+                         self)._dict_from_fits_header(
+                             file_name, input_summary=input_summary,
+                             missing_marker=missing_marker)
+
+        name = os.path.basename(file_name)
+        try:
+            cards = self._header_cards[name]
+        except KeyError:
+            raise OSError("unable to read header of {}".format(name))
+
+        if input_summary is None:
+            summary = OrderedDict()
+            n_previous = 0
+        else:
+            summary = input_summary
+            n_previous = len(summary['file'])
+
+        try:
+            summary['file'].append(name)
+        except KeyError:
+            summary['file'] = [name]
+
+        for k, v in cards:
+            try:
+                summary[k].append(v)
+            except KeyError:
+                summary[k] = [missing_marker] * n_previous
+                summary[k].append(v)
+
+        # Pad keywords that this file does not have.
+        n_now = n_previous + 1
+        for k, values in summary.items():
+            if len(values) < n_now:
+                values.append(missing_marker)
+
+        return summary
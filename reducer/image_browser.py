@@ -1,13 +1,18 @@
 from collections import OrderedDict
 import os
 from io import BytesIO
+import struct
+import warnings
+import zlib
 
 import numpy as np
 
-import matplotlib.image as mimg
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
 
 from astropy.io import fits
-from astropy.visualization import simple_norm
 from astropy.nddata import block_reduce
 
 
@@ -16,6 +21,7 @@ from ipywidgets import Accordion
 
 import msumastro
 
+from .fits_io import image_hdu_index
 from .notebook_dir import get_data_path
 
 __all__ = [
@@ -23,8 +29,16 @@ __all__ = [
     'FitsViewer',
     'ImageBrowser',
     'ndarray_to_png',
+    'ndarray_to_image',
+    'TilePyramid',
+    'ZoomViewer',
+    'get_tile_pyramid',
 ]
 
+# Image formats the preview encoder can produce; everything but PNG
+# requires Pillow.
+PREVIEW_FORMATS = ('png', 'jpeg', 'webp')
+
 
 class ImageTree(object):
     """
@@ -42,11 +56,11 @@ class ImageTree(object):
         self._tree = tree
         self._id_string = lambda l: os.path.join(*[str(s) for s in l]) if l else ''
         self._gui_objects = OrderedDict()
+        self._file_nodes = {}
+        self._updating = False
         self._top = None
         self._create_gui()
         self._set_titles()
-        # Generate an array to improve initial display time
-        ndarray_to_png(np.random.rand(1200, 1200))
 
     @property
     def top(self):
@@ -105,66 +119,228 @@ class ImageTree(object):
         List nodes monkey with their parents by editing the description to
         include the number of list items in the node.
         """
+        self._top = Accordion()
+        self._top.description = self._key_at(0)
+        self._gui_objects[self._id_string([])] = self._top
         for parents, children, index in self._tree.walk():
             if children and index:
                 # This should be impossible...
                 raise RuntimeError("What the ???")
-            parent_string = self._id_string(parents)
-            depth = len(parents)
-            try:
-                key = self._tree.tree_keys[depth]
-            except IndexError:
-                key = ''
-            if depth == 0:
-                self._top = Accordion()
-                self._top.description = key
-                # self._top.selected_index = -1
-                self._gui_objects[parent_string] = self._top
-
-            parent = self._gui_objects[parent_string]
-
-            # Do I have children? If so, add them as sub-accordions
-            if children:
-                child_objects = []
-                for child in children:
-                    desc = ": ".join([key, str(child)])
-                    child_container = Accordion()
-                    child_container.description = desc
-                    # Make sure all panels start out closed.
-                    # child_container.selected_index = -1
-                    child_container.parent = self._gui_objects[parent_string]
-                    child_string = os.path.join(parent_string, str(child))
-                    self._gui_objects[child_string] = child_container
-                    child_objects.append(child_container)
-                parent.children = child_objects
-            # Do I have only a list? Populate a select box with those...
             if index:
-                new_text = widgets.Select(options=index, value=None)
-                new_text.layout.width = '100%'
-                index_string = self._id_string([parent_string, 'files'])
-                self._gui_objects[index_string] = new_text
-
-                # On the last pass an Accordion will have been created for
-                # this item. We need to replace that Accordion with a Select.
-                # The Select should be inside a box so that we can set a
-                # description on the box that won't be displayed on the
-                # Select. When titles are built for the image viewer tree
-                # later on they are based on the description of the Accordions
-                # and their immediate children.
-                old_parent = parent
-                grandparent = old_parent.parent
-                desc = old_parent.description
-                s_or_not = ['', 's']
-                n_files = len(index)
-                desc += " ({0} image{1})".format(n_files,
-                                                 s_or_not[n_files > 1])
-
-                # Place the box between the Select and the parent Accordion
-                parent = widgets.Box()
-                parent.description = desc
-                parent.children = [new_text]
-                parent.parent = grandparent
-                self._replace_child(grandparent, old=old_parent, new=parent)
+                self._add_to_leaf(parents, index)
+
+    def _key_at(self, depth):
+        try:
+            return self._tree.tree_keys[depth]
+        except IndexError:
+            return ''
+
+    def _insert_child(self, parent, new):
+        """
+        Insert a new child into ``parent``, keeping the children sorted by
+        their value in the tree and the open panel of ``parent`` open.
+        """
+        current_children = list(parent.children)
+        open_child = None
+        if isinstance(parent, Accordion) and parent.selected_index is not None:
+            open_child = current_children[parent.selected_index]
+
+        position = len(current_children)
+        try:
+            for idx, child in enumerate(current_children):
+                if new._tree_value < child._tree_value:
+                    position = idx
+                    break
+        except TypeError:
+            # Values that cannot be compared just go at the end.
+            pass
+
+        current_children.insert(position, new)
+        parent.children = current_children
+        if open_child is not None:
+            parent.selected_index = current_children.index(open_child)
+        self._retitle(parent)
+
+    def _remove_child(self, parent, old):
+        """
+        Remove a child from ``parent``, keeping the open panel (if it is not
+        the one being removed) open.
+        """
+        current_children = list(parent.children)
+        open_child = None
+        if isinstance(parent, Accordion) and parent.selected_index is not None:
+            open_child = current_children[parent.selected_index]
+        current_children = [c for c in current_children if c is not old]
+        if isinstance(parent, Accordion):
+            parent.selected_index = None
+        parent.children = current_children
+        if open_child is not None and open_child is not old:
+            parent.selected_index = current_children.index(open_child)
+        self._retitle(parent)
+
+    def _branch(self, path):
+        """
+        Return the Accordion for the node at ``path``, creating it (and any
+        missing ancestors) if necessary.
+        """
+        branch_string = self._id_string(path)
+        try:
+            return self._gui_objects[branch_string]
+        except KeyError:
+            pass
+
+        parent = self._branch(path[:-1])
+        branch = Accordion()
+        branch.description = ": ".join([self._key_at(len(path) - 1),
+                                        str(path[-1])])
+        branch.parent = parent
+        branch._tree_value = path[-1]
+        self._gui_objects[branch_string] = branch
+        self._insert_child(parent, branch)
+        return branch
+
+    def _leaf(self, path):
+        """
+        Return the Select for the list node at ``path``, creating it if
+        necessary. The second return value is ``True`` if the Select is new.
+        """
+        index_string = self._id_string([self._id_string(path), 'files'])
+        try:
+            return self._gui_objects[index_string], False
+        except KeyError:
+            pass
+
+        new_text = widgets.Select(options=[], value=None)
+        new_text.layout.width = '100%'
+        self._gui_objects[index_string] = new_text
+
+        # The Select should be inside a box so that we can set a
+        # description on the box that won't be displayed on the
+        # Select. When titles are built for the image viewer tree
+        # later on they are based on the description of the Accordions
+        # and their immediate children.
+        parent = self._branch(path[:-1])
+        box = widgets.Box()
+        box.base_description = ": ".join([self._key_at(len(path) - 1),
+                                          str(path[-1])])
+        box.description = box.base_description
+        box.children = [new_text]
+        box.parent = parent
+        new_text.parent = box
+        box._tree_value = path[-1]
+        self._gui_objects[self._id_string(path)] = box
+        self._insert_child(parent, box)
+        return new_text, True
+
+    def _set_leaf_options(self, select, options):
+        """
+        Change the options of a Select without changing the file that is
+        selected, and update the image count in the description of the
+        box holding it.
+        """
+        current = select.value
+        self._updating = True
+        try:
+            select.options = options
+            select.value = current if current in options else None
+        finally:
+            self._updating = False
+
+        box = select.parent
+        s_or_not = ['', 's']
+        n_files = len(options)
+        box.description = (box.base_description +
+                           " ({0} image{1})".format(n_files,
+                                                     s_or_not[n_files > 1]))
+        self._retitle(box.parent)
+
+    def _add_to_leaf(self, path, files):
+        """
+        Add files to the list node at ``path``. Returns the Select if it was
+        created by this call, ``None`` otherwise.
+        """
+        select, is_new = self._leaf(path)
+        options = list(select.options) + list(files)
+        if not is_new:
+            options.sort()
+        self._set_leaf_options(select, options)
+        for name in files:
+            self._file_nodes[name] = list(path)
+        return select if is_new else None
+
+    def _prune(self, path):
+        """
+        Remove the node at ``path`` and any ancestors left without children.
+        """
+        while path:
+            node_string = self._id_string(path)
+            node = self._gui_objects[node_string]
+            if isinstance(node, Accordion) and node.children:
+                return
+            self._remove_child(node.parent, node)
+            del self._gui_objects[node_string]
+            self._gui_objects.pop(self._id_string([node_string, 'files']),
+                                  None)
+            path = path[:-1]
+
+    @property
+    def updating(self):
+        """
+        ``True`` while the options of a list node are being changed by
+        the tree itself rather than by the user.
+        """
+        return self._updating
+
+    def add_files(self, placements):
+        """
+        Add files to the tree, creating only the nodes needed to hold them.
+
+        Parameters
+        ----------
+
+        placements : dict
+            Keys are file names, values are the sequence of values of the
+            tree keys for that file, i.e. the path to the file in the tree.
+
+        Returns
+        -------
+
+        list
+            The ``Select`` widgets created for new list nodes.
+        """
+        by_path = OrderedDict()
+        for name, path in placements.items():
+            by_path.setdefault(tuple(path), []).append(name)
+        new_selects = []
+        for path, files in by_path.items():
+            new = self._add_to_leaf(list(path), files)
+            if new is not None:
+                new_selects.append(new)
+        return new_selects
+
+    def remove_files(self, names):
+        """
+        Remove files from the tree, dropping any node left empty.
+
+        Parameters
+        ----------
+
+        names : list of str
+            Names of the files to remove.
+        """
+        by_path = OrderedDict()
+        for name in names:
+            path = self._file_nodes.pop(name, None)
+            if path is not None:
+                by_path.setdefault(tuple(path), set()).add(name)
+        for path, files in by_path.items():
+            path = list(path)
+            select, _ = self._leaf(path)
+            remaining = [f for f in select.options if f not in files]
+            if remaining:
+                self._set_leaf_options(select, remaining)
+            else:
+                self._prune(path)
 
     def display(self):
         """
@@ -181,9 +357,12 @@ class ImageTree(object):
         """
         for name, obj in self._gui_objects.items():
             if isinstance(obj, Accordion):
-                for idx, child in enumerate(obj.children):
-                    if not isinstance(child, widgets.Select):
-                        obj.set_title(idx, child.description)
+                self._retitle(obj)
+
+    def _retitle(self, accordion):
+        for idx, child in enumerate(accordion.children):
+            if not isinstance(child, widgets.Select):
+                accordion.set_title(idx, child.description)
 
     def format(self):
         """
@@ -203,47 +382,580 @@ class ImageTree(object):
                         child.children[0].width = "15em"
 
 
-def ndarray_to_png(x, min_percent=20, max_percent=99.5):
+def _percentile_limits(x, min_percent, max_percent):
+    """
+    Values at two percentiles of the finite pixels of an image, or ``None``
+    if there are no finite pixels.
+    """
+    finite = np.isfinite(x)
+    values = x if finite.all() else x[finite]
+    if values.size == 0:
+        return None
+    return np.percentile(values, [min_percent, max_percent])
+
+
+def _scale_to_uint8(x, min_percent, max_percent, limits=None):
+    """
+    Scale an image linearly between two percentiles (or between the values
+    in ``limits``, if given) into 8-bit grayscale, with NaNs shown as black
+    pixels.
+    """
+    if limits is None:
+        limits = _percentile_limits(x, min_percent, max_percent)
+    if limits is None:
+        return np.zeros(x.shape, dtype=np.uint8)
+    finite = np.isfinite(x)
+    all_finite = finite.all()
+    low, high = limits
+    span = high - low
+    scale = 255 / span if span > 0 else 0
+    scaled = np.subtract(x, low, dtype=np.float32)
+    scaled *= scale
+    np.clip(scaled, 0, 255, out=scaled)
+    if not all_finite:
+        scaled[~finite] = 0
+    # Round rather than truncate so that the brightest pixels are white.
+    scaled += 0.5
+    return scaled.astype(np.uint8)
+
+
+def _encode_png_gray(x, compress_level):
+    """
+    Write an 8-bit grayscale array as a PNG without any third-party help.
+    """
+    def chunk(tag, payload):
+        return (struct.pack('>I', len(payload)) + tag + payload +
+                struct.pack('>I', zlib.crc32(tag + payload) & 0xffffffff))
+
+    height, width = x.shape
+    # Each scanline is preceded by its filter type, 0 (no filtering).
+    raw = np.zeros((height, width + 1), dtype=np.uint8)
+    raw[:, 1:] = x
+    header = struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)
+    return b''.join([b'\x89PNG\r\n\x1a\n',
+                     chunk(b'IHDR', header),
+                     chunk(b'IDAT', zlib.compress(raw.tobytes(),
+                                                  compress_level)),
+                     chunk(b'IEND', b'')])
+
+
+def ndarray_to_image(x, min_percent=20, max_percent=99.5, format='png',
+                     compress_level=1, quality=85, width=600):
+    """
+    Encode a two-dimensional array as an 8-bit grayscale preview image.
+
+    Parameters
+    ----------
+
+    x : numpy array
+        Image data.
+
+    min_percent, max_percent : float, optional
+        Percentiles of the data mapped to black and white.
+
+    format : {'png', 'jpeg', 'webp'}, optional
+        Output format. JPEG and WebP require Pillow.
+
+    compress_level : int, optional
+        zlib compression level, 0-9, for PNG output. Low levels are much
+        faster and only a little larger for noisy astronomical images.
+
+    quality : int, optional
+        Quality, 1-100, for JPEG and WebP output.
+
+    width : int, optional
+        The image is block-averaged until it is no wider than this.
+
+    Returns
+    -------
+
+    bytes or None
+        The encoded image, or ``None`` if ``x`` is not two-dimensional.
+    """
+    format = format.lower()
+    if format not in PREVIEW_FORMATS:
+        raise ValueError("format must be one of {}".format(PREVIEW_FORMATS))
+    if format != 'png' and PILImage is None:
+        raise ValueError("Pillow is required for {} output".format(format))
+
     shape = np.array(x.shape)
     # Reverse order for reasons I do not understand...
     shape = shape[::-1]
     if len(shape) != 2:
         return
 
-    width = 600  # pixels
     downsample = (shape[0] // width) + 1
 
     if downsample > 1:
         x = block_reduce(x,
                          block_size=(downsample, downsample))
 
-    norm = simple_norm(x,
-                       min_percent=min_percent,
-                       max_percent=max_percent,
-                       clip=True)
+    x = _scale_to_uint8(x, min_percent, max_percent)
+    return _encode_uint8(x, format, compress_level, quality)
+
+
+def _encode_uint8(x, format, compress_level, quality):
+    """
+    Encode an 8-bit grayscale array in the given format.
+    """
+    if PILImage is None:
+        return _encode_png_gray(x, compress_level)
 
-    x = norm(x)
-    # Replace NaNs with black pixels
-    x = np.nan_to_num(x)
     img_buffer = BytesIO()
-    mimg.imsave(img_buffer, x, format='png', cmap='gray')
+    image = PILImage.fromarray(x)
+    if format == 'png':
+        image.save(img_buffer, format='png', compress_level=compress_level)
+    else:
+        image.save(img_buffer, format=format, quality=quality)
     return img_buffer.getvalue()
 
 
+def ndarray_to_png(x, min_percent=20, max_percent=99.5, compress_level=1):
+    """
+    Encode a two-dimensional array as an 8-bit grayscale PNG.
+
+    See `ndarray_to_image` for a description of the parameters.
+    """
+    return ndarray_to_image(x, min_percent=min_percent,
+                            max_percent=max_percent, format='png',
+                            compress_level=compress_level)
+
+
+def _halve(x):
+    """
+    Average 2x2 blocks of an array, repeating the last row/column of arrays
+    with an odd number of them.
+    """
+    if x.shape[0] % 2:
+        x = np.concatenate([x, x[-1:, :]], axis=0)
+    if x.shape[1] % 2:
+        x = np.concatenate([x, x[:, -1:]], axis=1)
+    halved = x[::2, ::2] + x[1::2, ::2]
+    halved += x[::2, 1::2]
+    halved += x[1::2, 1::2]
+    halved *= 0.25
+    return halved
+
+
+class TilePyramid(object):
+    """
+    Multi-resolution tiles of an image, built on demand from a
+    memory-mapped FITS file.
+
+    Level 0 is the full-resolution image, and each level above it is
+    downsampled by a further factor of two; the top level fits in a single
+    tile. A tile is only read (or averaged from the tiles below it) the
+    first time it is requested, and the most recently used tiles are kept
+    in memory.
+
+    Parameters
+    ----------
+
+    path : str
+        Name of the FITS file.
+
+    ext : int, optional
+        Extension containing the image.
+
+    tile_size : int, optional
+        Width and height of a tile, in pixels.
+
+    min_percent, max_percent : float, optional
+        Percentiles of the whole image mapped to black and white in every
+        tile, so that adjacent tiles match.
+
+    image_format, compress_level, quality : optional
+        Encoding of the tiles; see `ndarray_to_image`.
+
+    max_tiles : int, optional
+        Maximum number of tiles at each stage (data and encoded) to keep in
+        memory.
+    """
+    def __init__(self, path, ext=0, tile_size=256, min_percent=20,
+                 max_percent=99.5, image_format='png', compress_level=1,
+                 quality=85, max_tiles=256):
+        self._hdulist = fits.open(path, memmap=True,
+                                  do_not_scale_image_data=True)
+        if ext == 0:
+            # A tile-compressed image is in the first extension.
+            ext = image_hdu_index(self._hdulist)
+        hdu = self._hdulist[ext]
+        if hdu.data is None or hdu.data.ndim != 2:
+            self.close()
+            raise ValueError("{} does not contain a two-dimensional "
+                             "image".format(path))
+        self._raw = hdu.data
+        self._bscale = hdu.header.get('BSCALE', 1)
+        self._bzero = hdu.header.get('BZERO', 0)
+        self._tile_size = tile_size
+        self._format = image_format
+        self._compress_level = compress_level
+        self._quality = quality
+        self._max_tiles = max_tiles
+        self._arrays = OrderedDict()
+        self._encoded = OrderedDict()
+
+        longest = max(self.shape)
+        self._n_levels = 1
+        while longest > tile_size:
+            longest = (longest + 1) // 2
+            self._n_levels += 1
+
+        # Set the display limits from a subsample of the image so that the
+        # whole file does not need to be read just to get started.
+        step = max(1, int(np.sqrt(self._raw.size / 1e6)))
+        sample = self._scaled(self._raw[::step, ::step])
+        self._limits = _percentile_limits(sample, min_percent, max_percent)
+
+    @property
+    def shape(self):
+        """
+        Shape of the full-resolution image.
+        """
+        return self._raw.shape
+
+    @property
+    def tile_size(self):
+        return self._tile_size
+
+    @property
+    def n_levels(self):
+        """
+        Number of levels in the pyramid.
+        """
+        return self._n_levels
+
+    def close(self):
+        """
+        Release the memory-mapped file.
+        """
+        self._hdulist.close()
+        self._raw = None
+        self._arrays.clear()
+        self._encoded.clear()
+
+    def _scaled(self, raw):
+        scaled = np.asarray(raw, dtype=np.float32)
+        if self._bscale != 1:
+            scaled = scaled * np.float32(self._bscale)
+        if self._bzero != 0:
+            scaled = scaled + np.float32(self._bzero)
+        return scaled
+
+    def level_shape(self, level):
+        """
+        Shape of the image at ``level``.
+        """
+        rows, cols = self.shape
+        for _ in range(level):
+            rows, cols = (rows + 1) // 2, (cols + 1) // 2
+        return rows, cols
+
+    def grid_shape(self, level):
+        """
+        Number of rows and columns of tiles at ``level``.
+        """
+        rows, cols = self.level_shape(level)
+        return (-(-rows // self._tile_size), -(-cols // self._tile_size))
+
+    def _remember(self, cache, key, value):
+        cache[key] = value
+        while len(cache) > self._max_tiles:
+            cache.popitem(last=False)
+
+    def tile_data(self, level, row, col):
+        """
+        Pixel values of one tile, as a float32 array.
+        """
+        key = (level, row, col)
+        try:
+            self._arrays.move_to_end(key)
+            return self._arrays[key]
+        except KeyError:
+            pass
+
+        n_rows, n_cols = self.grid_shape(level)
+        if not (0 <= row < n_rows and 0 <= col < n_cols):
+            raise IndexError("No tile {} at level {}".format((row, col),
+                                                              level))
+        size = self._tile_size
+        if level == 0:
+            tile = self._scaled(self._raw[row * size:(row + 1) * size,
+                                          col * size:(col + 1) * size])
+        else:
+            below_rows, below_cols = self.grid_shape(level - 1)
+            blocks = []
+            for r in (2 * row, 2 * row + 1):
+                if r >= below_rows:
+                    continue
+                blocks.append([self.tile_data(level - 1, r, c)
+                               for c in (2 * col, 2 * col + 1)
+                               if c < below_cols])
+            tile = _halve(np.block(blocks))
+        self._remember(self._arrays, key, tile)
+        return tile
+
+    def tile(self, level, row, col):
+        """
+        One tile, encoded as an image.
+
+        Parameters
+        ----------
+
+        level : int
+            Level in the pyramid; 0 is full resolution.
+
+        row, col : int
+            Position of the tile in the grid of tiles at that level.
+
+        Returns
+        -------
+
+        bytes
+            The encoded tile.
+        """
+        key = (level, row, col)
+        try:
+            self._encoded.move_to_end(key)
+            return self._encoded[key]
+        except KeyError:
+            pass
+        scaled = _scale_to_uint8(self.tile_data(level, row, col), None, None,
+                                 limits=self._limits)
+        encoded = _encode_uint8(scaled, self._format, self._compress_level,
+                                self._quality)
+        self._remember(self._encoded, key, encoded)
+        return encoded
+
+
+# Pyramids of recently viewed files, keyed by file name, size and
+# modification time so that a file that changes on disk is rebuilt.
+_PYRAMID_CACHE = OrderedDict()
+PYRAMID_CACHE_SIZE = 4
+
+
+def get_tile_pyramid(path, **kwd):
+    """
+    Return the `TilePyramid` for a file, reusing one built earlier if the
+    file has not changed.
+
+    Parameters
+    ----------
+
+    path : str
+        Name of the FITS file.
+
+    kwd :
+        Passed on to `TilePyramid` when a new pyramid is built.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns,
+           tuple(sorted(kwd.items())))
+    try:
+        _PYRAMID_CACHE.move_to_end(key)
+        return _PYRAMID_CACHE[key]
+    except KeyError:
+        pass
+    pyramid = TilePyramid(path, **kwd)
+    _PYRAMID_CACHE[key] = pyramid
+    while len(_PYRAMID_CACHE) > PYRAMID_CACHE_SIZE:
+        _, old = _PYRAMID_CACHE.popitem(last=False)
+        old.close()
+    return pyramid
+
+
+class ZoomViewer(object):
+    """
+    Zoom and pan around an image, sending only the visible tiles of a
+    `TilePyramid` to the browser.
+
+    Parameters
+    ----------
+
+    tile_size : int, optional
+        Width and height of a tile, in pixels.
+
+    viewport : tuple of int, optional
+        Number of rows and columns of tiles shown at once.
+
+    image_format : {'png', 'jpeg', 'webp'}, optional
+        Format of the tiles.
+
+    max_widgets : int, optional
+        Maximum number of tile widgets kept around; tiles whose widgets are
+        kept are not sent to the browser again when they come back into
+        view.
+    """
+    def __init__(self, tile_size=256, viewport=(2, 3), image_format='png',
+                 max_widgets=64):
+        self._tile_size = tile_size
+        self._viewport = viewport
+        self._image_format = image_format
+        self._max_widgets = max_widgets
+        self._path = None
+        self._pyramid = None
+        self._level = 0
+        self._row = 0
+        self._col = 0
+        self._tile_widgets = OrderedDict()
+
+        self._buttons = OrderedDict()
+        for name, desc in [('zoom_in', '+'), ('zoom_out', '-'),
+                           ('left', 'left'), ('right', 'right'),
+                           ('up', 'up'), ('down', 'down')]:
+            button = widgets.Button(description=desc)
+            button.layout.width = '4em'
+            button.on_click(self._move(name))
+            self._buttons[name] = button
+        self._position = widgets.Label()
+        self._controls = widgets.HBox(list(self._buttons.values()) +
+                                      [self._position])
+        self._grid = widgets.GridBox()
+        self._grid.layout.grid_gap = '0px'
+        self._top = widgets.VBox([self._controls, self._grid])
+
+    @property
+    def top(self):
+        return self._top
+
+    def set_file(self, path):
+        """
+        Set the file to view; nothing is read until `show` is called.
+        """
+        if path != self._path:
+            self._path = path
+            self._pyramid = None
+            for widget in self._tile_widgets.values():
+                widget.close()
+            self._tile_widgets.clear()
+            self._grid.children = []
+
+    def show(self):
+        """
+        Display the file, starting from the whole image at the coarsest
+        level.
+        """
+        if self._path is None or self._pyramid is not None:
+            return
+        self._pyramid = get_tile_pyramid(self._path,
+                                         tile_size=self._tile_size,
+                                         image_format=self._image_format)
+        self._level = self._pyramid.n_levels - 1
+        self._row = self._col = 0
+        self._render()
+
+    def _move(self, direction):
+        def handler(b):
+            if self._pyramid is None:
+                return
+            view_rows, view_cols = self._viewport
+            if direction in ('zoom_in', 'zoom_out'):
+                # Keep the center of the view in the center.
+                center_row = self._row + view_rows / 2
+                center_col = self._col + view_cols / 2
+                if direction == 'zoom_in' and self._level > 0:
+                    self._level -= 1
+                    center_row, center_col = 2 * center_row, 2 * center_col
+                elif (direction == 'zoom_out' and
+                      self._level < self._pyramid.n_levels - 1):
+                    self._level += 1
+                    center_row, center_col = center_row / 2, center_col / 2
+                self._row = int(center_row - view_rows / 2)
+                self._col = int(center_col - view_cols / 2)
+            elif direction == 'left':
+                self._col -= 1
+            elif direction == 'right':
+                self._col += 1
+            elif direction == 'up':
+                self._row -= 1
+            elif direction == 'down':
+                self._row += 1
+            self._render()
+        return handler
+
+    def _tile_widget(self, level, row, col):
+        key = (level, row, col)
+        try:
+            self._tile_widgets.move_to_end(key)
+            return self._tile_widgets[key]
+        except KeyError:
+            pass
+        data = self._pyramid.tile_data(level, row, col)
+        widget = widgets.Image(value=self._pyramid.tile(level, row, col),
+                               format=self._image_format)
+        widget.layout.width = '{}px'.format(data.shape[1])
+        widget.layout.height = '{}px'.format(data.shape[0])
+        self._tile_widgets[key] = widget
+        while len(self._tile_widgets) > self._max_widgets:
+            _, old = self._tile_widgets.popitem(last=False)
+            old.close()
+        return widget
+
+    def _render(self):
+        n_rows, n_cols = self._pyramid.grid_shape(self._level)
+        view_rows = min(self._viewport[0], n_rows)
+        view_cols = min(self._viewport[1], n_cols)
+        self._row = min(max(self._row, 0), n_rows - view_rows)
+        self._col = min(max(self._col, 0), n_cols - view_cols)
+
+        tiles = [self._tile_widget(self._level, row, col)
+                 for row in range(self._row, self._row + view_rows)
+                 for col in range(self._col, self._col + view_cols)]
+        self._grid.layout.grid_template_columns = \
+            ' '.join(['auto'] * view_cols)
+        self._grid.children = tiles
+
+        self._buttons['zoom_in'].disabled = self._level == 0
+        self._buttons['zoom_out'].disabled = \
+            self._level == self._pyramid.n_levels - 1
+        self._buttons['left'].disabled = self._col == 0
+        self._buttons['right'].disabled = self._col + view_cols >= n_cols
+        self._buttons['up'].disabled = self._row == 0
+        self._buttons['down'].disabled = self._row + view_rows >= n_rows
+        self._position.value = "Zoom 1:{}".format(2 ** self._level)
+
+
 class FitsViewer(object):
     """
     Display the image and header from a single FITS file.
 
+    Parameters
+    ----------
+
+    image_format : {'png', 'jpeg', 'webp'}, optional
+        Format used to send the preview to the browser. JPEG and WebP are
+        much smaller than PNG but need Pillow; without it PNG is used.
 
+    compress_level : int, optional
+        zlib compression level for PNG previews.
+
+    quality : int, optional
+        Quality for JPEG and WebP previews.
+
+    tile_size : int, optional
+        Size of the tiles in the zoom view; see `ZoomViewer`.
     """
-    def __init__(self):
+    def __init__(self, image_format='png', compress_level=1, quality=85,
+                 tile_size=256):
+        image_format = image_format.lower()
+        if image_format not in PREVIEW_FORMATS:
+            raise ValueError("image_format must be one of "
+                             "{}".format(PREVIEW_FORMATS))
+        if image_format != 'png' and PILImage is None:
+            warnings.warn("Pillow is not installed, so previews will be PNG "
+                          "instead of {}".format(image_format))
+            image_format = 'png'
+        self._image_format = image_format
+        self._compress_level = compress_level
+        self._quality = quality
+
         self._top = widgets.Tab(visible=False)
         self._data = None  # hdu.data
         self._png_image = None  # ndarray_to_png(self._data)
         self._header = ''
 
         self._image_box = widgets.VBox()
-        self._image = widgets.Image()
+        self._image = widgets.Image(format=image_format)
         # Do this so the initial display looks ok.
         self._image.layout.min_width = '400px'
         self._image_title = widgets.Label()
@@ -254,7 +966,12 @@ class FitsViewer(object):
         self._header_display.layout.width = '50rem'
         self._header_display.layout.height = '20rem'
         self._header_box.children = [self._header_display]
-        self._top.children = [self._image_box, self._header_box]
+
+        # The zoom view only reads the file when its tab is opened.
+        self._zoom = ZoomViewer(tile_size=tile_size, image_format=image_format)
+        self._top.children = [self._image_box, self._header_box,
+                              self._zoom.top]
+        self._top.observe(self._show_zoom, str('selected_index'))
 
     @property
     def top(self):
@@ -277,6 +994,7 @@ class FitsViewer(object):
         """
         self._top.set_title(0, 'Image')
         self._top.set_title(1, 'Header')
+        self._top.set_title(2, 'Zoom')
         self._header_display.height = '400px'
         self._header_display.width = '500px'
 
@@ -289,6 +1007,10 @@ class FitsViewer(object):
         self._header_box.align = "center"
         self._header_box.padding = "10px"
 
+    def _show_zoom(self, change):
+        if change['new'] == 2:
+            self._zoom.show()
+
     def set_fits_file_callback(self, demo=True, image_dir=None):
         """
         Returns a callback function that sets the name of FITS file to
@@ -320,12 +1042,18 @@ class FitsViewer(object):
                 else:
                     full_path = fits_file
             with fits.open(full_path) as hdulist:
-                hdu = hdulist[0]
+                hdu = hdulist[image_hdu_index(hdulist)]
                 self._data = hdu.data
                 self._header = hdu.header
             self._header_display.value = repr(self._header)
-            self._image.value = ndarray_to_png(self._data)
+            self._image.value = ndarray_to_image(self._data,
+                                                 format=self._image_format,
+                                                 compress_level=self._compress_level,
+                                                 quality=self._quality)
             self._image_title.value = os.path.basename(full_path)
+            self._zoom.set_file(full_path)
+            if self._top.selected_index == 2:
+                self._zoom.show()
             self.top.visible = True
 
         return set_fits_file
@@ -340,23 +1068,70 @@ class ImageBrowser(widgets.Box):
 
     collection : `ccdproc.ImageFileCollection`
         Directory of images.
+
+    image_format : {'png', 'jpeg', 'webp'}, optional
+        Format of the image previews; see `FitsViewer`.
     """
     def __init__(self, collection, allow_missing=True, *args, **kwd):
         self._directory = collection.location
         self._demo = kwd.pop('demo', False)
+        image_format = kwd.pop('image_format', 'png')
         self._tree_keys = kwd.pop('keys', [])
+        self._allow_missing = allow_missing
         missing = 'No value' if allow_missing else None
+        self._placements = self._placements_from(collection.summary)
         tree = msumastro.TableTree(collection.summary, self._tree_keys, 'file',
                                    fill_missing=missing)
         kwd['orientation'] = 'horizontal'
         super(ImageBrowser, self).__init__(*args, **kwd)
         self._tree_widget = ImageTree(tree)
-        self._fits_display = FitsViewer()
+        self._fits_display = FitsViewer(image_format=image_format)
         self._fits_display.top.visible = False
         self.children = [self.tree_widget, self.fits_display]
         # Connect the select boxes to the image displayer
         self._add_handler(self.tree_widget)
 
+    def _placements_from(self, summary):
+        """
+        Map each file in the summary table to its path in the tree.
+        """
+        columns = []
+        for key in self._tree_keys:
+            column = summary[key]
+            mask = getattr(column, 'mask', None)
+            if self._allow_missing and mask is not None and mask.any():
+                column = column.filled('No ' + key)
+            columns.append(column.tolist())
+        return OrderedDict((name, tuple(path)) for name, path in
+                           zip(summary['file'].tolist(), zip(*columns)))
+
+    def update(self, collection):
+        """
+        Bring the browser up to date with a refreshed collection.
+
+        Only the tree nodes holding files that were added, removed or whose
+        tree keywords changed are touched; open panels and the currently
+        displayed image are left alone.
+
+        Parameters
+        ----------
+
+        collection : `ccdproc.ImageFileCollection`
+            The collection the browser was created from, after it has been
+            refreshed.
+        """
+        new_placements = self._placements_from(collection.summary)
+        removed = [name for name, path in self._placements.items()
+                   if new_placements.get(name) != path]
+        added = OrderedDict((name, path)
+                            for name, path in new_placements.items()
+                            if self._placements.get(name) != path)
+        self._tree_widget.remove_files(removed)
+        new_selects = self._tree_widget.add_files(added)
+        for select in new_selects:
+            self._add_handler(select)
+        self._placements = new_placements
+
     @property
     def tree_widget(self):
         """
@@ -402,10 +1177,18 @@ class ImageBrowser(widgets.Box):
 
     def _add_handler(self, node):
         if isinstance(node, widgets.Select):
-            node.on_trait_change(
+            set_fits_file = \
                 self._fits_display.set_fits_file_callback(demo=self._demo,
-                                                          image_dir=self._directory),
-                str('value'))
+                                                          image_dir=self._directory)
+
+            def handler(name, fits_file):
+                # Option changes made while the tree is being updated are
+                # not selections by the user.
+                if self._tree_widget.updating or fits_file is None:
+                    return
+                set_fits_file(name, fits_file)
+
+            node.on_trait_change(handler, str('value'))
             return
         if hasattr(node, 'children'):
             for child in node.children:
@@ -0,0 +1,323 @@
+from collections import namedtuple
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import ccdproc
+from astropy import units as u
+from astropy.io import fits
+from astropy.modeling import models
+
+from .fits_io import image_hdu_index
+
+__all__ = [
+    'DEFAULT_RATES',
+    'Plan',
+    'header_bytes',
+    'image_geometry',
+    'load_rates',
+    'measure_rates',
+    'save_rates',
+]
+
+# Throughput of each part of a reduction on a single core, measured with
+# measure_rates on 1024 x 1024 float32 images, except that ``read`` and
+# ``write`` are for a local disk rather than the page cache. ``read`` and
+# ``write`` are in bytes per second, the rest in pixels per second; cosmic ray
+# rates are for one pass, and ``combine`` and ``dark_model`` count every
+# pixel of every image used. These are rough figures for a modest machine;
+# record rates on the machine that will do the work with measure_rates and
+# save_rates.
+DEFAULT_RATES = {
+    'read': 5e8,
+    'write': 3e8,
+    'overscan': 2e8,
+    'trim': 2e9,
+    'bias': 5e8,
+    'dark': 3e8,
+    'flat': 2e8,
+    'cosmic_ray_median': 5e5,
+    'cosmic_ray_lacosmic': 2e6,
+    'combine': 1e7,
+    'dark_model': 2e8,
+}
+
+_BITPIX_DTYPES = {
+    8: 'uint8',
+    16: 'int16',
+    32: 'int32',
+    64: 'int64',
+    -32: 'float32',
+    -64: 'float64',
+}
+
+
+def _data_dtype(header):
+    """
+    Type of the data astropy returns for an image with this header, taking
+    ``BSCALE`` and ``BZERO`` into account.
+    """
+    bitpix = header['BITPIX']
+    dtype = np.dtype(_BITPIX_DTYPES[bitpix])
+    bscale = header.get('BSCALE', 1)
+    bzero = header.get('BZERO', 0)
+    if bitpix < 0 or (bscale == 1 and bzero == 0):
+        return dtype
+    if bscale == 1 and bitpix > 8 and bzero == 2 ** (bitpix - 1):
+        return np.dtype('u{}'.format(dtype.itemsize))
+    if bscale == 1 and bitpix == 8 and bzero == -128:
+        return np.dtype('int8')
+    return np.dtype('float32' if bitpix <= 16 else 'float64')
+
+
+def image_geometry(path, ext=None):
+    """
+    Shape and data type of the image in a FITS file, from its header alone.
+
+    Parameters
+    ----------
+
+    path : str
+        Name of the file.
+
+    ext : int or str, optional
+        HDU holding the image; by default the primary HDU, or the first
+        extension with an image if the primary HDU is empty, e.g. for
+        tile-compressed files.
+
+    Returns
+    -------
+
+    shape : tuple of int
+
+    dtype : `numpy.dtype`
+        Type of the data as read by astropy, after any scaling.
+
+    header : `astropy.io.fits.Header`
+    """
+    with fits.open(path) as hdulist:
+        if ext is None:
+            index = image_hdu_index(hdulist)
+        else:
+            index = hdulist.index_of(ext)
+        header = hdulist[index].header
+        n_axes = header.get('NAXIS', 0)
+        shape = tuple(header['NAXIS{}'.format(axis)]
+                      for axis in range(n_axes, 0, -1))
+        return shape, _data_dtype(header), header.copy()
+
+
+def header_bytes(header, extra_cards=0):
+    """
+    Number of bytes a header takes in a FITS file, with room for
+    ``extra_cards`` more cards.
+    """
+    n_bytes = (len(header) + extra_cards + 1) * 80
+    return 2880 * -(-n_bytes // 2880)
+
+
+def load_rates(path):
+    """
+    Read rates saved with `save_rates`.
+
+    Rates that were not saved are taken from `DEFAULT_RATES`.
+
+    Returns
+    -------
+
+    dict
+    """
+    rates = dict(DEFAULT_RATES)
+    with open(path) as f:
+        rates.update(json.load(f))
+    return rates
+
+
+def save_rates(rates, path):
+    """
+    Save rates, e.g. from `measure_rates`, as JSON.
+    """
+    with open(path, 'w') as f:
+        json.dump(rates, f, indent=2, sort_keys=True)
+
+
+def _timed(function, *args, **kwd):
+    start = time.perf_counter()
+    function(*args, **kwd)
+    return time.perf_counter() - start
+
+
+def measure_rates(shape=(1024, 1024), n_images=5, directory=None):
+    """
+    Measure the rates used to estimate run times on this machine by timing
+    each part of a reduction on synthetic images.
+
+    Parameters
+    ----------
+
+    shape : tuple of int, optional
+        Shape of the images.
+
+    n_images : int, optional
+        Number of images read, written and combined.
+
+    directory : str, optional
+        Directory in which the images are written and read; a temporary
+        directory by default. Use a directory on the disk the reduction
+        will use. Files read just after being written are usually in the
+        page cache, so the read rate is that of files read more than once.
+
+    Returns
+    -------
+
+    dict
+        Rates with the same keys as `DEFAULT_RATES`; rates of cosmic ray
+        rejection methods that cannot be used here are not included.
+    """
+    from .calibration import (DarkModel, flat_correct, subtract_dark,
+                              subtract_overscan)
+    from .cosmic_ray import cosmicray_clean
+
+    random = np.random.default_rng(0)
+    n_pixels = shape[0] * shape[1]
+    images = []
+    for idx in range(n_images):
+        data = random.normal(1000, 10, size=shape).astype('float32')
+        ccd = ccdproc.CCDData(data, unit='adu')
+        ccd.header['exposure'] = 10.0 * (idx + 1)
+        images.append(ccd)
+    image = images[0]
+    master = ccdproc.CCDData(images[1].data.astype('float64'), unit='adu')
+    master.header['exposure'] = 10.0
+
+    rates = {}
+    work_dir = tempfile.mkdtemp(dir=directory)
+    try:
+        paths = [os.path.join(work_dir, 'image{}.fit'.format(idx))
+                 for idx in range(n_images)]
+        n_bytes = n_images * image.data.nbytes
+        rates['write'] = n_bytes / sum(
+            _timed(fits.writeto, path, ccd.data)
+            for path, ccd in zip(paths, images))
+        rates['read'] = n_bytes / sum(
+            _timed(fits.getdata, path, memmap=False) for path in paths)
+    finally:
+        shutil.rmtree(work_dir)
+
+    overscan_columns = max(shape[1] // 32, 1)
+    rates['overscan'] = n_pixels / _timed(
+        subtract_overscan, image, overscan=image[:, :overscan_columns],
+        model=models.Polynomial1D(1))
+    rates['trim'] = n_pixels / _timed(ccdproc.trim_image,
+                                      image[:, overscan_columns:])
+    rates['bias'] = n_pixels / _timed(ccdproc.subtract_bias, image, master)
+    rates['dark'] = n_pixels / _timed(subtract_dark, image, master,
+                                      exposure_time='exposure',
+                                      exposure_unit=u.second, scale=True)
+    rates['flat'] = n_pixels / _timed(flat_correct, image, master)
+    rates['cosmic_ray_median'] = n_pixels / _timed(
+        cosmicray_clean, image, method='median', max_iter=1, n_threads=1)
+    try:
+        import astroscrappy  # noqa
+    except ImportError:
+        pass
+    else:
+        rates['cosmic_ray_lacosmic'] = n_pixels / _timed(
+            cosmicray_clean, image, method='lacosmic', max_iter=1,
+            n_threads=1)
+    rates['combine'] = n_images * n_pixels / _timed(
+        ccdproc.combine, images, method='median')
+    rates['dark_model'] = n_images * n_pixels / _timed(
+        DarkModel.fit, images, exposure_keyword='exposure')
+    return rates
+
+
+def _format_bytes(n_bytes):
+    for unit in ['bytes', 'kB', 'MB', 'GB']:
+        if abs(n_bytes) < 1024 or unit == 'GB':
+            break
+        n_bytes /= 1024
+    if unit == 'bytes':
+        return '{:d} bytes'.format(int(n_bytes))
+    return '{:.1f} {}'.format(n_bytes, unit)
+
+
+class Plan(namedtuple('Plan', ['files', 'masters', 'groups', 'bytes_read',
+                               'bytes_written', 'peak_memory', 'runtime',
+                               'problems'])):
+    """
+    What pressing Go on a `~reducer.astro_gui.Reduction` or
+    `~reducer.astro_gui.Combiner` would do, worked out from headers alone;
+    made by their ``plan`` methods.
+
+    Attributes
+    ----------
+
+    files : list of str
+        Input files selected.
+
+    masters : dict
+        For a reduction, the master each calibration step would use for
+        each file, as ``{file: {step: master}}``; empty for a combination.
+
+    groups : list of tuple
+        For a combination, ``(group, files)`` for each image that would be
+        made, where ``group`` holds the values of the keywords images are
+        grouped by; empty for a reduction.
+
+    bytes_read : int
+        Bytes read from disk, including masters.
+
+    bytes_written : int
+        Bytes written, before any compression.
+
+    peak_memory : int
+        Largest number of bytes held at once by the worker doing the job,
+        including masters and images read ahead or waiting to be written.
+
+    runtime : float
+        Estimated time, in seconds, from the rates the plan was made with.
+
+    problems : list of str
+        Things that would stop files being processed, e.g. a missing master
+        or an output that already exists.
+    """
+    __slots__ = ()
+
+    def report(self):
+        """
+        The plan as text, for people sizing a job.
+
+        Returns
+        -------
+
+        str
+        """
+        lines = ['{} files'.format(len(self.files))]
+        if self.groups:
+            lines.append('{} images made'.format(len(self.groups)))
+            for group, files in self.groups:
+                description = ', '.join('{}={}'.format(k, v)
+                                        for k, v in group.items())
+                lines.append('  {}: {} files'.format(description or 'all',
+                                                     len(files)))
+        used = sorted(set(master for masters in self.masters.values()
+                          for master in masters.values()))
+        if used:
+            lines.append('Masters used: {}'.format(', '.join(used)))
+        lines.append('Read: {}'.format(_format_bytes(self.bytes_read)))
+        lines.append('Written: {}'.format(_format_bytes(self.bytes_written)))
+        lines.append('Peak memory: {}'.format(
+            _format_bytes(self.peak_memory)))
+        lines.append('Estimated time: {:.1f} s'.format(self.runtime))
+        if self.problems:
+            lines.append('Problems:')
+            lines.extend('  ' + problem for problem in self.problems)
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.report()
@@ -0,0 +1,291 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import os
+import warnings
+
+import numpy as np
+
+__all__ = [
+    'CalibrationScheduler',
+    'Task',
+]
+
+
+class Task(object):
+    """
+    One node of the graph run by a `CalibrationScheduler`: reducing one
+    file, or combining one group of reduced files into a master.
+
+    Parameters
+    ----------
+
+    name : str
+        Description of the task, used in error messages.
+
+    action : callable
+        Called with no arguments to do the task.
+
+    depends_on : list of `Task`, optional
+        Tasks that must finish before this one can start.
+
+    files : list of str, optional
+        Input files the task works on.
+
+    group : dict, optional
+        For combine tasks, the values of the keywords the combined images
+        are grouped by.
+    """
+    def __init__(self, name, action, depends_on=None, files=None,
+                 group=None):
+        self.name = name
+        self.action = action
+        self.depends_on = list(depends_on or [])
+        self.files = list(files or [])
+        self.group = group
+
+    def __repr__(self):
+        return '<Task {}>'.format(self.name)
+
+
+def _row_values(summary, files):
+    """
+    The header values of each file, from a collection summary, with
+    missing values left out.
+    """
+    rows = {}
+    index = {name: idx for idx, name in enumerate(summary['file'])}
+    for name in files:
+        row = summary[index[name]]
+        values = {}
+        for column in summary.colnames:
+            value = row[column]
+            if value is np.ma.masked:
+                continue
+            values[column.lower()] = value
+        rows[name] = values
+    return rows
+
+
+def _same(value, other):
+    # Collections match strings without regard to case.
+    if isinstance(value, str) and isinstance(other, str):
+        return value.lower() == other.lower()
+    return value == other
+
+
+def _matches(values, selector):
+    """
+    Whether a file with header ``values`` can be selected by ``selector``;
+    keywords the file does not have are taken to match, so that a
+    dependency is never missed.
+    """
+    for keyword, wanted in selector.items():
+        keyword = keyword.lower()
+        if keyword in values and not _same(values[keyword], wanted):
+            return False
+    return True
+
+
+class CalibrationScheduler(object):
+    """
+    Run the reduction and combination steps of a night as a graph of tasks,
+    each starting as soon as the masters it needs are made, instead of each
+    step waiting for the whole of the one before it.
+
+    Each input file is reduced by its own task, and each group of reduced
+    files is combined by its own task. A reduction task waits only for the
+    masters that match the file: a flat in R waits for the bias and the
+    dark of its exposure time, and a light in R for the R flat, so lights
+    in one filter can be reduced while flats in another are still being
+    combined. When no master of a step matches a file exactly, e.g. because
+    darks are scaled to the closest exposure time, the file waits for every
+    master of that step.
+
+    Parameters
+    ----------
+
+    stages : list of tuple
+        ``(reduction, combiner)`` for each step in the order the notebook
+        runs them, e.g. bias, dark, flat and light. ``reduction`` is a
+        `~reducer.astro_gui.Reduction`; ``combiner`` is the
+        `~reducer.astro_gui.Combiner` that combines the files it reduces,
+        or ``None`` if they are not combined. The combiners' image source
+        must be the destination collection of their reduction, and a
+        collection to which files can be added from several threads, i.e.
+        an `~reducer.header_index.IndexedImageFileCollection`, so masters
+        are found as soon as they are written.
+
+    max_workers : int, optional
+        Number of tasks run at the same time; defaults to the number of
+        CPUs.
+    """
+    def __init__(self, stages, max_workers=None):
+        for reduction, combiner in stages:
+            if combiner is None:
+                continue
+            if combiner.image_source is not reduction.destination_collection:
+                raise ValueError("The image source of a combiner must be the "
+                                 "destination collection of its reduction.")
+            if not hasattr(combiner.image_source, 'add_file'):
+                raise ValueError("The images combined must be in a "
+                                 "collection to which files can be added, "
+                                 "such as an IndexedImageFileCollection.")
+        self._stages = list(stages)
+        self._max_workers = max_workers or os.cpu_count()
+        self._errors = {}
+
+    @property
+    def errors(self):
+        """
+        Exceptions raised by the tasks that failed in the last run, by
+        task.
+        """
+        return self._errors
+
+    def _master_type(self, reduction, combiner):
+        imagetyp = combiner.apply_to.get('imagetyp')
+        for image_type, value in reduction.imagetype_map.items():
+            if _same(value, imagetyp):
+                return image_type
+        return None
+
+    def plan(self):
+        """
+        Build the graph of tasks from the current contents of the input
+        collections. No images are read.
+
+        Returns
+        -------
+
+        list of `Task`
+            The tasks, each after those it depends on.
+        """
+        tasks = []
+        # (image type, list of combine tasks) of each earlier stage.
+        masters = []
+        for reduction, combiner in self._stages:
+            collection = reduction.image_collection
+            collection.refresh()
+            files = collection.files_filtered(**reduction.apply_to)
+            rows = _row_values(collection.summary, files)
+
+            needed = reduction.masters_used()
+            upstream = [combines for image_type, combines in masters
+                        if image_type is None or image_type in needed]
+
+            stage_tasks = {}
+            for name in files:
+                depends_on = []
+                for combines in upstream:
+                    matched = [task for task in combines
+                               if _matches(rows[name], task.group)]
+                    depends_on.extend(matched or combines)
+                stage_tasks[name] = Task(
+                    'reduce {}'.format(name),
+                    _reduce_action(reduction, name),
+                    depends_on=depends_on, files=[name])
+            tasks.extend(stage_tasks.values())
+
+            if combiner is None:
+                continue
+            combines = []
+            keywords = [k.lower() for k in combiner.group_keywords]
+            combined = [name for name in files
+                        if _matches(rows[name], combiner.apply_to)]
+            groups = []
+            for name in combined:
+                group = {k: rows[name][k] for k in keywords
+                         if k in rows[name]}
+                if group not in groups:
+                    groups.append(group)
+            for group in groups:
+                members = [name for name in combined
+                           if _matches(rows[name], group)]
+                description = ', '.join('{}={}'.format(k, v)
+                                        for k, v in group.items())
+                combines.append(Task(
+                    'combine {} ({})'.format(
+                        combiner.apply_to.get('imagetyp', 'images'),
+                        description or 'all'),
+                    _combine_action(combiner, group),
+                    depends_on=[stage_tasks[name] for name in members],
+                    files=members, group=group))
+            tasks.extend(combines)
+            masters.append((self._master_type(reduction, combiner), combines))
+        return tasks
+
+    def run(self):
+        """
+        Plan the tasks and run them, each as soon as those it depends on
+        have finished.
+
+        Tasks that depend on a task that failed are not run; the others
+        carry on.
+
+        Raises
+        ------
+
+        RuntimeError
+            If any task failed; the exceptions are in `errors`.
+        """
+        tasks = self.plan()
+        self._errors = {}
+        waiting_on = {task: set(task.depends_on) for task in tasks}
+        dependents = {task: [] for task in tasks}
+        for task in tasks:
+            for dependency in task.depends_on:
+                dependents[dependency].append(task)
+        skipped = []
+
+        def skip(task):
+            for dependent in dependents[task]:
+                if dependent in waiting_on:
+                    del waiting_on[dependent]
+                    skipped.append(dependent)
+                    skip(dependent)
+
+        ready = [task for task in tasks if not waiting_on[task]]
+        # Suppress warnings that come up here...mostly about HIERARCH
+        # keywords. The filters are restored, on this thread, once every
+        # task has finished.
+        with warnings.catch_warnings(), \
+                ThreadPoolExecutor(max_workers=self._max_workers) as pool:
+            warnings.simplefilter('ignore')
+            running = {}
+            while ready or running:
+                for task in ready:
+                    del waiting_on[task]
+                    running[pool.submit(task.action)] = task
+                ready = []
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        self._errors[task] = error
+                        skip(task)
+                        continue
+                    for dependent in dependents[task]:
+                        if dependent in waiting_on:
+                            waiting_on[dependent].discard(task)
+                            if not waiting_on[dependent]:
+                                ready.append(dependent)
+
+        if self._errors:
+            failures = '\n'.join('{}: {}'.format(task.name, error)
+                                 for task, error in self._errors.items())
+            raise RuntimeError("{} tasks failed and {} were not run because "
+                               "they depend on them:\n"
+                               "{}".format(len(self._errors), len(skipped),
+                                           failures))
+
+
+def _reduce_action(reduction, name):
+    def action():
+        return reduction.process_file(name)
+    return action
+
+
+def _combine_action(combiner, group):
+    def action():
+        return combiner.combine_group(group)
+    return action
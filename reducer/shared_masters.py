@@ -0,0 +1,267 @@
+from collections import namedtuple
+from multiprocessing import shared_memory
+import os
+import threading
+
+import numpy as np
+
+import ccdproc
+from astropy.io import fits
+
+from .calibration import DARK_MODEL_KEYWORD
+from .fits_io import read_master
+
+__all__ = [
+    'SharedMaster',
+    'SharedMasterStore',
+]
+
+# Shared memory blocks attached in this process, by name, with the image
+# built on them, so that each block is mapped only once per process.
+_attached = {}
+_attached_lock = threading.Lock()
+
+# Blocks detached while arrays on them were still in use.
+_in_use = []
+
+
+def _attach_block(name):
+    """
+    Attach an existing shared memory block. Where Python allows it the
+    block is not tracked by this process, since the publisher owns it;
+    otherwise worker processes started by `multiprocessing` share the
+    publisher's resource tracker, so tracking it again is harmless.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def _close_block(block):
+    """
+    Unmap a block, unless arrays still use it, in which case it is kept
+    until the process exits rather than invalidating them.
+    """
+    try:
+        block.close()
+    except BufferError:
+        _in_use.append(block)
+
+
+def _read_only_array(block, shape, dtype):
+    array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    array.flags.writeable = False
+    return array
+
+
+class SharedMaster(namedtuple('SharedMaster', ['data_name', 'mask_name',
+                                               'shape', 'dtype', 'unit',
+                                               'header'])):
+    """
+    Handle on a master image published by a `SharedMasterStore`.
+
+    Handles are small and can be pickled, so they can be sent to worker
+    processes, which call `attach` to get the image without reading or
+    copying it.
+    """
+    __slots__ = ()
+
+    def attach(self):
+        """
+        Map the image into this process.
+
+        The image is mapped once per process however often this is called,
+        and its data and mask are read-only.
+
+        Returns
+        -------
+
+        `~ccdproc.CCDData`
+        """
+        with _attached_lock:
+            try:
+                return _attached[self.data_name][1]
+            except KeyError:
+                pass
+            blocks = [_attach_block(self.data_name)]
+            data = _read_only_array(blocks[0], self.shape, self.dtype)
+            mask = None
+            if self.mask_name is not None:
+                blocks.append(_attach_block(self.mask_name))
+                mask = _read_only_array(blocks[1], self.shape, bool)
+            ccd = ccdproc.CCDData(data, mask=mask, unit=self.unit,
+                                  meta=fits.Header.fromstring(self.header))
+            _attached[self.data_name] = (blocks, ccd)
+            return ccd
+
+    def detach(self):
+        """
+        Unmap the image from this process. Images obtained from `attach`
+        must not be used afterwards.
+        """
+        with _attached_lock:
+            blocks, _ = _attached.pop(self.data_name, ([], None))
+        for block in blocks:
+            _close_block(block)
+
+
+class SharedMasterStore(object):
+    """
+    Master images published once into shared memory, to be mapped
+    read-only by every worker process instead of each worker reading and
+    caching its own copy.
+
+    Each master is published once however many times `publish` is called
+    for it; the calls are counted, and the shared memory is freed when as
+    many calls to `release` have been made, or when the store is closed.
+    Use the store as a context manager to be sure everything is freed at
+    the end of a run.
+
+    The data and mask of each master are shared; uncertainties are not.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # path -> [handle, blocks, reference count]
+        self._published = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _share(self, array):
+        block = shared_memory.SharedMemory(create=True,
+                                           size=max(array.nbytes, 1))
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        shared[...] = array
+        return block
+
+    def publish(self, path, ccd=None, **read_args):
+        """
+        Publish a master, or count another use of one already published.
+
+        Parameters
+        ----------
+
+        path : str
+            Name of the master's file, which identifies it.
+
+        ccd : `~ccdproc.CCDData`, optional
+            The master, if it has already been read; otherwise it is read
+            from ``path``.
+
+        read_args :
+            Passed to `~reducer.fits_io.read_master` when reading the master.
+
+        Returns
+        -------
+
+        `SharedMaster`
+        """
+        with self._lock:
+            entry = self._published.get(path)
+            if entry is not None:
+                entry[2] += 1
+                return entry[0]
+
+            if ccd is None:
+                ccd = read_master(path, **read_args)
+            data = np.asarray(ccd.data)
+            data = data.astype(data.dtype.newbyteorder('='), copy=False)
+            blocks = [self._share(data)]
+            mask_name = None
+            if ccd.mask is not None:
+                blocks.append(self._share(np.asarray(ccd.mask, dtype=bool)))
+                mask_name = blocks[1].name
+            header = fits.Header(ccd.meta)
+            handle = SharedMaster(blocks[0].name, mask_name, data.shape,
+                                  data.dtype.str, ccd.unit.to_string(),
+                                  header.tostring())
+            self._published[path] = [handle, blocks, 1]
+            return handle
+
+    def publish_masters(self, collection, **read_args):
+        """
+        Publish every master of a collection, e.g. the ``master_source`` of
+        a `~reducer.astro_gui.Reduction`, except dark models, which are not
+        images.
+
+        Parameters
+        ----------
+
+        collection : `~ccdproc.ImageFileCollection`
+            Collection holding the masters.
+
+        read_args :
+            Passed to `~reducer.fits_io.read_master` when reading the masters.
+
+        Returns
+        -------
+
+        dict
+            `SharedMaster` handles of the masters, by path.
+        """
+        handles = {}
+        for name in collection.files_filtered(master=True):
+            path = os.path.join(collection.location, name)
+            with fits.open(path) as hdulist:
+                if hdulist[0].header.get(DARK_MODEL_KEYWORD, False):
+                    continue
+            handles[path] = self.publish(path, **read_args)
+        return handles
+
+    def release(self, path):
+        """
+        Count one use of a master as finished, freeing its shared memory
+        after the last.
+
+        Parameters
+        ----------
+
+        path : str
+            Name of the master's file.
+        """
+        with self._lock:
+            entry = self._published.get(path)
+            if entry is None:
+                raise ValueError("{} has not been published".format(path))
+            entry[2] -= 1
+            if entry[2] > 0:
+                return
+            del self._published[path]
+        self._free(entry)
+
+    def handles(self):
+        """
+        Handles of every master published, by path, to be given to worker
+        processes, e.g. as the ``shared_masters`` of a `Reduction`.
+
+        Returns
+        -------
+
+        dict
+        """
+        with self._lock:
+            return {path: entry[0]
+                    for path, entry in self._published.items()}
+
+    def _free(self, entry):
+        handle, blocks, _ = entry
+        # The publishing process may have attached the master too.
+        handle.detach()
+        for block in blocks:
+            _close_block(block)
+            block.unlink()
+
+    def close(self):
+        """
+        Free the shared memory of every master, whatever its reference
+        count.
+        """
+        with self._lock:
+            entries = list(self._published.values())
+            self._published = {}
+        for entry in entries:
+            self._free(entry)
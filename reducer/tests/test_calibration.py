@@ -0,0 +1,183 @@
+import numpy as np
+import pytest
+
+import ccdproc
+from astropy import units as u
+from astropy.modeling import models
+
+from ..calibration import (_inverse_flat, flat_correct, subtract_dark,
+                           subtract_overscan, subtract_overscan_batch)
+
+
+def _image(value, exposure, shape=(20, 30), seed=0):
+    random = np.random.default_rng(seed)
+    data = random.normal(value, 5, size=shape)
+    ccd = ccdproc.CCDData(data, unit='adu')
+    ccd.header['exposure'] = exposure
+    return ccd
+
+
+def test_subtract_dark_matches_ccdproc():
+    ccd = _image(1000, 30.0)
+    master = _image(20, 10.0, seed=1)
+    master.header['subbias'] = True
+    for scale in [False, True]:
+        expected = ccdproc.subtract_dark(ccd, master, exposure_time='exposure',
+                                         exposure_unit=u.second, scale=scale)
+        result = subtract_dark(ccd, master, exposure_time='exposure',
+                               exposure_unit=u.second, scale=scale)
+        np.testing.assert_allclose(result.data, expected.data, rtol=1e-12)
+        assert result.unit == expected.unit
+        assert 'subtract_dark' in result.header
+
+
+def test_subtract_dark_leaves_input_unchanged():
+    ccd = _image(1000, 30.0)
+    original = ccd.data.copy()
+    master = _image(20, 30.0, seed=1)
+    result = subtract_dark(ccd, master, exposure_time='exposure',
+                           exposure_unit=u.second)
+    np.testing.assert_array_equal(ccd.data, original)
+    assert result.data is not ccd.data
+
+
+def test_subtract_dark_inplace():
+    ccd = _image(1000, 30.0)
+    expected = ccd.data - 20
+    master = ccdproc.CCDData(np.full(ccd.shape, 20.0), unit='adu')
+    master.header['exposure'] = 30.0
+    result = subtract_dark(ccd, master, exposure_time='exposure',
+                           exposure_unit=u.second, inplace=True)
+    assert result.data is ccd.data
+    np.testing.assert_allclose(result.data, expected)
+
+
+def _flat(shape=(20, 30)):
+    flat = _image(10000, 5.0, shape=shape, seed=2)
+    flat.data[3, 4] = 0
+    return flat
+
+
+def test_flat_correct_matches_ccdproc():
+    ccd = _image(1000, 30.0)
+    flat = _flat()
+    expected = ccdproc.flat_correct(ccd, flat)
+    result = flat_correct(ccd, flat)
+    np.testing.assert_allclose(result.data, expected.data, rtol=1e-12)
+    # Where the flat is zero the result is infinite, as with ccdproc.
+    assert np.isinf(result.data[3, 4]) and np.isinf(expected.data[3, 4])
+    assert result.unit == expected.unit
+    assert 'flat_correct' in result.header
+
+
+def test_flat_correct_leaves_input_unchanged():
+    ccd = _image(1000, 30.0)
+    original = ccd.data.copy()
+    flat_correct(ccd, _flat())
+    np.testing.assert_array_equal(ccd.data, original)
+
+
+def test_flat_correct_single_precision_inplace():
+    ccd = _image(1000, 30.0)
+    ccd.data = ccd.data.astype('float32')
+    flat = _flat()
+    expected = ccdproc.flat_correct(ccd, flat).data
+    data = ccd.data
+    result = flat_correct(ccd, flat, inplace=True)
+    assert result.data is data
+    assert result.data.dtype == np.float32
+    np.testing.assert_allclose(result.data, expected, rtol=1e-6)
+    # The single precision reciprocal is cached alongside the double one.
+    inverse, _ = _inverse_flat(flat, None, None, dtype='float32')
+    assert inverse is _inverse_flat(flat, None, None, dtype='float32')[0]
+    assert inverse.dtype == np.float32
+
+
+def _with_overscan(shape=(60, 80), seed=3):
+    random = np.random.default_rng(seed)
+    data = random.normal(1000, 5, size=shape)
+    rows, columns = np.indices(shape)
+    # A bias level that drifts along both axes.
+    data += 200 + 0.5 * rows + 0.02 * rows ** 2 + 0.3 * columns
+    return ccdproc.CCDData(data, unit='adu')
+
+
+@pytest.mark.parametrize('overscan_axis', [0, 1])
+@pytest.mark.parametrize('degree', [None, 0, 1, 3])
+def test_subtract_overscan_matches_ccdproc(overscan_axis, degree):
+    ccd = _with_overscan()
+    if overscan_axis == 1:
+        overscan = ccd[:, :10]
+    else:
+        overscan = ccd[:10, :]
+    model = None if degree is None else models.Polynomial1D(degree)
+    expected = ccdproc.subtract_overscan(ccd, overscan=overscan,
+                                         overscan_axis=overscan_axis,
+                                         model=model)
+    result = subtract_overscan(ccd, overscan=overscan,
+                               overscan_axis=overscan_axis, model=model)
+    np.testing.assert_allclose(result.data, expected.data, rtol=0,
+                               atol=1.5e-10)
+    assert 'subtract_overscan' in result.header
+
+
+def test_subtract_overscan_batch_matches_single():
+    images = [_with_overscan(seed=seed) for seed in range(3)]
+    stack = np.stack([ccd.data for ccd in images])
+    region = (slice(None), slice(0, 10))
+    batch = subtract_overscan_batch(stack, region, overscan_axis=1, order=2)
+    for ccd, subtracted in zip(images, batch):
+        single = subtract_overscan(ccd, overscan=ccd[region], overscan_axis=1,
+                                   model=models.Polynomial1D(2))
+        np.testing.assert_allclose(subtracted, single.data, rtol=0,
+                                   atol=1e-10)
+
+
+@pytest.mark.parametrize('encoding', [None, 'int16'])
+def test_dark_model_written_with_encoding(tmp_path, encoding):
+    from astropy.io import fits
+    from ccdproc import ImageFileCollection
+
+    from ..astro_gui import Combiner
+    from ..calibration import DarkModel
+
+    raw = tmp_path / 'raw'
+    reduced = tmp_path / 'reduced'
+    raw.mkdir()
+    reduced.mkdir()
+    random = np.random.default_rng(4)
+    offset = random.normal(100, 3, size=(20, 30))
+    rate = random.uniform(0.5, 2, size=(20, 30))
+    paths = []
+    for exposure in [10.0, 30.0, 60.0]:
+        path = str(raw / 'dark{:.0f}.fit'.format(exposure))
+        header = fits.Header(dict(imagetyp='DARK', exposure=exposure,
+                                  bunit='adu'))
+        fits.writeto(path, offset + rate * exposure, header)
+        paths.append(path)
+    expected = DarkModel.fit(paths)
+
+    combiner = Combiner(
+        description='Model', toggle_type='button',
+        file_name_base='dark_model', dark_model=True,
+        image_source=ImageFileCollection(str(raw), keywords='*'),
+        imagetype_map={'dark': 'DARK'}, apply_to={'imagetyp': 'dark'},
+        destination=str(reduced), output_encoding=encoding,
+        master_sidecars=False)
+    combiner.action()
+
+    path = str(reduced / 'dark_model.fit')
+    bitpix = 16 if encoding else -32
+    with fits.open(path, do_not_scale_image_data=True) as hdulist:
+        assert [hdu.header['BITPIX'] for hdu in hdulist] == [bitpix, bitpix]
+        scales = [hdu.header.get('BSCALE', 1) for hdu in hdulist]
+    model = DarkModel.read(path)
+    for values, original, bscale in [(model.offset, expected.offset,
+                                      scales[0]),
+                                     (model.rate, expected.rate, scales[1])]:
+        if encoding:
+            # See encode_hdu; astropy reads int16 images back as float32.
+            bound = bscale / 2 + np.abs(original) * 2.0 ** -24
+        else:
+            bound = np.abs(original) * 2.0 ** -24
+        assert np.all(np.abs(values - original) <= bound)
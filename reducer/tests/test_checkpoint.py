@@ -0,0 +1,165 @@
+import os
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+from ccdproc import ImageFileCollection
+
+from .. import astro_gui
+from ..checkpoint import CHECKPOINT_NAME, Checkpoint
+from ..fits_io import PARTIAL_SUFFIX, _partial_path
+
+LIGHTS = ['light0.fit', 'light1.fit', 'light2.fit']
+
+
+class Interrupted(BaseException):
+    """
+    Stands in for the process dying; not an Exception, so a reduction does
+    not carry on past it.
+    """
+
+
+def _write_raw(directory):
+    for idx, name in enumerate(LIGHTS):
+        header = fits.Header({'imagetyp': 'LIGHT', 'exposure': 10.0,
+                              'bunit': 'adu'})
+        data = np.full((8, 8), 100.0 + idx, dtype='float32')
+        fits.writeto(os.path.join(directory, name), data, header)
+
+
+def _reduction(raw, reduced):
+    return astro_gui.Reduction(
+        description='Reduce', toggle_type='button',
+        input_image_collection=ImageFileCollection(raw, keywords='*'),
+        imagetype_map={'light': 'LIGHT'}, apply_to={'imagetyp': 'light'},
+        destination=reduced, writer_threads=0, read_ahead=0)
+
+
+def _interrupt_before_link(monkeypatch, name):
+    """
+    Make writing ``name`` stop after the file is written and recorded but
+    before it is moved into place, leaving the partial file behind as a
+    process that died there would.
+    """
+    write_atomic = astro_gui.write_atomic
+
+    def interrupted(hdulist, path, before_commit=None):
+        if os.path.basename(path) != name:
+            return write_atomic(hdulist, path, before_commit=before_commit)
+        partial = _partial_path(path)
+        hdulist.writeto(partial)
+        before_commit(partial)
+        raise Interrupted
+
+    monkeypatch.setattr(astro_gui, 'write_atomic', interrupted)
+
+
+@pytest.fixture
+def interrupted_run(tmp_path, monkeypatch):
+    raw = tmp_path / 'raw'
+    reduced = tmp_path / 'reduced'
+    raw.mkdir()
+    reduced.mkdir()
+    _write_raw(str(raw))
+    _interrupt_before_link(monkeypatch, LIGHTS[1])
+    with pytest.raises(Interrupted):
+        _reduction(str(raw), str(reduced)).action()
+    monkeypatch.undo()
+    return str(raw), str(reduced)
+
+
+def _partials(directory):
+    return [entry for entry in os.listdir(directory)
+            if entry.endswith(PARTIAL_SUFFIX)]
+
+
+def test_done_after_interruption(interrupted_run):
+    raw, reduced = interrupted_run
+    journal = Checkpoint(reduced)
+    done = [journal.done(name, os.path.join(reduced, name),
+                         source_path=os.path.join(raw, name))
+            for name in LIGHTS]
+    # The second file was recorded but never moved into place.
+    assert done == [True, False, False]
+    assert not os.path.exists(os.path.join(reduced, LIGHTS[1]))
+    assert len(_partials(reduced)) == 1
+
+
+def test_remove_partial(interrupted_run):
+    _, reduced = interrupted_run
+    journal = Checkpoint(reduced)
+    journal.remove_partial([LIGHTS[0], LIGHTS[2]])
+    assert len(_partials(reduced)) == 1
+    journal.remove_partial([LIGHTS[1]])
+    assert not _partials(reduced)
+
+
+def test_action_reduces_only_unfinished_files(interrupted_run, monkeypatch):
+    raw, reduced = interrupted_run
+    finished = os.stat(os.path.join(reduced, LIGHTS[0])).st_mtime_ns
+    written = []
+    write_atomic = astro_gui.write_atomic
+
+    def spy(hdulist, path, before_commit=None):
+        written.append(os.path.basename(path))
+        return write_atomic(hdulist, path, before_commit=before_commit)
+
+    monkeypatch.setattr(astro_gui, 'write_atomic', spy)
+    reduction = _reduction(raw, reduced)
+    reduction.action()
+
+    assert written == LIGHTS[1:]
+    assert not reduction.failures
+    assert not _partials(reduced)
+    assert os.stat(os.path.join(reduced, LIGHTS[0])).st_mtime_ns == finished
+    for idx, name in enumerate(LIGHTS):
+        data = fits.getdata(os.path.join(reduced, name))
+        np.testing.assert_allclose(data, 100.0 + idx)
+
+    journal = Checkpoint(reduced)
+    assert all(journal.done(name, os.path.join(reduced, name),
+                            source_path=os.path.join(raw, name))
+               for name in LIGHTS)
+
+
+def test_changed_input_is_not_done(interrupted_run):
+    raw, reduced = interrupted_run
+    source = os.path.join(raw, LIGHTS[0])
+    journal = Checkpoint(reduced)
+    assert journal.done(LIGHTS[0], os.path.join(reduced, LIGHTS[0]),
+                        source_path=source)
+    stat = os.stat(source)
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert not journal.done(LIGHTS[0], os.path.join(reduced, LIGHTS[0]),
+                            source_path=source)
+
+
+def test_truncated_last_line(tmp_path):
+    directory = str(tmp_path)
+    sources = []
+    for name in ['a.fit', 'b.fit', 'c.fit']:
+        for prefix in ['in_', '']:
+            with open(os.path.join(directory, prefix + name), 'w') as f:
+                f.write(name)
+        sources.append(os.path.join(directory, 'in_' + name))
+
+    journal = Checkpoint(directory)
+    journal.record(sources[0], 'a.fit', os.path.join(directory, 'a.fit'))
+    journal.record(sources[1], 'b.fit', os.path.join(directory, 'b.fit'))
+    # The process died part way through writing the second record.
+    path = os.path.join(directory, CHECKPOINT_NAME)
+    with open(path, 'rb') as f:
+        contents = f.read()
+    with open(path, 'wb') as f:
+        f.write(contents[:-10])
+
+    journal = Checkpoint(directory)
+    assert journal.done(sources[0], os.path.join(directory, 'a.fit'))
+    assert not journal.done(sources[1], os.path.join(directory, 'b.fit'))
+
+    # Records added after the cut short line are still read.
+    journal.record(sources[2], 'c.fit', os.path.join(directory, 'c.fit'))
+    journal = Checkpoint(directory)
+    assert journal.done(sources[0], os.path.join(directory, 'a.fit'))
+    assert journal.done(sources[2], os.path.join(directory, 'c.fit'))
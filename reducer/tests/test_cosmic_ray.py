@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+import ccdproc
+from astropy.io import fits
+
+from ..cosmic_ray import clean_cosmic_rays, cosmicray_clean, tile_slices
+
+
+def _image_with_cosmic_rays(shape=(150, 130), n_rays=60, seed=0):
+    random = np.random.default_rng(seed)
+    data = random.normal(1000, 10, size=shape)
+    rows = random.integers(0, shape[0], n_rays)
+    columns = random.integers(0, shape[1], n_rays)
+    data[rows, columns] += random.uniform(2000, 5000, n_rays)
+    return data, rows, columns
+
+
+def test_tiles_cover_image_once():
+    shape = (150, 130)
+    covered = np.zeros(shape, dtype=int)
+    for outer, inner, core in tile_slices(shape, tile_size=40, overlap=7):
+        covered[inner] += 1
+        tile = np.zeros(shape)[outer]
+        assert tile[core].shape == covered[inner].shape
+    assert (covered == 1).all()
+
+
+@pytest.mark.parametrize('n_threads', [1, 4])
+def test_median_one_pass_matches_ccdproc(n_threads):
+    data, rows, columns = _image_with_cosmic_rays()
+    expected, expected_mask = ccdproc.cosmicray_median(
+        data, error_image=data.std(), thresh=5, mbox=11, gbox=0, rbox=5)
+    cleaned, crmask = clean_cosmic_rays(data, method='median', max_iter=1,
+                                        tile_size=40, n_threads=n_threads)
+    np.testing.assert_array_equal(crmask, expected_mask)
+    np.testing.assert_array_equal(cleaned, expected)
+    assert crmask[rows, columns].all()
+
+
+def test_input_not_modified():
+    data, _, _ = _image_with_cosmic_rays()
+    original = data.copy()
+    clean_cosmic_rays(data, tile_size=40, n_threads=2)
+    np.testing.assert_array_equal(data, original)
+
+
+def test_tiling_does_not_change_cosmic_rays_found():
+    data, _, _ = _image_with_cosmic_rays()
+    _, whole = clean_cosmic_rays(data, max_iter=2, n_threads=1)
+    _, tiled = clean_cosmic_rays(data, max_iter=2, tile_size=40,
+                                 n_threads=4)
+    np.testing.assert_array_equal(tiled, whole)
+
+
+def test_cosmicray_clean_adds_to_mask():
+    data, rows, columns = _image_with_cosmic_rays()
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[0, 0] = True
+    ccd = ccdproc.CCDData(data, unit='adu', mask=mask, meta=fits.Header())
+    result = cosmicray_clean(ccd, max_iter=1, tile_size=40, n_threads=2)
+    assert result.mask[0, 0]
+    assert result.mask[rows, columns].all()
+    assert result.header['CRCLEAN'] == 'median'
+
+
+def test_bad_method():
+    with pytest.raises(ValueError):
+        clean_cosmic_rays(np.zeros((10, 10)), method='nope')
@@ -0,0 +1,147 @@
+import os
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+from ccdproc import ImageFileCollection
+
+from .. import astro_gui, fits_io
+from ..checkpoint import Checkpoint
+
+GOOD = ['lightR0.fit', 'lightR1.fit', 'lightR2.fit']
+
+SETTINGS = [
+    dict(read_ahead=0, writer_threads=0),
+    dict(read_ahead=2, writer_threads=1),
+]
+
+
+def _write(path, value, **keywords):
+    header = fits.Header(dict(bunit='adu', **keywords))
+    fits.writeto(path, np.full((8, 8), value, dtype='float32'), header)
+
+
+@pytest.fixture
+def night(tmp_path):
+    """
+    Lights in R, a master flat for R only, and a destination.
+    """
+    raw = tmp_path / 'raw'
+    masters = tmp_path / 'masters'
+    reduced = tmp_path / 'reduced'
+    for directory in [raw, masters, reduced]:
+        directory.mkdir()
+    for idx, name in enumerate(GOOD):
+        _write(str(raw / name), 100.0 * (idx + 1), imagetyp='LIGHT',
+               filter='R')
+    _write(str(masters / 'flat_R.fit'), 2.0, imagetyp='FLAT', filter='R',
+           master=True)
+    return str(raw), str(masters), str(reduced)
+
+
+def _reduction(night, **kwd):
+    raw, masters, reduced = night
+    reduction = astro_gui.Reduction(
+        description='Reduce', toggle_type='button',
+        input_image_collection=ImageFileCollection(raw, keywords='*'),
+        imagetype_map={'light': 'LIGHT', 'flat': 'FLAT'},
+        apply_to={'imagetyp': 'light'}, destination=reduced,
+        master_source=ImageFileCollection(masters, keywords='*'), **kwd)
+    reduction._flat_calib.toggle.value = True
+    return reduction
+
+
+def _reduced(night):
+    return sorted(os.listdir(night[2]))
+
+
+def _fits_files(night):
+    return [name for name in _reduced(night) if name.endswith('.fit')]
+
+
+def _add_truncated(night, name='lightR1b.fit'):
+    raw = night[0]
+    with open(os.path.join(raw, GOOD[0]), 'rb') as f:
+        contents = f.read()
+    # The header is intact but the data are cut short.
+    with open(os.path.join(raw, name), 'wb') as f:
+        f.write(contents[:2880 + 100])
+    return name
+
+
+@pytest.mark.parametrize('settings', SETTINGS)
+def test_corrupt_input_does_not_stop_others(night, settings, capsys):
+    bad = _add_truncated(night)
+    reduction = _reduction(night, **settings)
+    reduction.action()
+
+    assert _fits_files(night) == GOOD
+    assert list(reduction.failures) == [bad]
+    assert bad in capsys.readouterr().out
+    for idx, name in enumerate(GOOD):
+        data = fits.getdata(os.path.join(night[2], name))
+        np.testing.assert_allclose(data, 100.0 * (idx + 1))
+    assert bad in Checkpoint(night[2]).failures()
+
+
+@pytest.mark.parametrize('settings', SETTINGS)
+def test_missing_master(night, settings):
+    _write(os.path.join(night[0], 'lightV0.fit'), 100.0, imagetyp='LIGHT',
+           filter='V')
+    reduction = _reduction(night, **settings)
+    reduction.action()
+
+    assert _fits_files(night) == GOOD
+    assert list(reduction.failures) == ['lightV0.fit']
+    assert 'No master found' in reduction.failures['lightV0.fit']
+
+
+def test_background_write_error_is_mapped_to_input(night, monkeypatch):
+    write_atomic = fits_io.write_atomic
+
+    def disk_full(hdulist, path, before_commit=None):
+        if os.path.basename(path) == GOOD[1]:
+            raise OSError(28, 'No space left on device')
+        return write_atomic(hdulist, path, before_commit=before_commit)
+
+    # Files queued on a background writer are written by fits_io.
+    monkeypatch.setattr(fits_io, 'write_atomic', disk_full)
+    reduction = _reduction(night, read_ahead=2, writer_threads=1)
+    reduction.action()
+
+    assert _fits_files(night) == [GOOD[0], GOOD[2]]
+    assert list(reduction.failures) == [GOOD[1]]
+    assert 'No space left' in reduction.failures[GOOD[1]]
+
+    monkeypatch.undo()
+    reduction.retry_failed()
+    assert not reduction.failures
+    assert _fits_files(night) == GOOD
+
+
+def test_retry_failed_from_journal(night, monkeypatch):
+    _write(os.path.join(night[0], 'lightV0.fit'), 100.0, imagetyp='LIGHT',
+           filter='V')
+    _reduction(night).action()
+    assert _fits_files(night) == GOOD
+
+    # After a restart only the journal knows what failed. Once the master
+    # is there the failed file, and only it, is reduced.
+    _write(os.path.join(night[1], 'flat_V.fit'), 4.0, imagetyp='FLAT',
+           filter='V', master=True)
+    written = []
+    write_atomic = astro_gui.write_atomic
+
+    def spy(hdulist, path, before_commit=None):
+        written.append(os.path.basename(path))
+        return write_atomic(hdulist, path, before_commit=before_commit)
+
+    monkeypatch.setattr(astro_gui, 'write_atomic', spy)
+    _reduction(night, read_ahead=0, writer_threads=0).retry_failed()
+
+    assert written == ['lightV0.fit']
+    assert _fits_files(night) == sorted(GOOD + ['lightV0.fit'])
+    np.testing.assert_allclose(
+        fits.getdata(os.path.join(night[2], 'lightV0.fit')), 100.0)
+    assert not Checkpoint(night[2]).failures()
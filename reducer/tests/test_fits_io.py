@@ -0,0 +1,255 @@
+import os
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+from ..fits_io import (compress_hdulist, encode_hdu, image_hdu_index,
+                       read_ccd, read_master, sidecar_paths, write_sidecar)
+
+
+def _image(shape=(50, 60), seed=0):
+    random = np.random.default_rng(seed)
+    data = random.normal(1000, 100, size=shape)
+    data[0, 0] = np.nan
+    data[0, 1] = np.inf
+    return data
+
+
+def _write(tmp_path, hdulist, name='image.fit'):
+    path = os.path.join(str(tmp_path), name)
+    hdulist.writeto(path)
+    return path
+
+
+@pytest.mark.parametrize('encoding', ['int16', 'int32'])
+def test_integer_encoding_error_bound(tmp_path, encoding):
+    data = _image()
+    finite = np.isfinite(data)
+    hdu = encode_hdu(fits.PrimaryHDU(data.copy()), encoding)
+    bscale = hdu.header['BSCALE']
+    n_bits = 8 * np.dtype(encoding).itemsize
+    low, high = data[finite].min(), data[finite].max()
+    assert bscale == pytest.approx((high - low) / (2.0 ** n_bits - 2))
+    path = _write(tmp_path, fits.HDUList([hdu]))
+
+    # Scaled back in double precision the error is at most BSCALE / 2.
+    with fits.open(path, do_not_scale_image_data=True) as hdulist:
+        header = hdulist[0].header
+        stored = hdulist[0].data
+        assert stored.dtype == np.dtype(encoding).newbyteorder('>')
+        decoded = stored * header['BSCALE'] + header['BZERO']
+        assert (stored[~finite] == header['BLANK']).all()
+    assert np.abs(decoded - data)[finite].max() <= bscale / 2
+
+    # Read as astropy reads it, with its rounding added.
+    ccd = read_ccd(path, unit='adu')
+    error = np.abs(ccd.data - data)
+    bound = bscale / 2
+    if ccd.data.dtype.itemsize == 4:
+        bound = bound + np.abs(data) * 2.0 ** -24
+    assert (error[finite] <= np.broadcast_to(bound, data.shape)[finite]).all()
+    assert np.isnan(ccd.data[~finite]).all()
+
+
+def test_integer_encoding_constant_image(tmp_path):
+    hdu = encode_hdu(fits.PrimaryHDU(np.full((4, 4), 7.0)), 'int16')
+    assert hdu.header.get('BSCALE', 1) == 1
+    path = _write(tmp_path, fits.HDUList([hdu]))
+    np.testing.assert_array_equal(fits.getdata(path), 7.0)
+
+
+def test_float_encoding(tmp_path):
+    data = _image()
+    hdu = encode_hdu(fits.PrimaryHDU(data.copy()), 'float32')
+    assert 'BSCALE' not in hdu.header
+    path = _write(tmp_path, fits.HDUList([hdu]))
+    ccd = read_ccd(path, unit='adu')
+    assert ccd.data.dtype.newbyteorder('=') == np.float32
+    np.testing.assert_array_equal(ccd.data, data.astype('float32'))
+
+
+def test_unknown_encoding():
+    with pytest.raises(ValueError):
+        encode_hdu(fits.PrimaryHDU(np.zeros((2, 2))), 'uint8')
+
+
+def _noisy(shape=(100, 120), sigma=10.0, seed=1):
+    random = np.random.default_rng(seed)
+    return random.normal(1000, sigma, size=shape)
+
+
+def _primary(data):
+    header = fits.Header({'OBJECT': 'M13', 'BUNIT': 'adu'})
+    return fits.HDUList([fits.PrimaryHDU(data, header=header)])
+
+
+@pytest.mark.parametrize('compression', ['GZIP_1', 'GZIP_2'])
+def test_gzip_round_trip_is_lossless(tmp_path, compression):
+    data = _image()
+    path = _write(tmp_path, compress_hdulist(_primary(data), 0, compression))
+    with fits.open(path) as hdulist:
+        assert image_hdu_index(hdulist) == 1
+        assert isinstance(hdulist[1], fits.CompImageHDU)
+        # The empty primary HDU keeps the keywords of the image.
+        assert hdulist[0].header['OBJECT'] == 'M13'
+        assert 'BSCALE' not in hdulist[0].header
+    ccd = read_ccd(path)
+    assert ccd.header['OBJECT'] == 'M13'
+    np.testing.assert_array_equal(ccd.data, data)
+
+
+def test_rice_round_trip_error_bound(tmp_path):
+    sigma = 10.0
+    quantize_level = 16.0
+    data = _noisy(sigma=sigma)
+    path = _write(tmp_path, compress_hdulist(_primary(data), 0, 'RICE_1',
+                                             quantize_level=quantize_level))
+    ccd = read_ccd(path)
+    # Each tile, a row by default, is quantized in steps of its noise, as
+    # estimated by astropy, divided by the level, so each value is off by
+    # at most half its tile's step.
+    with fits.open(path, disable_image_compression=True) as hdulist:
+        assert hdulist[1].header['ZTILE2'] == 1
+        steps = np.array(hdulist[1].data['ZSCALE'])
+    assert steps.mean() == pytest.approx(sigma / quantize_level, rel=0.1)
+    error = np.abs(ccd.data - data).max(axis=1)
+    assert (error <= steps / 2 * (1 + 1e-9)).all()
+
+
+def test_rice_is_reproducible(tmp_path):
+    data = _noisy()
+    paths = [_write(tmp_path, compress_hdulist(_primary(data), 0, 'RICE_1'),
+                    name='{}.fit'.format(idx)) for idx in range(2)]
+    with open(paths[0], 'rb') as first, open(paths[1], 'rb') as second:
+        assert first.read() == second.read()
+
+
+def test_compressed_integer_encoding(tmp_path):
+    data = _image()
+    finite = np.isfinite(data)
+    hdulist = _primary(data.copy())
+    encode_hdu(hdulist[0], 'int16')
+    bscale = hdulist[0].header['BSCALE']
+    path = _write(tmp_path, compress_hdulist(hdulist, 0, 'RICE_1'))
+    ccd = read_ccd(path)
+    # Integers are compressed losslessly, so only the encoding loses.
+    bound = bscale / 2 + np.abs(data) * 2.0 ** -24
+    error = np.abs(ccd.data - data)
+    assert (error[finite] <= bound[finite]).all()
+    assert np.isnan(ccd.data[~finite]).all()
+
+
+def test_compress_extension(tmp_path):
+    data = _noisy()
+    hdulist = fits.HDUList([fits.PrimaryHDU(),
+                            fits.ImageHDU(data, name='SCI')])
+    compressed = compress_hdulist(hdulist, 1, 'GZIP_2')
+    assert len(compressed) == 2
+    path = _write(tmp_path, compressed)
+    np.testing.assert_array_equal(read_ccd(path, unit='adu').data, data)
+
+
+def test_unknown_compression():
+    with pytest.raises(ValueError):
+        compress_hdulist(_primary(np.zeros((4, 4))), 0, 'ZIP')
+
+
+def _master(path, value, checksum=False):
+    data = np.full((20, 30), value, dtype='float32')
+    fits.writeto(path, data, fits.Header(dict(bunit='adu', master=True)),
+                 overwrite=True, checksum=checksum)
+
+
+def _mapped(ccd):
+    return isinstance(ccd.data, np.memmap) and not ccd.data.flags.writeable
+
+
+def test_sidecar_mapped(tmp_path):
+    path = os.path.join(str(tmp_path), 'master.fit')
+    _master(path, 5.0, checksum=True)
+    assert not _mapped(read_master(path))
+
+    assert write_sidecar(path)
+    assert all(os.path.exists(name) for name in sidecar_paths(path)[::2])
+    ccd = read_master(path)
+    assert _mapped(ccd)
+    assert ccd.data.dtype.isnative
+    expected = read_ccd(path)
+    np.testing.assert_array_equal(ccd.data, expected.data)
+    assert ccd.unit == expected.unit
+    assert ccd.header['MASTER']
+
+
+def test_sidecar_not_used_with_uncertainty(tmp_path):
+    path = os.path.join(str(tmp_path), 'master.fit')
+    _master(path, 5.0)
+    ccd = read_ccd(path)
+    ccd.uncertainty = np.ones(ccd.shape)
+    assert not write_sidecar(path, ccd)
+    assert not os.path.exists(sidecar_paths(path)[0])
+
+
+def _restamp(path, stat):
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+@pytest.mark.parametrize('change', ['size', 'mtime', 'datasum'])
+def test_stale_sidecar_ignored(tmp_path, change):
+    path = os.path.join(str(tmp_path), 'master.fit')
+    _master(path, 5.0, checksum=True)
+    write_sidecar(path)
+    stat = os.stat(path)
+
+    if change == 'size':
+        # More header cards make the file a block longer; keep the time.
+        with fits.open(path) as hdulist:
+            hdulist[0].header.extend(
+                [('KEY{}'.format(i), i) for i in range(40)])
+            hdulist.writeto(path, overwrite=True, checksum=True)
+        _restamp(path, stat)
+        assert os.path.getsize(path) != stat.st_size
+    elif change == 'mtime':
+        # The same data, but the file has been touched.
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    else:
+        # New data of the same size, with the time put back; only DATASUM
+        # gives the change away.
+        _master(path, 7.0, checksum=True)
+        _restamp(path, stat)
+        assert os.path.getsize(path) == stat.st_size
+
+    ccd = read_master(path)
+    assert not _mapped(ccd)
+    np.testing.assert_array_equal(ccd.data, read_ccd(path).data)
+
+
+@pytest.mark.parametrize('sidecars', [True, False])
+def test_combiner_writes_sidecars(tmp_path, sidecars):
+    from ccdproc import ImageFileCollection
+
+    from ..astro_gui import Combiner
+
+    raw = tmp_path / 'raw'
+    reduced = tmp_path / 'reduced'
+    raw.mkdir()
+    reduced.mkdir()
+    for idx in range(3):
+        fits.writeto(str(raw / 'bias{}.fit'.format(idx)),
+                     np.full((20, 30), 100.0 + idx, dtype='float32'),
+                     fits.Header(dict(bunit='adu', imagetyp='BIAS')))
+    combiner = Combiner(
+        description='Combine', toggle_type='button',
+        file_name_base='combined_bias',
+        image_source=ImageFileCollection(str(raw), keywords='*'),
+        imagetype_map={'bias': 'BIAS'}, apply_to={'imagetyp': 'bias'},
+        destination=str(reduced), master_sidecars=sidecars)
+    combiner._combine_method.toggle.value = True
+    combiner.action()
+
+    path = str(reduced / 'combined_bias.fit')
+    assert os.path.exists(sidecar_paths(path)[0]) == sidecars
+    ccd = read_master(path)
+    assert _mapped(ccd) == sidecars
+    np.testing.assert_allclose(ccd.data, 101.0)
@@ -0,0 +1,255 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+from ccdproc import ImageFileCollection
+
+from ..header_index import (HeaderIndex, IndexedImageFileCollection,
+                            header_cards, read_header)
+
+KEYWORDS = ['imagetyp', 'filter']
+
+
+def _write(path, **keywords):
+    header = fits.Header(dict(bunit='adu', **keywords))
+    fits.writeto(str(path), np.zeros((4, 4), dtype='float32'), header)
+
+
+@pytest.fixture
+def images(tmp_path):
+    for idx, filt in enumerate(['R', 'V', 'R']):
+        _write(tmp_path / 'light{}.fit'.format(idx), imagetyp='LIGHT',
+               filter=filt)
+    return tmp_path
+
+
+def _count_reads(monkeypatch):
+    """
+    Record the name of every file whose header the index reads from disk.
+    """
+    names = []
+    read_cards = HeaderIndex._read_cards
+
+    def counting(self, name):
+        names.append(name)
+        return read_cards(self, name)
+
+    monkeypatch.setattr(HeaderIndex, '_read_cards', counting)
+    return names
+
+
+def _assert_same_summary(summary, expected):
+    assert summary.colnames == expected.colnames
+    for name in expected.colnames:
+        assert list(summary[name]) == list(expected[name]), name
+
+
+def test_read_header_matches_astropy(images):
+    path = str(images / 'light0.fit')
+    header = read_header(path)
+    assert header == fits.getheader(path)
+    assert header_cards(header)[:3] == [('simple', True), ('bitpix', -32),
+                                        ('naxis', 2)]
+
+
+def test_read_header_truncated(images):
+    path = str(images / 'short.fit')
+    with open(str(images / 'light0.fit'), 'rb') as f:
+        contents = f.read()
+    with open(path, 'wb') as f:
+        f.write(contents[:1000])
+    with pytest.raises(OSError):
+        read_header(path)
+
+
+def test_scan_reads_only_changed_files(images, monkeypatch):
+    index = HeaderIndex(str(images))
+    names = sorted(os.listdir(str(images)))
+    names = [name for name in names if name.endswith('.fit')]
+    read = _count_reads(monkeypatch)
+
+    cards = index.scan(index.stat_files(names))
+    assert list(cards) == names
+    assert cards['light1.fit'] == header_cards(
+        fits.getheader(str(images / 'light1.fit')))
+    assert sorted(read) == names
+
+    # A new index on the same file reads nothing; cards come back from the
+    # index as lists.
+    del read[:]
+    again = HeaderIndex(str(images)).scan(index.stat_files(names))
+    assert read == []
+    assert {name: [tuple(card) for card in again[name]]
+            for name in again} == dict(cards)
+
+    fits.setval(str(images / 'light1.fit'), 'filter', value='B')
+    cards = index.scan(index.stat_files(names))
+    assert read == ['light1.fit']
+    assert dict(cards['light1.fit'])['filter'] == 'B'
+
+
+def test_scan_leaves_out_unreadable_files(images):
+    with open(str(images / 'junk.fit'), 'w') as f:
+        f.write('not a FITS file')
+    index = HeaderIndex(str(images))
+    cards = index.scan(index.stat_files(['light0.fit', 'junk.fit']))
+    assert list(cards) == ['light0.fit']
+
+
+def test_summary_matches_ccdproc(images):
+    for keywords in ['*', KEYWORDS]:
+        expected = ImageFileCollection(str(images), keywords=keywords)
+        collection = IndexedImageFileCollection(str(images),
+                                                keywords=keywords)
+        _assert_same_summary(collection.summary, expected.summary)
+        assert (collection.files_filtered(filter='R') ==
+                expected.files_filtered(filter='R')).all()
+
+
+def _no_headers_read(monkeypatch):
+    def fail(self, stats, header_keywords):
+        raise AssertionError("headers were read instead of the stored "
+                             "summary")
+
+    monkeypatch.setattr(IndexedImageFileCollection, '_summary_from_index',
+                        fail)
+
+
+def test_stored_summary_used(images, monkeypatch):
+    first = IndexedImageFileCollection(str(images), keywords=KEYWORDS)
+
+    _no_headers_read(monkeypatch)
+    second = IndexedImageFileCollection(str(images), keywords=KEYWORDS)
+
+    assert second.summary.colnames == ['file'] + KEYWORDS
+    assert list(second.summary['file']) == list(first.summary['file'])
+    assert list(second.summary['filter']) == ['R', 'V', 'R']
+
+
+def test_summary_stored_by_refresh_used(images, monkeypatch):
+    collection = IndexedImageFileCollection(str(images), keywords=KEYWORDS)
+    _write(images / 'light3.fit', imagetyp='LIGHT', filter='B')
+    collection.refresh()
+
+    # The summary stored by refresh lists 'file' among its keywords, the
+    # one built for a new collection does not; both are found the same way.
+    _no_headers_read(monkeypatch)
+    reopened = IndexedImageFileCollection(str(images), keywords=KEYWORDS)
+
+    assert list(reopened.summary['file']) == ['light0.fit', 'light1.fit',
+                                              'light2.fit', 'light3.fit']
+    assert list(reopened.summary['filter']) == ['R', 'V', 'R', 'B']
+
+
+def test_parallel_scan_matches_serial(tmp_path, monkeypatch):
+    for idx in range(20):
+        _write(tmp_path / 'image{:02d}.fit'.format(idx), imagetyp='LIGHT',
+               exposure=float(idx))
+    names = sorted(name for name in os.listdir(str(tmp_path))
+                   if name.endswith('.fit'))
+    serial = HeaderIndex(str(tmp_path), index_path=str(tmp_path / 's.db'),
+                         n_threads=1)
+    parallel = HeaderIndex(str(tmp_path), index_path=str(tmp_path / 'p.db'),
+                           n_threads=8)
+
+    threads = set()
+    read_cards = HeaderIndex._read_cards
+
+    def recording(self, name):
+        threads.add(threading.current_thread().name)
+        return read_cards(self, name)
+
+    monkeypatch.setattr(HeaderIndex, '_read_cards', recording)
+    expected = serial.scan(serial.stat_files(names))
+    assert threads == {threading.current_thread().name}
+
+    threads.clear()
+    assert parallel.scan(parallel.stat_files(names)) == expected
+    assert threading.current_thread().name not in threads
+    assert parallel.stored() == serial.stored()
+
+
+@pytest.mark.parametrize('keywords', ['*', KEYWORDS])
+def test_refresh_reads_only_changed_files(images, monkeypatch, keywords):
+    collection = IndexedImageFileCollection(str(images), keywords=keywords)
+    read = _count_reads(monkeypatch)
+
+    collection.refresh()
+    assert read == []
+
+    _write(images / 'light3.fit', imagetyp='LIGHT', filter='B')
+    os.remove(str(images / 'light0.fit'))
+    fits.setval(str(images / 'light2.fit'), 'filter', value='I')
+    collection.refresh()
+
+    assert sorted(read) == ['light2.fit', 'light3.fit']
+    expected = ImageFileCollection(str(images), keywords=keywords)
+    _assert_same_summary(collection.summary, expected.summary)
+    assert list(collection.files_filtered(filter='I')) == ['light2.fit']
+
+
+def test_refresh_drops_keywords_of_removed_files(images):
+    _write(images / 'odd.fit', imagetyp='LIGHT', oddkey=1)
+    collection = IndexedImageFileCollection(str(images), keywords='*')
+    assert 'oddkey' in collection.summary.colnames
+
+    os.remove(str(images / 'odd.fit'))
+    collection.refresh()
+
+    assert 'oddkey' not in collection.summary.colnames
+    expected = ImageFileCollection(str(images), keywords='*')
+    _assert_same_summary(collection.summary, expected.summary)
+
+
+def test_add_file_uses_header_in_memory(images, monkeypatch):
+    collection = IndexedImageFileCollection(str(images), keywords='*')
+    read = _count_reads(monkeypatch)
+
+    path = images / 'light3.fit'
+    _write(path, imagetyp='LIGHT', filter='B')
+    collection.add_file(str(path), fits.getheader(str(path)))
+
+    assert 'light3.fit' in collection.files
+    assert list(collection.files_filtered(filter='B')) == ['light3.fit']
+    _assert_same_summary(collection.summary,
+                         ImageFileCollection(str(images),
+                                             keywords='*').summary)
+    # Neither the collection nor a refresh of it read the header back.
+    collection.refresh()
+    IndexedImageFileCollection(str(images), keywords='*')
+    assert read == []
+
+
+@pytest.mark.parametrize('writer_threads', [0, 1])
+def test_reduction_adds_outputs_to_destination(tmp_path, monkeypatch,
+                                                writer_threads):
+    from .. import astro_gui
+
+    raw = tmp_path / 'raw'
+    reduced = tmp_path / 'reduced'
+    raw.mkdir()
+    reduced.mkdir()
+    for idx, filt in enumerate(['R', 'V', 'R']):
+        _write(raw / 'light{}.fit'.format(idx), imagetyp='LIGHT',
+               filter=filt)
+    destination = IndexedImageFileCollection(str(reduced), keywords='*')
+    reduction = astro_gui.Reduction(
+        description='Reduce', toggle_type='button',
+        input_image_collection=ImageFileCollection(str(raw), keywords='*'),
+        imagetype_map={'light': 'LIGHT'}, apply_to={'imagetyp': 'light'},
+        destination=str(reduced), destination_collection=destination,
+        allow_bias=False, allow_dark=False, allow_flat=False,
+        writer_threads=writer_threads)
+    read = _count_reads(monkeypatch)
+
+    reduction.action()
+
+    assert read == []
+    assert list(destination.files) == ['light0.fit', 'light1.fit',
+                                       'light2.fit']
+    _assert_same_summary(destination.summary,
+                         ImageFileCollection(str(reduced),
+                                             keywords='*').summary)
@@ -0,0 +1,116 @@
+import os
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+from ccdproc import ImageFileCollection
+
+from .. import astro_gui
+
+IMAGETYPE_MAP = {'light': 'LIGHT', 'flat': 'FLAT'}
+
+
+def _write(path, **keywords):
+    header = fits.Header(dict(bunit='adu', **keywords))
+    fits.writeto(path, np.ones((8, 8), dtype='float32'), header)
+
+
+@pytest.fixture
+def night(tmp_path):
+    """
+    Lights and flats in R and V, with a master flat for R only.
+    """
+    raw = tmp_path / 'raw'
+    masters = tmp_path / 'masters'
+    reduced = tmp_path / 'reduced'
+    for directory in [raw, masters, reduced]:
+        directory.mkdir()
+    for name, filt in [('lightR0.fit', 'R'), ('lightR1.fit', 'R'),
+                       ('lightV0.fit', 'V')]:
+        _write(str(raw / name), imagetyp='LIGHT', filter=filt)
+    _write(str(raw / 'lightX0.fit'), imagetyp='LIGHT')
+    for name, filt in [('flatR0.fit', 'R'), ('flatR1.fit', 'R'),
+                       ('flatR2.fit', 'R'), ('flatV0.fit', 'V')]:
+        _write(str(raw / name), imagetyp='FLAT', filter=filt)
+    _write(str(masters / 'flat_R.fit'), imagetyp='FLAT', filter='R',
+           master=True)
+    return str(raw), str(masters), str(reduced)
+
+
+def _reduction(night):
+    raw, masters, reduced = night
+    reduction = astro_gui.Reduction(
+        description='Reduce', toggle_type='button',
+        input_image_collection=ImageFileCollection(raw, keywords='*'),
+        imagetype_map=IMAGETYPE_MAP, apply_to={'imagetyp': 'light'},
+        destination=reduced,
+        master_source=ImageFileCollection(masters, keywords='*'))
+    reduction._flat_calib.toggle.value = True
+    return reduction
+
+
+def _combiner(night):
+    raw, _, reduced = night
+    combiner = astro_gui.Combiner(
+        description='Combine', toggle_type='button',
+        file_name_base='combined_flat', group_by='filter',
+        image_source=ImageFileCollection(raw, keywords='*'),
+        imagetype_map=IMAGETYPE_MAP, apply_to={'imagetyp': 'flat'},
+        destination=reduced)
+    combiner._combine_method.toggle.value = True
+    return combiner
+
+
+def test_reduction_plan(night):
+    plan = _reduction(night).plan()
+
+    assert sorted(plan.files) == ['lightR0.fit', 'lightR1.fit',
+                                  'lightV0.fit', 'lightX0.fit']
+    assert plan.masters['lightR0.fit'] == {'flat': 'flat_R.fit'}
+    assert plan.masters['lightR1.fit'] == {'flat': 'flat_R.fit'}
+    assert plan.masters['lightV0.fit'] == {}
+    assert plan.masters['lightX0.fit'] == {}
+    assert plan.groups == []
+    assert plan.bytes_read > 0
+    assert plan.bytes_written > 0
+
+    assert len(plan.problems) == 2
+    assert any(problem.startswith('lightV0.fit:')
+               for problem in plan.problems)
+    assert ('lightX0.fit: keyword filter needed to choose the flat master '
+            'is missing' in plan.problems)
+
+    report = plan.report()
+    assert report.startswith('4 files')
+    assert 'Masters used: flat_R.fit' in report
+    assert 'Problems:\n' in report
+    assert '  ' + plan.problems[0] in report
+
+
+def test_reduction_plan_skips_existing_outputs(night):
+    reduction = _reduction(night)
+    existing = os.path.join(night[2], 'lightR0.fit')
+    _write(existing, imagetyp='LIGHT', filter='R')
+
+    plan = reduction.plan()
+
+    assert '{} already exists'.format(existing) in plan.problems
+
+
+def test_combiner_plan(night):
+    plan = _combiner(night).plan()
+
+    assert sorted(plan.files) == ['flatR0.fit', 'flatR1.fit', 'flatR2.fit',
+                                  'flatV0.fit']
+    groups = {group['filter']: sorted(files) for group, files in plan.groups}
+    assert groups == {'R': ['flatR0.fit', 'flatR1.fit', 'flatR2.fit'],
+                      'V': ['flatV0.fit']}
+    assert plan.masters == {}
+    assert plan.problems == []
+
+    report = plan.report()
+    assert report.startswith('4 files\n2 images made')
+    assert '  filter=R: 3 files' in report
+    assert '  filter=V: 1 files' in report
+    assert 'Masters used' not in report
@@ -0,0 +1,206 @@
+import warnings
+
+import pytest
+
+from astropy.table import Table
+
+from ..scheduler import CalibrationScheduler, _matches
+
+IMAGETYPE_MAP = {'bias': 'BIAS', 'dark': 'DARK', 'flat': 'FLAT',
+                 'light': 'LIGHT'}
+
+RAW = [
+    ('bias0.fit', 'BIAS', 0.0, ''),
+    ('bias1.fit', 'BIAS', 0.0, ''),
+    ('dark10.fit', 'DARK', 10.0, ''),
+    ('dark20.fit', 'DARK', 20.0, ''),
+    ('flatR.fit', 'FLAT', 5.0, 'R'),
+    ('flatV.fit', 'FLAT', 5.0, 'V'),
+    ('lightR.fit', 'LIGHT', 10.0, 'R'),
+    ('lightV.fit', 'LIGHT', 30.0, 'V'),
+]
+
+
+class StubCollection(object):
+    """
+    Just enough of an IndexedImageFileCollection for planning.
+    """
+    def __init__(self, rows):
+        self.summary = Table(rows=rows,
+                             names=['file', 'imagetyp', 'exposure', 'filter'])
+
+    def refresh(self):
+        pass
+
+    def add_file(self, path, header):
+        pass
+
+    def files_filtered(self, **kwd):
+        return [row['file'] for row in self.summary
+                if _matches({k: row[k] for k in self.summary.colnames}, kwd)]
+
+
+class StubReduction(object):
+    def __init__(self, collection, image_type, masters, fail=()):
+        self.image_collection = collection
+        self.destination_collection = StubCollection(RAW)
+        self.imagetype_map = IMAGETYPE_MAP
+        self.apply_to = {'imagetyp': IMAGETYPE_MAP[image_type]}
+        self._masters = masters
+        self._fail = fail
+        self.reduced = []
+
+    def masters_used(self):
+        return self._masters
+
+    def process_file(self, name):
+        if name in self._fail:
+            raise ValueError("cannot reduce {}".format(name))
+        self.reduced.append(name)
+
+
+class StubCombiner(object):
+    def __init__(self, reduction, group_keywords=(), fail=()):
+        self.image_source = reduction.destination_collection
+        self.apply_to = dict(reduction.apply_to)
+        self.group_keywords = list(group_keywords)
+        self._fail = fail
+        self.combined = []
+
+    def combine_group(self, group):
+        if group in self._fail:
+            raise ValueError("cannot combine {}".format(group))
+        self.combined.append(group)
+
+
+def _stages(fail_reduce=(), fail_combine=()):
+    raw = StubCollection(RAW)
+    bias = StubReduction(raw, 'bias', [], fail=fail_reduce)
+    dark = StubReduction(raw, 'dark', ['bias'], fail=fail_reduce)
+    flat = StubReduction(raw, 'flat', ['bias', 'dark'], fail=fail_reduce)
+    light = StubReduction(raw, 'light', ['bias', 'dark', 'flat'],
+                          fail=fail_reduce)
+    return [
+        (bias, StubCombiner(bias, fail=fail_combine)),
+        (dark, StubCombiner(dark, ['exposure'], fail=fail_combine)),
+        (flat, StubCombiner(flat, ['filter'], fail=fail_combine)),
+        (light, None),
+    ]
+
+
+def _by_name(tasks):
+    return {task.name: task for task in tasks}
+
+
+def _depends_on(task):
+    return sorted(dependency.name for dependency in task.depends_on)
+
+
+def test_matches():
+    assert _matches({'exposure': 10.0, 'filter': 'R'}, {'exposure': 10.0})
+    assert not _matches({'exposure': 10.0}, {'exposure': 20.0})
+    # Strings match regardless of case, as in a collection.
+    assert _matches({'filter': 'r'}, {'FILTER': 'R'})
+    # A keyword the file does not have never rules a master out.
+    assert _matches({'filter': 'R'}, {'exposure': 10.0})
+
+
+def test_plan_combines_each_group():
+    tasks = _by_name(CalibrationScheduler(_stages()).plan())
+    combines = sorted(name for name in tasks if name.startswith('combine'))
+    assert combines == ['combine BIAS (all)',
+                        'combine DARK (exposure=10.0)',
+                        'combine DARK (exposure=20.0)',
+                        'combine FLAT (filter=R)',
+                        'combine FLAT (filter=V)']
+    assert (_depends_on(tasks['combine DARK (exposure=10.0)']) ==
+            ['reduce dark10.fit'])
+    assert (_depends_on(tasks['combine BIAS (all)']) ==
+            ['reduce bias0.fit', 'reduce bias1.fit'])
+
+
+def test_plan_exact_dark_waits_for_its_master_only():
+    tasks = _by_name(CalibrationScheduler(_stages()).plan())
+    assert _depends_on(tasks['reduce lightR.fit']) == [
+        'combine BIAS (all)',
+        'combine DARK (exposure=10.0)',
+        'combine FLAT (filter=R)',
+    ]
+
+
+def test_plan_closest_dark_waits_for_every_dark():
+    tasks = _by_name(CalibrationScheduler(_stages()).plan())
+    # No dark has the exposure of the flats or of the V light, so the
+    # closest could be any of them.
+    darks = ['combine DARK (exposure=10.0)', 'combine DARK (exposure=20.0)']
+    assert (_depends_on(tasks['reduce flatR.fit']) ==
+            ['combine BIAS (all)'] + darks)
+    assert (_depends_on(tasks['reduce lightV.fit']) ==
+            ['combine BIAS (all)'] + darks + ['combine FLAT (filter=V)'])
+
+
+def test_plan_only_masters_used():
+    stages = _stages()
+    stages[3][0]._masters = ['flat']
+    tasks = _by_name(CalibrationScheduler(stages).plan())
+    assert (_depends_on(tasks['reduce lightR.fit']) ==
+            ['combine FLAT (filter=R)'])
+    assert not tasks['reduce bias0.fit'].depends_on
+
+
+def test_plan_orders_dependencies_first():
+    tasks = CalibrationScheduler(_stages()).plan()
+    seen = set()
+    for task in tasks:
+        assert set(task.depends_on) <= seen
+        seen.add(task)
+
+
+def test_run_does_everything():
+    stages = _stages()
+    CalibrationScheduler(stages, max_workers=4).run()
+    reduced = sorted(name for reduction, _ in stages
+                     for name in reduction.reduced)
+    assert reduced == sorted(row[0] for row in RAW)
+    assert stages[2][1].combined in ([{'filter': 'R'}, {'filter': 'V'}],
+                                     [{'filter': 'V'}, {'filter': 'R'}])
+
+
+def test_run_skips_dependents_of_failed_combine():
+    stages = _stages(fail_combine=[{'filter': 'V'}])
+    scheduler = CalibrationScheduler(stages, max_workers=4)
+    with pytest.raises(RuntimeError) as error:
+        scheduler.run()
+    assert '1 tasks failed and 1 were not run' in str(error.value)
+    assert ([task.name for task in scheduler.errors] ==
+            ['combine FLAT (filter=V)'])
+    # The R light does not need the V flat, so it is still reduced.
+    assert stages[3][0].reduced == ['lightR.fit']
+    assert stages[2][1].combined == [{'filter': 'R'}]
+
+
+def test_run_skips_dependents_of_failed_reduction():
+    stages = _stages(fail_reduce=['dark20.fit'])
+    scheduler = CalibrationScheduler(stages, max_workers=4)
+    with pytest.raises(RuntimeError):
+        scheduler.run()
+    assert [task.name for task in scheduler.errors] == ['reduce dark20.fit']
+    # The flats, which might need the 20 s dark as the closest, are not
+    # reduced, so neither is any light, though the 10 s dark is made.
+    assert stages[1][1].combined == [{'exposure': 10.0}]
+    assert stages[2][0].reduced == []
+    assert stages[2][1].combined == []
+    assert stages[3][0].reduced == []
+
+
+def test_run_restores_warning_filters():
+    before = list(warnings.filters)
+    CalibrationScheduler(_stages(), max_workers=2).run()
+    assert warnings.filters == before
+
+
+def test_combiner_must_use_reduction_destination():
+    stages = _stages()
+    stages[0][1].image_source = StubCollection(RAW)
+    with pytest.raises(ValueError):
+        CalibrationScheduler(stages)
@@ -0,0 +1,149 @@
+import multiprocessing
+import os
+import pickle
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+import ccdproc
+from astropy.io import fits
+from ccdproc import ImageFileCollection
+
+from .. import astro_gui
+from ..calibration import DarkModel
+from ..shared_masters import SharedMasterStore
+
+
+def _master(path, data, mask=None, **keywords):
+    ccd = ccdproc.CCDData(data, unit='adu', mask=mask,
+                          meta=dict(master=True, **keywords))
+    ccd.write(path)
+    return path
+
+
+def _attached_sum(handle):
+    ccd = handle.attach()
+    return float(ccd.data.sum()), int(ccd.mask.sum()), ccd.header['FILTER']
+
+
+def _gone(name):
+    try:
+        block = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return True
+    block.close()
+    return False
+
+
+@pytest.fixture
+def flat(tmp_path):
+    data = np.arange(600, dtype='float64').reshape(20, 30)
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[3, 4] = True
+    return _master(str(tmp_path / 'flat_R.fit'), data, mask=mask,
+                   imagetyp='FLAT', filter='R')
+
+
+def test_publish_and_attach(flat):
+    with SharedMasterStore() as store:
+        handle = store.publish(flat)
+        ccd = handle.attach()
+        expected = ccdproc.CCDData.read(flat)
+        np.testing.assert_array_equal(ccd.data, expected.data)
+        np.testing.assert_array_equal(ccd.mask, expected.mask)
+        assert ccd.unit == expected.unit
+        assert ccd.header['FILTER'] == 'R'
+        assert not ccd.data.flags.writeable
+        assert not ccd.mask.flags.writeable
+        # Mapped once per process.
+        assert handle.attach() is ccd
+        assert store.handles() == {flat: handle}
+    assert _gone(handle.data_name)
+    assert _gone(handle.mask_name)
+
+
+def test_attach_in_worker_process(flat):
+    with SharedMasterStore() as store:
+        handle = store.publish(flat)
+        handle = pickle.loads(pickle.dumps(handle))
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(1) as pool:
+            result = pool.apply(_attached_sum, (handle,))
+    assert result == (float(np.arange(600).sum()), 1, 'R')
+
+
+def test_reference_counting(flat):
+    store = SharedMasterStore()
+    handle = store.publish(flat)
+    assert store.publish(flat) is handle
+
+    store.release(flat)
+    assert not _gone(handle.data_name)
+    assert store.handles() == {flat: handle}
+
+    store.release(flat)
+    assert _gone(handle.data_name)
+    assert store.handles() == {}
+    with pytest.raises(ValueError):
+        store.release(flat)
+
+
+def test_publish_masters_skips_dark_models(tmp_path, flat):
+    fits.writeto(str(tmp_path / 'not_master.fit'), np.ones((20, 30)),
+                 fits.Header(dict(bunit='adu', imagetyp='FLAT')),
+                 overwrite=True)
+    darks = []
+    for exposure in [10.0, 20.0]:
+        dark = ccdproc.CCDData(np.full((20, 30), exposure), unit='adu')
+        dark.header['exposure'] = exposure
+        darks.append(dark)
+    model = DarkModel.fit(darks)
+    model.header['master'] = True
+    model.to_hdulist().writeto(str(tmp_path / 'dark_model.fit'))
+
+    collection = ImageFileCollection(str(tmp_path), keywords='*')
+    with SharedMasterStore() as store:
+        handles = store.publish_masters(collection)
+        assert list(handles) == [flat]
+
+
+def test_reduction_uses_shared_masters(tmp_path, flat, monkeypatch):
+    raw = tmp_path / 'raw'
+    raw.mkdir()
+    for idx in range(2):
+        fits.writeto(str(raw / 'light{}.fit'.format(idx)),
+                     np.full((20, 30), 100.0 * (idx + 1)),
+                     fits.Header(dict(bunit='adu', imagetyp='LIGHT',
+                                      filter='R')))
+
+    def reduce(destination, shared_masters=None):
+        os.mkdir(destination)
+        reduction = astro_gui.Reduction(
+            description='Reduce', toggle_type='button',
+            input_image_collection=ImageFileCollection(str(raw),
+                                                       keywords='*'),
+            imagetype_map={'light': 'LIGHT', 'flat': 'FLAT'},
+            apply_to={'imagetyp': 'light'}, destination=destination,
+            master_source=ImageFileCollection(str(tmp_path), keywords='*'),
+            shared_masters=shared_masters, checkpoint=False)
+        reduction._flat_calib.toggle.value = True
+        reduction.action()
+        return [fits.getdata(os.path.join(destination, name))
+                for name in sorted(os.listdir(destination))]
+
+    expected = reduce(str(tmp_path / 'own'))
+    with SharedMasterStore() as store:
+        handles = store.publish_masters(
+            ImageFileCollection(str(tmp_path), keywords='*'))
+
+        def no_reading(path, **kwd):
+            raise AssertionError("master read instead of mapped")
+
+        monkeypatch.setattr(astro_gui, 'read_master', no_reading)
+        result = reduce(str(tmp_path / 'shared'), shared_masters=handles)
+    # Failures are recorded rather than raised, so check every file was
+    # written.
+    assert len(result) == len(expected) == 2
+    for data, expected_data in zip(result, expected):
+        np.testing.assert_array_equal(data, expected_data)
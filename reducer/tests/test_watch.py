@@ -0,0 +1,73 @@
+import os
+import warnings
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+from ccdproc import ImageFileCollection
+
+from .. import astro_gui
+from ..watch import FrameWatcher, frame_is_complete
+
+
+def _write(path, value=1.0, **keywords):
+    header = fits.Header(dict(bunit='adu', imagetyp='LIGHT', **keywords))
+    fits.writeto(path, np.full((8, 8), value, dtype='float32'), header)
+
+
+@pytest.fixture
+def reduction(tmp_path):
+    raw = tmp_path / 'raw'
+    reduced = tmp_path / 'reduced'
+    raw.mkdir()
+    reduced.mkdir()
+    _write(str(raw / 'light0.fit'))
+    return astro_gui.Reduction(
+        description='Reduce', toggle_type='button',
+        input_image_collection=ImageFileCollection(str(raw), keywords='*'),
+        imagetype_map={'light': 'LIGHT'}, apply_to={'imagetyp': 'light'},
+        destination=str(reduced), allow_bias=False, allow_dark=False,
+        allow_flat=False)
+
+
+def test_frame_is_complete(tmp_path):
+    path = str(tmp_path / 'frame.fit')
+    _write(path)
+    assert frame_is_complete(path)
+    with open(path, 'rb') as f:
+        contents = f.read()
+    with open(path, 'wb') as f:
+        f.write(contents[:-100])
+    assert not frame_is_complete(path)
+
+
+def test_poll_reduces_only_new_frames(reduction):
+    watcher = FrameWatcher(reduction, settle_time=0, use_inotify=False)
+    assert watcher.poll() == []
+
+    raw = reduction.image_collection.location
+    _write(os.path.join(raw, 'light1.fit'), value=2.0)
+    # The first check only sees the frame; it is reduced once its size has
+    # been seen not to change.
+    watcher.poll()
+    assert watcher.poll() == ['light1.fit']
+    assert [name for name in os.listdir(reduction.destination)
+            if name.endswith('.fit')] == ['light1.fit']
+    assert watcher.status()['n_reduced'] == 1
+    assert watcher.poll() == []
+
+
+def test_warning_filter_removed_on_stop(reduction):
+    before = list(warnings.filters)
+    watcher = FrameWatcher(reduction, poll_interval=0.01,
+                           use_inotify=False)
+    watcher.start()
+    try:
+        assert len(warnings.filters) == len(before) + 1
+        # Starting again while running adds nothing.
+        watcher.start()
+        assert len(warnings.filters) == len(before) + 1
+    finally:
+        watcher.stop()
+    assert warnings.filters == before
@@ -0,0 +1,383 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+import warnings
+
+import numpy as np
+
+from astropy.io.fits.verify import VerifyWarning
+
+from .header_index import FITS_BLOCK_SIZE, read_header
+
+__all__ = [
+    'FrameWatcher',
+    'frame_is_complete',
+]
+
+# inotify event flags, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = os.O_NONBLOCK
+
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def _padded(n_bytes):
+    return -(-n_bytes // FITS_BLOCK_SIZE) * FITS_BLOCK_SIZE
+
+
+def frame_is_complete(path):
+    """
+    Check whether a FITS file is at least as long as its primary header
+    says it should be, i.e. whether it has finished being written.
+
+    Parameters
+    ----------
+
+    path : str
+        Name of the file.
+
+    Returns
+    -------
+
+    bool
+    """
+    try:
+        header = read_header(path)
+        size = os.path.getsize(path)
+    except (OSError, ValueError, UnicodeDecodeError):
+        return False
+    naxis = header.get('NAXIS', 0)
+    n_pixels = int(np.prod([header.get('NAXIS{}'.format(i), 0)
+                            for i in range(1, naxis + 1)])) if naxis else 0
+    data_size = (abs(header.get('BITPIX', 8)) // 8 *
+                 header.get('GCOUNT', 1) *
+                 (header.get('PCOUNT', 0) + n_pixels))
+    return size >= len(header.tostring()) + _padded(data_size)
+
+
+class _Inotify(object):
+    """
+    Minimal inotify watch on one directory, reporting files closed after
+    writing or moved into it. Raises `OSError` where inotify is not
+    available.
+    """
+    def __init__(self, path):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError("inotify is not available")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        try:
+            init = libc.inotify_init1
+            add_watch = libc.inotify_add_watch
+        except AttributeError:
+            raise OSError("inotify is not available")
+        self._fd = init(IN_NONBLOCK)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if add_watch(self._fd, os.fsencode(path),
+                     IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(self._fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+
+    def wait(self, timeout):
+        """
+        Wait up to ``timeout`` seconds for events and return the names of
+        the files involved.
+        """
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buffer = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        names = []
+        offset = 0
+        while offset < len(buffer):
+            _, _, _, length = _INOTIFY_EVENT.unpack_from(buffer, offset)
+            offset += _INOTIFY_EVENT.size
+            name = buffer[offset:offset + length].rstrip(b'\0')
+            offset += length
+            names.append(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self._fd)
+
+
+class FrameWatcher(object):
+    """
+    Watch the input directory of a `~reducer.astro_gui.Reduction` and
+    reduce each new frame that matches it as soon as the file is complete.
+
+    New files are noticed through inotify where it is available and by
+    polling the directory otherwise. A file counts as complete once it is
+    as long as its header says it should be and either it has been closed
+    by the writer (inotify) or its size has not changed for
+    ``settle_time`` seconds.
+
+    Parameters
+    ----------
+
+    reduction : `~reducer.astro_gui.Reduction`
+        Widget whose settings, input collection, masters and destination
+        are used. Its input collection is refreshed before each batch of new
+        frames, so an `~reducer.header_index.IndexedImageFileCollection`
+        keeps that cheap.
+
+    poll_interval : float, optional
+        Longest time, in seconds, between checks of the directory.
+
+    settle_time : float, optional
+        Time, in seconds, a file's size must be unchanged before it is
+        treated as complete when no close event has been seen for it.
+
+    include_existing : bool, optional
+        If ``True``, frames already in the directory when watching starts
+        are reduced too, unless their reduced version already exists.
+
+    use_inotify : bool, optional
+        Set to ``False`` to always poll.
+
+    on_frame : callable, optional
+        Called as ``on_frame(file_name, status)`` after each frame is
+        reduced, where ``status`` is the dictionary returned by `status`.
+
+    Notes
+    -----
+
+    An error while checking the directory, e.g. a file system or database
+    that is briefly unavailable, does not stop the watcher; it is reported
+    by `status` and the directory is checked again after ``poll_interval``.
+    Frames that could not be reduced are listed in `failed` and are tried
+    again after `retry_failed`.
+    """
+    def __init__(self, reduction, poll_interval=5.0, settle_time=2.0,
+                 include_existing=False, use_inotify=True, on_frame=None):
+        self._reduction = reduction
+        self._collection = reduction.image_collection
+        self._location = self._collection.location
+        self._poll_interval = poll_interval
+        self._settle_time = settle_time
+        self._use_inotify = use_inotify
+        self._on_frame = on_frame
+
+        # Files that need no further attention: reduced, skipped because
+        # they do not match, or failed.
+        self._handled = set()
+        if not include_existing:
+            self._handled.update(self._fits_files())
+        # For files not yet complete, the (size, mtime, first seen) of the
+        # last check.
+        self._pending = {}
+        self._closed = set()
+
+        self._failed = {}
+        self._last_error = None
+        # Guards _handled and _failed, which retry_failed changes from the
+        # calling thread while the watcher runs.
+        self._lock = threading.Lock()
+        self._lags = []
+        self._started = None
+        self._thread = None
+        self._stop = threading.Event()
+        # The warnings filter added while watching, removed by stop.
+        self._warning_filter = None
+
+    def _fits_files(self):
+        return set(self._collection._get_files())
+
+    @property
+    def failed(self):
+        """
+        Files that could not be reduced, with the reason.
+        """
+        return dict(self._failed)
+
+    def retry_failed(self):
+        """
+        Try the frames that could not be reduced again, at the next check
+        of the directory.
+
+        Returns
+        -------
+
+        list of str
+            Names of the frames that will be tried again.
+        """
+        with self._lock:
+            names = sorted(self._failed)
+            self._failed.clear()
+            self._handled.difference_update(names)
+        return names
+
+    def status(self):
+        """
+        Summary of the frames reduced so far.
+
+        Returns
+        -------
+
+        dict
+            ``n_reduced``; ``mean_lag`` and ``max_lag``, the time in
+            seconds from a frame being written to its reduced version being
+            written; ``frames_per_minute`` since watching started;
+            ``n_failed``; ``running``, whether the watcher is running; and
+            ``last_error``, the error raised by the last check of the
+            directory, or ``None`` if it succeeded.
+        """
+        n_reduced = len(self._lags)
+        elapsed = time.time() - self._started if self._started else 0
+        return {
+            'n_reduced': n_reduced,
+            'mean_lag': float(np.mean(self._lags)) if self._lags else None,
+            'max_lag': float(np.max(self._lags)) if self._lags else None,
+            'frames_per_minute': 60 * n_reduced / elapsed if elapsed else 0,
+            'n_failed': len(self._failed),
+            'running': self._thread is not None and self._thread.is_alive(),
+            'last_error': self._last_error,
+        }
+
+    def _complete(self, name, now):
+        path = os.path.join(self._location, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._pending.pop(name, None)
+            return False
+        if not frame_is_complete(path):
+            self._pending[name] = (stat.st_size, stat.st_mtime, now)
+            return False
+        if name in self._closed:
+            return True
+        previous = self._pending.get(name)
+        if previous is None or previous[:2] != (stat.st_size,
+                                                stat.st_mtime):
+            self._pending[name] = (stat.st_size, stat.st_mtime, now)
+            return False
+        return now - previous[2] >= self._settle_time
+
+    def poll(self):
+        """
+        Check the directory once and reduce every new frame that is
+        complete.
+
+        Returns
+        -------
+
+        list of str
+            Names of the frames reduced.
+        """
+        now = time.time()
+        with self._lock:
+            new = sorted(self._fits_files() - self._handled)
+        ready = [name for name in new if self._complete(name, now)]
+        if not ready:
+            return []
+
+        self._collection.refresh()
+        matching = set(self._collection.files_filtered(
+            **self._reduction.apply_to))
+        reduced = []
+        for name in ready:
+            self._pending.pop(name, None)
+            self._closed.discard(name)
+            # A frame that fails is handled too, so it is not tried again
+            # on every check; retry_failed tries it again.
+            with self._lock:
+                self._handled.add(name)
+            if name not in matching:
+                continue
+            if os.path.exists(os.path.join(self._reduction.destination,
+                                           name)):
+                # Already reduced, e.g. by pressing Go earlier.
+                continue
+            try:
+                written = os.path.getmtime(os.path.join(self._location, name))
+                self._reduction.process_file(name)
+            except Exception as e:
+                with self._lock:
+                    self._failed[name] = repr(e)
+                continue
+            self._lags.append(time.time() - written)
+            reduced.append(name)
+            if self._on_frame is not None:
+                self._on_frame(name, self.status())
+        return reduced
+
+    def _run(self):
+        inotify = None
+        if self._use_inotify:
+            try:
+                inotify = _Inotify(self._location)
+            except OSError:
+                inotify = None
+
+        try:
+            while not self._stop.is_set():
+                try:
+                    if inotify is not None:
+                        # Files still settling need another look soon even
+                        # if no further events arrive for them.
+                        timeout = (min(self._poll_interval, self._settle_time)
+                                   if self._pending else self._poll_interval)
+                        closed = inotify.wait(timeout)
+                        with self._lock:
+                            self._closed.update(name for name in closed
+                                                if name not in self._handled)
+                    else:
+                        self._stop.wait(self._poll_interval)
+                    self.poll()
+                except Exception as e:
+                    # Keep watching; the next check may well succeed.
+                    self._last_error = repr(e)
+                    self._stop.wait(self._poll_interval)
+                else:
+                    self._last_error = None
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+    def start(self):
+        """
+        Start watching in a background thread.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        if self._reduction._master_source:
+            self._reduction._master_source.refresh()
+        # Only the warnings about long keywords written as HIERARCH cards
+        # are silenced, and only until stop is called; catch_warnings is
+        # not safe to use from the watcher thread.
+        if self._warning_filter is None:
+            warnings.filterwarnings('ignore', category=VerifyWarning,
+                                    message='.*a HIERARCH card will be '
+                                            'created')
+            self._warning_filter = warnings.filters[0]
+        self._started = time.time()
+        self._last_error = None
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop watching, after the frame currently being reduced (if any) is
+        finished.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._warning_filter is not None:
+            # Remove this filter itself, not one that merely looks the same.
+            for idx, warning_filter in enumerate(warnings.filters):
+                if warning_filter is self._warning_filter:
+                    del warnings.filters[idx]
+                    break
+            self._warning_filter = None